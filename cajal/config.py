@@ -1,4 +1,10 @@
 
+import os
+import os.path as op
 import logging
 
 LOG_LEVEL = logging.INFO
+
+# Folder and disk budget of the decompressed copies of .nii.gz files
+CACHE_DIR = os.getenv('CAJAL_CACHE_DIR', op.join(op.expanduser('~'), '.cache', 'cajal'))
+CACHE_MAX_BYTES = int(os.getenv('CAJAL_CACHE_MAX_BYTES', 10 * 1024**3))
@@ -3,10 +3,14 @@
 import  os
 import  numpy       as      np
 import  nibabel     as      nib
+import  scipy.sparse as     sp
 from    collections import  OrderedDict
 from    mayavi      import  mlab
 
-from    boyle.nifti.roi import get_rois_centers_of_mass
+from    .roi            import get_rois_centers_of_mass
+from    .matrix         import (matrix_edges, load_edge_list, select_edges,
+                                node_indices)
+from    .mesh           import show_iso_surface
 
 
 def test_quiver3d():
@@ -23,21 +27,414 @@ def get_random_color():
     return tuple(np.random.rand(3))
 
 
+def lab_mean_colors(colors1, colors2):
+    """
+    Return the mean of each pair of RGB colors computed in the CIE Lab
+    color space, which keeps the shade of colors of similar hue.
+
+    :param colors1: ndarray
+    :param colors2: ndarray
+    Arrays of shape (K, 3) with RGB values in [0, 1].
+
+    :return: ndarray
+    Array of shape (K, 3)
+    """
+    from skimage.color import rgb2lab, lab2rgb
+
+    if len(colors1) == 0:
+        return np.zeros((0, 3))
+
+    lab1 = rgb2lab(np.asarray(colors1, dtype=float)[np.newaxis, :, :3])
+    lab2 = rgb2lab(np.asarray(colors2, dtype=float)[np.newaxis, :, :3])
+    return lab2rgb((lab1 + lab2) / 2.)[0]
+
+
+def _set_lut_colors(module, rgb):
+    """
+    Make the colormap of a mayavi module map the scalar i to the color rgb[i].
+    """
+    rgba = np.column_stack([np.asarray(rgb, dtype=float)[:, :3],
+                            np.ones(len(rgb))]) * 255
+    lut_manager = module.module_manager.scalar_lut_manager
+    lut_manager.lut.number_of_colors = len(rgba)
+    lut_manager.lut.table = rgba.round().astype(np.uint8)
+    lut_manager.use_default_range = False
+    lut_manager.data_range = [0, max(len(rgba) - 1, 1)]
+
+
+def draw_nodes(centers, colors, sizes, resolution=20, figure=None):
+    """
+    Draw all the nodes as spheres of one glyph source.
+    The size of each sphere comes from the length of its glyph vector
+    and its color from its index in a lookup table, so there is only
+    one VTK pipeline whatever the number of nodes.
+
+    :param centers: ndarray
+    Array of shape (N, 3)
+
+    :param colors: ndarray
+    Array of shape (N, 3) with RGB values in [0, 1].
+
+    :param sizes: ndarray
+    Vector with size N with the diameter of each sphere.
+
+    :param resolution: int
+    :param figure: mayavi scene, optional
+
+    :return: mayavi glyph module
+    """
+    glyphs = mlab.quiver3d(*_node_vectors(centers, sizes), mode='sphere',
+                           scale_mode='vector', scale_factor=1,
+                           resolution=resolution, figure=figure)
+    glyphs.glyph.color_mode = 'color_by_scalar'
+    glyphs.glyph.glyph_source.glyph_position = 'center'
+    _set_lut_colors(glyphs, colors)
+    return glyphs
+
+
+def _node_vectors(centers, sizes):
+    """
+    Return the x, y, z, u, v, w arrays and scalars of the node glyphs.
+    """
+    n_nodes = len(centers)
+    x, y, z = np.asarray(centers, dtype=float).T
+    u = np.asarray(sizes, dtype=float)
+    v = np.zeros(n_nodes)
+    w = np.zeros(n_nodes)
+    return x, y, z, u, v, w, np.arange(n_nodes)
+
+
+def _update_nodes(glyphs, centers, colors, sizes):
+    """
+    Replace the data of the node glyphs made with draw_nodes.
+    """
+    x, y, z, u, v, w, scalars = _node_vectors(centers, sizes)
+    glyphs.mlab_source.reset(x=x, y=y, z=z, u=u, v=v, w=w, scalars=scalars)
+    _set_lut_colors(glyphs, colors)
+
+
+def draw_edges(starts, ends, colors, tube_radius=0.5, tube_sides=6,
+               figure=None):
+    """
+    Draw all the edges as tubes made from one polyline dataset, with one
+    color for each edge.
+
+    :param starts: ndarray
+    :param ends: ndarray
+    Arrays of shape (K, 3) with the coordinates of the ends of each edge.
+
+    :param colors: ndarray
+    Array of shape (K, 3) with RGB values in [0, 1].
+
+    :param tube_radius: float
+    :param tube_sides: int
+    :param figure: mayavi scene, optional
+
+    :return: mayavi surface module
+    """
+    if len(starts) == 0:
+        return None
+
+    src = _edge_source(starts, ends, figure=figure)
+    return _tube_surface(src, colors, tube_radius, tube_sides)
+
+
+def _edge_polylines(starts, ends):
+    """
+    Return the points, scalars and lines of the polyline dataset of the edges.
+    """
+    n_edges = len(starts)
+    points = np.empty((2 * n_edges, 3))
+    points[0::2] = starts
+    points[1::2] = ends
+
+    #both points of an edge get its index as scalar
+    scalars = np.repeat(np.arange(n_edges), 2)
+    lines = np.arange(2 * n_edges).reshape((n_edges, 2))
+    return points, scalars, lines
+
+
+def _edge_source(starts, ends, figure=None):
+    points, scalars, lines = _edge_polylines(starts, ends)
+    src = mlab.pipeline.scalar_scatter(points[:, 0], points[:, 1], points[:, 2],
+                                       scalars, figure=figure)
+    src.mlab_source.dataset.lines = lines
+    src.update()
+    return src
+
+
+def _update_edge_source(src, starts, ends):
+    """
+    Replace the edges of a source made with _edge_source.
+    """
+    points, scalars, lines = _edge_polylines(starts, ends)
+    src.mlab_source.reset(x=points[:, 0], y=points[:, 1], z=points[:, 2],
+                          scalars=scalars)
+    src.mlab_source.dataset.lines = lines
+    src.update()
+
+
+def _tube_surface(src, colors, tube_radius=0.5, tube_sides=6):
+    tubes = mlab.pipeline.tube(src, tube_radius=tube_radius,
+                               tube_sides=tube_sides)
+    surface = mlab.pipeline.surface(tubes)
+    _set_lut_colors(surface, colors)
+    return surface
+
+
+def connectivity_graph(rois_centers, colors={}, sizes={}, connections=None,
+                       top_k=None, percentile=None, density=None, weights=None):
+    """
+    Return the positions, sizes and colors of the nodes and edges to draw
+    for a connectivity graph. See show_brain_connectivity for the parameters.
+
+    :return: dict
+    With 'centers', 'node_colors', 'node_sizes' for the N nodes and
+    'starts', 'ends', 'edge_colors' for the K edges.
+    """
+    n_rois = len(rois_centers)
+
+    if colors:
+        assert(n_rois == len(colors))
+
+    if isinstance(connections, str):
+        connections = load_edge_list(connections, n_nodes=n_rois)
+
+    is_matrix = connections is not None and (sp.issparse(connections) or
+                                             connections.shape[0] != 2)
+    if is_matrix:
+        assert(n_rois == connections.shape[0] == connections.shape[1])
+
+    all_rois = np.array(list(rois_centers.keys()))
+    centers  = np.array([rois_centers[rval] for rval in all_rois], dtype=float)
+
+    node_colors = np.array([colors.get(rval, (0.5, 0.5, 0)) for rval in all_rois])
+    node_sizes  = np.array([sizes.get(rval, 1) for rval in all_rois], dtype=float)
+
+    conns = np.zeros((2, 0), dtype=int)
+    if connections is not None:
+        #if connectivity matrix, will transform it in array of pairs of indices
+        if is_matrix:
+            rows, cols, edge_weights = matrix_edges(connections)
+            conns = np.array([rows, cols])
+        #else, an array of pairs of ROI values has been given
+        else:
+            #transform it in pairs of indices
+            conns = node_indices(all_rois, connections)
+            #one weight per pair if given, otherwise they are all equal
+            if weights is not None and len(weights) == conns.shape[1]:
+                edge_weights = np.asarray(weights, dtype=float)
+            else:
+                edge_weights = np.ones(conns.shape[1])
+
+        no_loops = conns[0] != conns[1]
+        rows, cols, _ = select_edges(conns[0][no_loops], conns[1][no_loops],
+                                     edge_weights[no_loops],
+                                     top_k=top_k, percentile=percentile,
+                                     density=density, n_nodes=n_rois)
+        conns = np.array([rows, cols], dtype=int)
+
+    #tube color: the average of the ROI colors in Lab color space,
+    #so it also works when they are of the same shade
+    endpoint_colors = np.array([colors.get(rval, (1, 1, 1)) for rval in all_rois])
+    edge_colors = lab_mean_colors(endpoint_colors[conns[0]],
+                                  endpoint_colors[conns[1]])
+
+    return {'centers': centers,
+            'node_colors': node_colors,
+            'node_sizes': node_sizes,
+            'starts': centers[conns[0]],
+            'ends': centers[conns[1]],
+            'edge_colors': edge_colors}
+
+
+# mlab.view arguments of the snapshot camera presets, for volumes in
+# RAS voxel order: x from left to right, y from back to front, z upwards.
+CAMERA_PRESETS = {'lateral':  {'azimuth': 180, 'elevation': 90},
+                  'dorsal':   {'azimuth': 0,   'elevation': 0},
+                  'anterior': {'azimuth': 90,  'elevation': 90}}
+
+
+class ConnectivityScene(object):
+    """
+    One mayavi scene with a brain surface and the nodes and edges of a
+    connectivity graph, which can be replaced by the ones of another graph
+    without building a new scene.
+
+    :param vol: ndarray, optional
+    3D brain image whose surface is shown under the graphs.
+
+    :param size: tuple of 2 int
+    Size in pixels of the scene and its snapshots.
+
+    :param offscreen: bool
+    If True, the scene is rendered without opening a window, for headless
+    batch runs. It needs a VTK built with offscreen support.
+    This sets mlab.options.offscreen, which is global to the process, until
+    close() restores its previous value. Mayavi only honors it for figures
+    created after it is set, so create the scene before any other figure.
+
+    :param contour_intensity_threshold: float
+    :param lod: int
+    :param mesh_cache: cajal.mesh.MeshCache or bool
+    See show_brain_connectivity.
+
+    :param bgcolor: tuple of 3 floats
+
+    :param tube_radius: float
+    :param tube_sides: int
+    See draw_edges.
+    """
+    def __init__(self, vol=None, size=(800, 800), offscreen=False,
+                 contour_intensity_threshold=0.4, lod=0, mesh_cache=True,
+                 bgcolor=(0, 0, 0), tube_radius=0.5, tube_sides=6):
+        self._prev_offscreen = mlab.options.offscreen
+        if offscreen:
+            mlab.options.offscreen = True
+
+        self.fig = mlab.figure(size=size, bgcolor=bgcolor)
+        self.tube_radius = tube_radius
+        self.tube_sides = tube_sides
+
+        if vol is not None:
+            show_iso_surface(vol, level_fraction=contour_intensity_threshold,
+                             lod=lod, cache=mesh_cache, opacity=0.1,
+                             figure=self.fig)
+
+        self._nodes = None
+        self._edge_src = None
+        self._edges = None
+
+    def set_graph(self, rois_centers, colors={}, sizes={}, connections=None,
+                  **kwargs):
+        """
+        Show the graph of rois_centers and connections, replacing the data
+        of the nodes and edges of the previous one.
+        See show_brain_connectivity for the parameters, kwargs are
+        weights, top_k, percentile and density.
+
+        :return: ConnectivityScene
+        self
+        """
+        graph = connectivity_graph(rois_centers, colors, sizes, connections,
+                                   **kwargs)
+
+        if self._nodes is None:
+            self._nodes = draw_nodes(graph['centers'], graph['node_colors'],
+                                     graph['node_sizes'], figure=self.fig)
+        else:
+            _update_nodes(self._nodes, graph['centers'], graph['node_colors'],
+                          graph['node_sizes'])
+
+        has_edges = len(graph['starts']) > 0
+        if has_edges and self._edges is None:
+            self._edge_src = _edge_source(graph['starts'], graph['ends'],
+                                          figure=self.fig)
+            self._edges = _tube_surface(self._edge_src, graph['edge_colors'],
+                                        self.tube_radius, self.tube_sides)
+        elif has_edges:
+            _update_edge_source(self._edge_src, graph['starts'], graph['ends'])
+            _set_lut_colors(self._edges, graph['edge_colors'])
+
+        if self._edges is not None:
+            self._edges.visible = has_edges
+
+        return self
+
+    def snapshot(self, filepath, view='lateral'):
+        """
+        Save the scene seen from a camera preset into filepath.
+
+        :param filepath: string
+        :param view: string or dict
+        A key of CAMERA_PRESETS or arguments to mlab.view.
+
+        :return: string
+        filepath
+        """
+        view_kwargs = CAMERA_PRESETS[view] if isinstance(view, str) else view
+        mlab.view(focalpoint='auto', distance='auto', figure=self.fig,
+                  **view_kwargs)
+        mlab.savefig(filepath, figure=self.fig)
+        return filepath
+
+    def close(self):
+        """
+        Close the figure of the scene and restore mlab.options.offscreen.
+        """
+        try:
+            mlab.close(self.fig)
+        finally:
+            mlab.options.offscreen = self._prev_offscreen
+
+
+def snapshot_brain_connectivity(output_dir, subjects, vol=None,
+                                views=('lateral', 'dorsal', 'anterior'),
+                                size=(800, 800), offscreen=True, **kwargs):
+    """
+    Save PNG snapshots of the connectivity graph of each subject from fixed
+    camera presets, drawing all of them in one scene.
+
+    :param output_dir: string
+
+    :param subjects: list of dict
+    Each one with the arguments of ConnectivityScene.set_graph for a subject:
+    'rois_centers' and, optionally, 'connections', 'colors', 'sizes',
+    'top_k', 'percentile' and 'density', and also a 'name' for its files,
+    which is subject<index> by default.
+
+    :param vol: ndarray, optional
+    3D brain image shown under all the graphs.
+
+    :param views: list of strings
+    Keys of CAMERA_PRESETS.
+
+    :param size: tuple of 2 int
+    :param offscreen: bool
+    :param kwargs: other arguments to ConnectivityScene
+
+    :return: list of strings
+    The file names of the snapshots, <name>_<view>.png.
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    scene = ConnectivityScene(vol, size=size, offscreen=offscreen, **kwargs)
+
+    img_files = []
+    try:
+        for idx, subject in enumerate(subjects):
+            graph_kwargs = dict(subject)
+            name = graph_kwargs.pop('name', 'subject{}'.format(idx))
+            scene.set_graph(**graph_kwargs)
+
+            for view in views:
+                img_file = '{}_{}.png'.format(name, view)
+                scene.snapshot(os.path.join(output_dir, img_file), view)
+                img_files.append(img_file)
+    finally:
+        scene.close()
+
+    return img_files
+
+
 @mlab.show
 def show_brain_connectivity_on_atlas(vol, atlas_vol, colors={}, colormap=None,
                                      weights=None, sizes={}, connections=None,
-                                     contour_intensity_threshold=0.4):
+                                     contour_intensity_threshold=0.4, **kwargs):
 
     rois_centers = get_rois_centers_of_mass(atlas_vol)
 
     show_brain_connectivity(vol, rois_centers, colors, colormap, weights, sizes,
-                            connections, contour_intensity_threshold)
+                            connections, contour_intensity_threshold, **kwargs)
 
 
 @mlab.show
 def show_brain_connectivity(vol, rois_centers, colors={}, colormap=None,
                             weights=None, sizes={}, connections=None,
-                            contour_intensity_threshold=0.4):
+                            contour_intensity_threshold=0.4, top_k=None,
+                            percentile=None, density=None, lod=0,
+                            mesh_cache=True):
     """
 
     :param vol: ndarray
@@ -59,102 +456,63 @@ def show_brain_connectivity(vol, rois_centers, colors={}, colormap=None,
 
     :params weights: vector
     Vector of floats with size N.
+    With connection pairs, a vector with one weight for each of the K pairs,
+    used to select the strongest connections.
 
     :params sizes: vector of float
     Vector with size N
     Indicating the size of each drop
 
-    :param connections: ndarray
+    :param connections: ndarray, scipy.sparse matrix or string
     This array can have two different shapes:
     - Connectivity matrix: shape NxN, where each component
-    is a connection weight.
+    is a connection weight. It can also be a scipy.sparse matrix,
+    its edges are read without making it dense.
 
     - Connection pairs: 2xN, where each pair is the
     indication what two ROIs is connected.
 
+    It can also be the path to an edge list file with the ROI indices,
+    see cajal.matrix.load_edge_list.
+
 
     :param contour_intensity_threshold: float
     This will indicate the contour process of the
     vol surface the voxel intensity threshold
     to use to select where to perform the contour.
 
-    """
-    n_rois = len(rois_centers)
+    :param top_k: int
+    :param percentile: float
+    :param density: float
+    If given, only the strongest connections are drawn: the top_k largest
+    weights, the weights at or above this percentile, or a fraction of
+    all the possible connections. See cajal.matrix.select_edges.
+    Connection pairs without a weight for each pair are all equal.
 
-    if colors is not None:
-        assert(n_rois == len(colors))
+    :param lod: int
+    Level of detail of the brain surface, see cajal.mesh.iso_surface_mesh.
 
-    if connections is not None:
-        if connections.shape[0] != 2:
-            assert(n_rois == connections.shape[0] == connections.shape[1])
+    :param mesh_cache: cajal.mesh.MeshCache or bool
+    Cache of the brain surface mesh, so it is only extracted once for each
+    volume and threshold. See cajal.mesh.iso_surface_mesh.
+
+    """
+    graph = connectivity_graph(rois_centers, colors, sizes, connections,
+                               top_k=top_k, percentile=percentile,
+                               density=density, weights=weights)
 
     #plot brain contour
     src = mlab.pipeline.scalar_field(vol)
-    mlab.pipeline.iso_surface(src, contours=[vol.min()+contour_intensity_threshold*vol.ptp(), ],
-                              opacity=0.1)
+    show_iso_surface(vol, level_fraction=contour_intensity_threshold, lod=lod,
+                     cache=mesh_cache, opacity=0.1)
     #mlab.pipeline.volume(src)
 
     #plot drops
-    all_rois = np.array(rois_centers.keys())
-
-    #mlab.pipeline.iso_surface(src, contours=[vol.max()-0.1*vol.ptp(), ],)
-    ridx = 0
-    for rval in rois_centers:
-        c = rois_centers[rval]
-
-        params = {}
-        params['color'] = colors.get(rval, (0.5, 0.5, 0))
-         #[rval] if colors is not None else (0.5, 0.5, 0)
-        params['scale_factor'] = sizes.get(rval, 1)
+    draw_nodes(graph['centers'], graph['node_colors'], graph['node_sizes'],
+               resolution=20)
 
-        points = mlab.points3d(c[0], c[1], c[2],
-                               resolution=20,
-                               scale_mode='none',
-                               **params)
-        ridx += 1
-
-    if connections is not None:
-        #if connectivity matrix, will transform it in array of pairs of indices
-        if isinstance(connections, np.ndarray):
-            if connections.shape == (n_rois, n_rois):
-                conns = np.array(np.where(connections > 0))
-                weights = connections[connections > 0]
-        #else, an array of pairs of ROI values has been given
-        else:
-            n_links = connections.shape[1]
-            #transform it in pairs of indices
-            conns = np.zeros((2, n_links))
-            for rpidx in list(range(n_links)):
-                conns[0, rpidx] = np.where(all_rois == connections[0, rpidx])[0][0]
-                conns[1, rpidx] = np.where(all_rois == connections[1, rpidx])[0][0]
-
-        for pidx in list(range(conns.shape[1])):
-            pair = conns[:, pidx]
-            if pair[0] != pair[1]:
-                #which rois?
-                r1val = all_rois[pair[0]]
-                r2val = all_rois[pair[1]]
-
-                #tube color
-                #this average color works if they are of different shade,
-                #otherwise, you should use Lab color space.
-                r1color = colors.get(r1val, (1, 1, 1))
-                r2color = colors.get(r2val, (1, 1, 1))
-                tube_color = tuple(np.mean([r1color, r2color], axis=0))
-
-                #extreme points coordinates
-                roi1coord = rois_centers[r1val]
-                roi2coord = rois_centers[r2val]
-
-                coords = np.concatenate([roi1coord, roi2coord])
-                x = coords[0:4:3]
-                y = coords[1:5:3]
-                z = coords[2:6:3]
-                w = weights[pidx]
-                #mlab.flow
-
-                mlab.plot3d(x, y, z, tube_radius=0.5, tube_sides=6,
-                            color=tube_color)
+    draw_edges(graph['starts'], graph['ends'], graph['edge_colors'],
+               tube_radius=0.5, tube_sides=6)
 
     mlab.pipeline.image_plane_widget(src,
                             plane_orientation='z_axes',
@@ -0,0 +1,203 @@
+# coding=utf-8
+#-------------------------------------------------------------------------------
+# License: BSD 3 clause
+#-------------------------------------------------------------------------------
+"""
+Paginated HTML galleries of the images in an output folder.
+"""
+import  os
+import  os.path     as op
+import  json
+import  logging
+from    xml.sax.saxutils import escape, quoteattr
+
+import  numpy       as np
+import  skimage.io  as skio
+
+from    .utils.image    import area_downscale
+
+log = logging.getLogger(__name__)
+
+_PAGE_HEAD = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+body {{ font-family: sans-serif; }}
+figure {{ display: inline-block; margin: 4px; text-align: center; }}
+figcaption {{ font-size: small; word-break: break-all; max-width: {thumb_size}px; }}
+</style>
+</head>
+<body>
+'''
+
+_PAGE_FOOT = '''</body>
+</html>
+'''
+
+
+def page_filename(filename, page_no):
+    """
+    Return the file name of the page number page_no of a gallery,
+    the first page is filename itself.
+
+    @param filename: string
+    @param page_no: int
+    Starting from 1.
+
+    @return: string
+    """
+    if page_no == 1:
+        return filename
+
+    base, ext = op.splitext(filename)
+    return '{}_{}{}'.format(base, page_no, ext)
+
+
+def make_thumbnail(output_dir, img_file, thumbs_dir='thumbs', thumb_size=256):
+    """
+    Create a thumbnail of output_dir/img_file in output_dir/thumbs_dir,
+    unless there already is one newer than the image.
+
+    @param output_dir: string
+    @param img_file: string
+    Path to the image relative to output_dir.
+
+    @param thumbs_dir: string
+    Folder of the thumbnails relative to output_dir.
+
+    @param thumb_size: int
+    Maximum width and height of the thumbnail in pixels.
+
+    @return: (string, tuple of int)
+    Path to the thumbnail relative to output_dir and its (width, height).
+    """
+    img_path   = op.join(output_dir, img_file)
+    thumb_file = op.join(thumbs_dir, img_file)
+    thumb_path = op.join(output_dir, thumb_file)
+
+    if op.exists(thumb_path) and op.getmtime(thumb_path) >= op.getmtime(img_path):
+        thumb = skio.imread(thumb_path)
+    else:
+        img = skio.imread(img_path)
+        factor = int(np.ceil(max(img.shape[:2]) / float(thumb_size)))
+        thumb = area_downscale(img, factor)
+
+        os.makedirs(op.dirname(thumb_path), exist_ok=True)
+        skio.imsave(thumb_path, thumb)
+
+    return thumb_file, (thumb.shape[1], thumb.shape[0])
+
+
+def create_gallery(output_dir, img_files, per_page=100, thumb_size=256,
+                   thumbs_dir='thumbs', filename='index.html',
+                   manifest_filename='gallery.json', title='cajal'):
+    """
+    Write a paginated HTML gallery of the images in output_dir.
+
+    Each page shows per_page lazy-loaded thumbnails linked to the full
+    images, with links to the previous and next pages.
+    The entries are written to disk as they come, so img_files can be a
+    generator and only one page of entries is kept in memory.
+
+    @param output_dir: string
+
+    @param img_files: iterable of strings
+    Paths to the images relative to output_dir.
+
+    @param per_page: int
+    Number of images in each page.
+
+    @param thumb_size: int
+    Maximum width and height of the thumbnails in pixels.
+
+    @param thumbs_dir: string
+    Folder of the thumbnails relative to output_dir.
+
+    @param filename: string
+    File name of the first page. The other pages are named after it,
+    e.g., index_2.html, index_3.html, ...
+
+    @param manifest_filename: string
+    File name of the JSON list with one entry for each image with
+    its thumbnail, size and page. If None, it is not written.
+
+    @param title: string
+    Title of the pages.
+
+    @return: list of strings
+    The file names of the pages.
+    """
+    page     = []
+    pages    = []
+    page_no  = 1
+    manifest = None
+
+    def flush(has_next):
+        pages.append(_write_gallery_page(output_dir, page, page_no, has_next,
+                                         filename, title, thumb_size))
+
+    try:
+        if manifest_filename is not None:
+            manifest = open(op.join(output_dir, manifest_filename), 'w')
+            manifest.write('[')
+
+        for n, img_file in enumerate(img_files):
+            if len(page) == per_page:
+                flush(has_next=True)
+                page = []
+                page_no += 1
+
+            thumb_file, thumb_wh = make_thumbnail(output_dir, img_file,
+                                                  thumbs_dir, thumb_size)
+
+            entry = {'img': img_file, 'thumb': thumb_file,
+                     'thumb_size': thumb_wh, 'page': page_no}
+            page.append(entry)
+
+            if manifest is not None:
+                manifest.write((',\n' if n else '\n') +
+                               json.dumps(entry, separators=(',', ':')))
+
+        flush(has_next=False)
+
+        if manifest is not None:
+            manifest.write('\n]\n')
+    finally:
+        if manifest is not None:
+            manifest.close()
+
+    return pages
+
+
+def _write_gallery_page(output_dir, entries, page_no, has_next, filename,
+                        title, thumb_size):
+    """
+    Write one page of a gallery and return its file name.
+    """
+    page_file = page_filename(filename, page_no)
+
+    nav = []
+    if page_no > 1:
+        nav.append('<a href={}>&laquo; previous</a>'.format(quoteattr(page_filename(filename, page_no - 1))))
+    nav.append('page {}'.format(page_no))
+    if has_next:
+        nav.append('<a href={}>next &raquo;</a>'.format(quoteattr(page_filename(filename, page_no + 1))))
+    nav = '<p>' + ' | '.join(nav) + '</p>\n'
+
+    with open(op.join(output_dir, page_file), 'w') as f:
+        f.write(_PAGE_HEAD.format(title=escape(title), thumb_size=thumb_size))
+        f.write(nav)
+        for entry in entries:
+            width, height = entry['thumb_size']
+            f.write('<figure><a href={img}><img src={thumb} width="{w}" height="{h}" '
+                    'loading="lazy" alt={img}/></a><figcaption>{name}</figcaption>'
+                    '</figure>\n'.format(img=quoteattr(entry['img']),
+                                         thumb=quoteattr(entry['thumb']),
+                                         w=width, h=height,
+                                         name=escape(entry['img'])))
+        f.write(nav)
+        f.write(_PAGE_FOOT)
+
+    return page_file
@@ -0,0 +1,241 @@
+# coding=utf-8
+#-------------------------------------------------------------------------------
+# License: BSD 3 clause
+#-------------------------------------------------------------------------------
+"""
+Manifest of the images rendered into an output folder, to skip the
+subjects that did not change when a batch is run again.
+"""
+import  os
+import  os.path     as op
+import  json
+import  hashlib
+import  logging
+from    collections import OrderedDict
+
+import  numpy       as np
+
+log = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = 'manifest.jsonl'
+
+
+def file_sha1(filepath, blocksize=1 << 20):
+    """
+    Return the SHA1 hex digest of the content of filepath.
+
+    @param filepath: string
+    @param blocksize: int
+    Number of bytes read at once.
+
+    @return: string
+    """
+    sha = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def file_signature(filepath):
+    """
+    Return the path, size, modification time and content hash of filepath.
+
+    @param filepath: string
+
+    @return: dict
+    """
+    st = os.stat(filepath)
+    return {'path': op.abspath(filepath),
+            'size': st.st_size,
+            'mtime': st.st_mtime,
+            'sha1': file_sha1(filepath)}
+
+
+def _jsonable(value):
+    """
+    Return a JSON serializable version of value that is stable across runs.
+    """
+    if isinstance(value, dict):
+        return dict((str(k), _jsonable(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    # colormaps and other objects are identified by their name
+    name = getattr(value, 'name', None)
+    if name is not None:
+        return '{}:{}'.format(type(value).__name__, name)
+    return repr(value)
+
+
+def params_digest(params):
+    """
+    Return a hash of the rendering parameters in params.
+
+    @param params: dict
+
+    @return: string
+    """
+    text = json.dumps(_jsonable(params), sort_keys=True)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class RenderManifest(object):
+    """
+    Record of the images rendered in an output folder.
+
+    Each entry holds the names of the images a subject was rendered into,
+    the signature of its input files and a hash of the parameters they were
+    rendered with. The entries are appended to a JSON-lines file as soon as
+    each subject is done, so a run that dies in the middle keeps everything
+    it finished.
+
+    @param output_dir: string
+    Folder of the rendered images and the manifest file.
+
+    @param filename: string
+    Name of the manifest file in output_dir.
+    """
+
+    def __init__(self, output_dir, filename=MANIFEST_FILENAME):
+        self.output_dir = output_dir
+        self.path = op.join(output_dir, filename)
+        self._entries = OrderedDict()
+        self.load()
+
+    def load(self):
+        """
+        Read the entries of the manifest file, the last entry of each image wins.
+        """
+        self._entries = OrderedDict()
+        if not op.exists(self.path):
+            return
+
+        with open(self.path) as f:
+            for line_no, line in enumerate(f):
+                try:
+                    entry = json.loads(line)
+                    self._entries[entry['png']] = entry
+                except (ValueError, KeyError):
+                    # probably a line cut off by a crash
+                    log.warning('Ignoring line {} of {}.'.format(line_no + 1, self.path))
+
+    def __contains__(self, png_name):
+        return png_name in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, png_name):
+        return self._entries.get(png_name)
+
+    @staticmethod
+    def _outputs(entry):
+        # entries written before the outputs were recorded have only one image
+        return entry.get('outputs', [entry['png']])
+
+    def image_files(self):
+        """
+        Return the names of all the recorded images which exist in output_dir,
+        in the order they were first recorded.
+
+        @return: list of strings
+        """
+        return [name for entry in self._entries.values()
+                for name in self._outputs(entry)
+                if op.exists(op.join(self.output_dir, name))]
+
+    def is_up_to_date(self, png_name, input_files, params):
+        """
+        Return True if every image recorded for png_name exists and they were
+        rendered from input_files with the same content and the same params.
+
+        Only the input files whose size or modification time changed since
+        they were recorded are read to compare their hash.
+
+        @param png_name: string
+        File name of the image in output_dir.
+
+        @param input_files: list of strings
+
+        @param params: dict
+        Rendering parameters.
+
+        @return: bool
+        """
+        entry = self._entries.get(png_name)
+        if entry is None:
+            return False
+
+        if not all(op.exists(op.join(self.output_dir, name))
+                   for name in self._outputs(entry)):
+            return False
+
+        if entry['params'] != params_digest(params):
+            return False
+
+        if len(entry['inputs']) != len(input_files):
+            return False
+
+        touched = False
+        for recorded, filepath in zip(entry['inputs'], input_files):
+            if recorded['path'] != op.abspath(filepath) or not op.exists(filepath):
+                return False
+
+            st = os.stat(filepath)
+            if st.st_size == recorded['size'] and st.st_mtime == recorded['mtime']:
+                continue
+
+            if file_sha1(filepath) != recorded['sha1']:
+                return False
+
+            recorded['size'], recorded['mtime'] = st.st_size, st.st_mtime
+            touched = True
+
+        if touched:
+            self._append(entry)
+
+        return True
+
+    def record(self, png_name, input_signatures, params, outputs=None):
+        """
+        Add or replace the entry of png_name and append it to the manifest file.
+
+        @param png_name: string
+        File name of the image in output_dir.
+
+        @param input_signatures: list of dict
+        See file_signature.
+
+        @param params: dict
+        Rendering parameters.
+
+        @param outputs: list of strings, optional
+        File names of all the images rendered for png_name, e.g., one
+        for each axis. By default only png_name.
+        """
+        entry = {'png': png_name,
+                 'outputs': list(outputs) if outputs else [png_name],
+                 'inputs': list(input_signatures),
+                 'params': params_digest(params)}
+        self._entries[png_name] = entry
+        self._append(entry)
+
+    def _append(self, entry):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry, sort_keys=True) + '\n')
+
+    def compact(self):
+        """
+        Rewrite the manifest file with only the last entry of each image.
+        """
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for entry in self._entries.values():
+                f.write(json.dumps(entry, sort_keys=True) + '\n')
+        os.rename(tmp_path, self.path)
@@ -0,0 +1,743 @@
+# coding=utf-8
+#-------------------------------------------------------------------------------
+# License: BSD 3 clause
+#-------------------------------------------------------------------------------
+"""
+Connectivity matrix images composed directly with numpy, without matplotlib
+figures.
+"""
+import  os
+import  logging
+
+import  numpy       as np
+import  scipy.sparse    as sp
+
+from    .utils.image    import colormap_lut, scalar_to_rgba
+
+log = logging.getLogger(__name__)
+
+
+def color_limits(cmat, color_anchor=None):
+    """
+    Return the data range mapped to the colormap of a matrix image,
+    as draw_square_matrix_channels does.
+
+    @param cmat: ndarray
+
+    @param color_anchor: None, 0 or (a, b)
+    If None, the min and max of cmat.
+    If 0, from -max(abs(cmat)) to max(abs(cmat)).
+    If (a, b), from a to b.
+
+    @return: (vmin, vmax)
+    """
+    if color_anchor is not None and not np.isscalar(color_anchor):
+        return color_anchor[0], color_anchor[1]
+
+    min_val = np.nanmin(cmat)
+    max_val = np.nanmax(cmat)
+
+    if color_anchor is None:
+        return min_val, max_val
+
+    bound = max(abs(max_val), abs(min_val))
+    return -bound, bound
+
+
+def dense_matrix(cmat):
+    """
+    Return cmat as an ndarray, converting it if it is a scipy.sparse matrix.
+    """
+    if sp.issparse(cmat):
+        return cmat.toarray()
+    return np.asarray(cmat)
+
+
+def matrix_edges(cmat, lower_triangle_only=False):
+    """
+    Return the positive cells of a connectivity matrix as an edge list.
+    The edges of scipy.sparse matrices are read from their stored entries,
+    without making a dense copy.
+
+    @param cmat: ndarray or scipy.sparse matrix
+    @param lower_triangle_only: bool
+    If True, only the edges below the diagonal are returned.
+
+    @return: rows, cols, weights
+    Three 1D ndarrays.
+    """
+    if sp.issparse(cmat):
+        coo = cmat.tocoo()
+        rows, cols, weights = coo.row, coo.col, coo.data
+        keep = weights > 0
+        if lower_triangle_only:
+            keep &= cols < rows
+        return rows[keep], cols[keep], weights[keep]
+
+    cmat = np.asarray(cmat)
+    positive = cmat > 0
+    if lower_triangle_only:
+        positive &= np.tri(*cmat.shape, k=-1, dtype=bool)
+    rows, cols = np.nonzero(positive)
+    return rows, cols, cmat[rows, cols]
+
+
+def select_edges(rows, cols, weights, top_k=None, percentile=None, density=None,
+                 n_nodes=None):
+    """
+    Keep only the strongest edges of an edge list.
+    The edges are selected with partial sorts, numpy.argpartition and
+    numpy.percentile, so it costs O(K) for K edges.
+
+    @param rows: ndarray
+    @param cols: ndarray
+    @param weights: ndarray
+    Edge list, see matrix_edges.
+
+    @param top_k: int, optional
+    Keep the top_k edges with the largest weights.
+
+    @param percentile: float, optional
+    Keep the edges with weights at or above this percentile of the weights,
+    in [0, 100].
+
+    @param density: float, optional
+    Keep the largest edges up to this fraction of the
+    n_nodes * (n_nodes - 1) possible edges between different nodes.
+
+    @param n_nodes: int
+    Only needed for density.
+
+    @return: rows, cols, weights
+    The selected edges, in their original order.
+    """
+    weights = np.asarray(weights)
+
+    keep = np.ones(len(weights), dtype=bool)
+    if percentile is not None and len(weights):
+        keep &= weights >= np.percentile(weights, percentile)
+
+    k = None
+    if top_k is not None:
+        k = int(top_k)
+    if density is not None:
+        if n_nodes is None:
+            raise ValueError('n_nodes is needed to select the edges by density.')
+        density_k = int(round(density * n_nodes * (n_nodes - 1)))
+        k = density_k if k is None else min(k, density_k)
+
+    if k is not None and k < keep.sum():
+        candidates = np.flatnonzero(keep)
+        keep[:] = False
+        if k > 0:
+            largest = np.argpartition(-weights[candidates], k - 1)[:k]
+            keep[candidates[largest]] = True
+
+    return np.asarray(rows)[keep], np.asarray(cols)[keep], weights[keep]
+
+
+def node_indices(node_values, values):
+    """
+    Return the positions of values in node_values with one binary search
+    over the sorted node values.
+
+    @param node_values: ndarray
+    The value of each node, e.g., the ROI values of an atlas.
+
+    @param values: ndarray
+    Values of node_values, of any shape.
+
+    @return: ndarray
+    int array with the shape of values.
+
+    @raise: ValueError
+    If any of the values is not in node_values.
+    """
+    node_values = np.asarray(node_values)
+    values = np.asarray(values)
+
+    order = np.argsort(node_values, kind='mergesort')
+    sorted_values = node_values[order]
+
+    pos = np.searchsorted(sorted_values, values)
+    pos = np.clip(pos, 0, len(sorted_values) - 1)
+    found = sorted_values[pos] == values
+    if not found.all():
+        raise ValueError('Unknown node values: {}.'.format(np.unique(values[~found])))
+
+    return order[pos]
+
+
+def load_edge_list(filepath, n_nodes=None, symmetric=False, delimiter=None):
+    """
+    Read a sparse connectivity matrix from a file.
+
+    @param filepath: string
+    A .npz file saved with scipy.sparse.save_npz, or a text file with one
+    edge per line: the 0-based indices of the two nodes and, optionally,
+    the weight of the edge, which is 1 otherwise.
+
+    @param n_nodes: int, optional
+    Number of nodes. By default one more than the largest index in the file.
+
+    @param symmetric: bool
+    If True, each edge of a text file is also added in the other direction.
+
+    @param delimiter: string, optional
+    See numpy.loadtxt.
+
+    @return: scipy.sparse.coo_matrix
+    """
+    if filepath.endswith('.npz'):
+        return sp.load_npz(filepath).tocoo()
+
+    edges = np.loadtxt(filepath, delimiter=delimiter, ndmin=2)
+    rows = edges[:, 0].astype(np.intp)
+    cols = edges[:, 1].astype(np.intp)
+    weights = edges[:, 2] if edges.shape[1] > 2 else np.ones(len(edges))
+
+    if symmetric:
+        rows, cols = np.concatenate([rows, cols]), np.concatenate([cols, rows])
+        weights = np.concatenate([weights, weights])
+
+    if n_nodes is None:
+        n_nodes = int(max(rows.max(), cols.max())) + 1 if len(rows) else 0
+
+    return sp.coo_matrix((weights, (rows, cols)), shape=(n_nodes, n_nodes))
+
+
+def lower_triangle(cmat):
+    """
+    Return a float copy of cmat with NaN on and above the diagonal and without
+    its first row and last column, which would be empty, the way nitime's
+    drawmatrix_channels shows it.
+
+    @param cmat: ndarray
+    Square matrix.
+
+    @return: ndarray
+    """
+    m = np.array(dense_matrix(cmat), dtype=np.float64)
+    m[np.triu_indices(m.shape[0])] = np.nan
+    return m[1:, :-1]
+
+
+# ufuncs which combine the statistics kept for each block: sums and counts
+# of the cells which are not NaN for 'mean', the largest value for 'max',
+# the largest and smallest values for 'absmax'. fmax and fmin ignore NaNs.
+_STAT_UFUNCS = {'mean': (np.add, np.add),
+                'max': (np.fmax,),
+                'absmax': (np.fmax, np.fmin)}
+
+
+def _check_method(method):
+    if method not in _STAT_UFUNCS:
+        raise ValueError('Unknown reduction method {}, expected one of {}.'.format(
+                         method, sorted(_STAT_UFUNCS)))
+
+
+def _empty_stats(shape, method):
+    """Return the statistics of blocks without any cell."""
+    if method == 'mean':
+        return [np.zeros(shape), np.zeros(shape)]
+    return [np.full(shape, np.nan) for _ in _STAT_UFUNCS[method]]
+
+
+def _cell_stats(values, method):
+    """Return the statistics of values, each cell being its own block."""
+    if method == 'mean':
+        valid = ~np.isnan(values)
+        return [np.where(valid, values, 0), valid.astype(np.float64)]
+    return [values for _ in _STAT_UFUNCS[method]]
+
+
+def _pool_stats(stats, row_starts, col_starts, method):
+    """
+    Combine the statistics of the blocks between consecutive row_starts and
+    col_starts, the last ones up to the end of the arrays.
+    """
+    return [ufunc.reduceat(ufunc.reduceat(values, col_starts, axis=1),
+                           row_starts, axis=0)
+            for ufunc, values in zip(_STAT_UFUNCS[method], stats)]
+
+
+def _stats_values(stats, method):
+    """Return the pooled value of each block from its statistics."""
+    if method == 'mean':
+        sums, counts = stats
+        with np.errstate(invalid='ignore', divide='ignore'):
+            # blocks with only NaN cells stay NaN
+            return sums / counts
+
+    if method == 'max':
+        return stats[0]
+
+    # the value of largest magnitude with its sign, the negative one on ties
+    maxs, mins = stats
+    return np.where(-mins >= maxs, mins, maxs)
+
+
+def _read_region(cmat, rows, cols, lower_triangle_only=False):
+    """
+    Return a float64 copy of cmat[rows, cols], with NaN on and above the
+    diagonal if lower_triangle_only.
+    """
+    block = np.array(dense_matrix(cmat[rows, cols]), dtype=np.float64)
+    if lower_triangle_only:
+        row_idx = np.arange(rows.start, rows.stop)[:, np.newaxis]
+        col_idx = np.arange(cols.start, cols.stop)[np.newaxis, :]
+        block[col_idx >= row_idx] = np.nan
+    return block
+
+
+def _region_stats(cmat, rows, cols, factor, method='mean',
+                  lower_triangle_only=False, max_band_size=1 << 22):
+    """
+    Return the statistics of the factor x factor blocks of cmat[rows, cols],
+    see reduce_region.
+    """
+    _check_method(method)
+
+    factor = int(factor)
+    n_rows = rows.stop - rows.start
+    n_cols = cols.stop - cols.start
+    stats = _empty_stats((-(-n_rows // factor), -(-n_cols // factor)), method)
+    col_starts = np.arange(0, n_cols, factor)
+
+    # bands are whole blocks of rows when they fit, so each block row is
+    # usually pooled from a single band
+    band_rows = max(1, max_band_size // max(n_cols, 1))
+    if band_rows >= factor:
+        band_rows -= band_rows % factor
+
+    for start in range(rows.start, rows.stop, band_rows):
+        stop = min(start + band_rows, rows.stop)
+        band = _read_region(cmat, slice(start, stop), cols, lower_triangle_only)
+
+        offsets = np.arange(start, stop) - rows.start
+        row_starts = np.flatnonzero(offsets % factor == 0)
+        if not len(row_starts) or row_starts[0] != 0:
+            row_starts = np.concatenate([[0], row_starts])
+
+        first = offsets[0] // factor
+        block_rows = slice(first, first + len(row_starts))
+        pooled = _pool_stats(_cell_stats(band, method), row_starts, col_starts, method)
+        for ufunc, acc, values in zip(_STAT_UFUNCS[method], stats, pooled):
+            acc[block_rows] = ufunc(acc[block_rows], values)
+
+    return stats
+
+
+def reduce_region(cmat, rows, cols, factor, method='mean',
+                  lower_triangle_only=False, max_band_size=1 << 22):
+    """
+    Pool the cells of cmat[rows, cols] in blocks of factor x factor.
+
+    The region is read by bands of about max_band_size cells, fewer rows
+    than a block if needed, and the sums, counts or extremes of each block
+    are accumulated from them. So cmat can be a numpy.memmap larger than the
+    available memory, whatever the factor. NaN cells are ignored, and the
+    blocks cut by the end of the region only pool the cells inside of it.
+
+    @param cmat: 2D ndarray or scipy.sparse matrix
+    Sparse matrices must support slicing, e.g., CSR.
+
+    @param rows: slice
+    @param cols: slice
+    With start and stop set.
+
+    @param factor: int
+    @param method: string
+    'mean', 'max' or 'absmax', the value of largest magnitude with its sign.
+
+    @param lower_triangle_only: bool
+    If True, the cells on and above the diagonal are left out.
+
+    @param max_band_size: int
+    Approximate number of cells read at once.
+
+    @return: ndarray
+    float64 array of shape (ceil(n_rows / factor), ceil(n_cols / factor)).
+    """
+    stats = _region_stats(cmat, rows, cols, factor, method, lower_triangle_only,
+                          max_band_size)
+    return _stats_values(stats, method)
+
+
+def block_reduce_matrix(cmat, factor, method='mean', lower_triangle_only=False,
+                        rows=None, cols=None):
+    """
+    Pool a matrix in blocks of factor x factor cells, see reduce_region.
+    scipy.sparse matrices are pooled from their stored entries, the cells
+    that are not stored count as zeros.
+
+    @param cmat: 2D ndarray or scipy.sparse matrix
+    @param factor: int
+    @param method: string
+    @param lower_triangle_only: bool
+
+    @param rows: slice, optional
+    @param cols: slice, optional
+    Region of cmat to pool, with start and stop set. By default all of it.
+    The diagonal of lower_triangle_only is the one of cmat.
+
+    @return: ndarray
+    """
+    rows = rows if rows is not None else slice(0, cmat.shape[0])
+    cols = cols if cols is not None else slice(0, cmat.shape[1])
+
+    if sp.issparse(cmat):
+        return _reduce_sparse(cmat, factor, method, lower_triangle_only,
+                              rows, cols)
+
+    return reduce_region(cmat, rows, cols, factor, method, lower_triangle_only)
+
+
+def _reduce_sparse(cmat, factor, method='mean', lower_triangle_only=False,
+                   region_rows=None, region_cols=None):
+    """
+    block_reduce_matrix for scipy.sparse matrices.
+    """
+    _check_method(method)
+
+    factor = int(factor)
+    if region_rows is None:
+        region_rows = slice(0, cmat.shape[0])
+    if region_cols is None:
+        region_cols = slice(0, cmat.shape[1])
+    row0, col0 = region_rows.start, region_cols.start
+    n_rows = region_rows.stop - row0
+    n_cols = region_cols.stop - col0
+
+    # only the stored entries of the region are read
+    coo = cmat.tocsr()[region_rows, region_cols].tocoo(copy=True)
+    coo.sum_duplicates()
+    rows, cols, data = coo.row, coo.col, coo.data.astype(np.float64)
+
+    if lower_triangle_only:
+        keep = cols + col0 < rows + row0
+        rows, cols, data = rows[keep], cols[keep], data[keep]
+
+    shape = (-(-n_rows // factor), -(-n_cols // factor))
+    blocks = (rows // factor) * shape[1] + cols // factor
+    n_blocks = shape[0] * shape[1]
+
+    # stored NaNs are left out, like the nan-aware reductions of dense blocks
+    is_nan = np.isnan(data)
+    n_nans = np.bincount(blocks[is_nan], minlength=n_blocks)
+    blocks, data = blocks[~is_nan], data[~is_nan]
+
+    # number of cells of each block inside of the matrix, or under the
+    # diagonal, which are the ones that count as zeros when not stored
+    row_edges = np.minimum(np.arange(shape[0] + 1) * factor, n_rows)
+    col_edges = np.minimum(np.arange(shape[1] + 1) * factor, n_cols)
+    if lower_triangle_only:
+        # cells with c < r among the first r_end rows and c_end columns
+        # of cmat, differences of it give the count of each block
+        r_end = (row0 + row_edges[:, np.newaxis]).astype(np.float64)
+        c_end = (col0 + col_edges[np.newaxis, :]).astype(np.float64)
+        diag = np.minimum(r_end, c_end)
+        below = diag * (diag - 1) / 2 + (r_end - diag) * c_end
+        area = below[1:, 1:] - below[:-1, 1:] - below[1:, :-1] + below[:-1, :-1]
+    else:
+        area = np.outer(np.diff(row_edges), np.diff(col_edges)).astype(np.float64)
+
+    # cells which are not NaN
+    area = area.ravel() - n_nans
+    counts = np.bincount(blocks, minlength=n_blocks)
+    has_zeros = counts < area
+
+    if method == 'mean':
+        sums = np.bincount(blocks, weights=data, minlength=n_blocks)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out = sums / area
+    else:
+        values = data if method == 'max' else np.abs(data)
+        out = np.full(n_blocks, -np.inf)
+        np.maximum.at(out, blocks, values)
+        out[has_zeros] = np.maximum(out[has_zeros], 0)
+
+        if method == 'absmax':
+            # recover the sign of the largest magnitude of each block
+            sign = np.ones(n_blocks)
+            largest = values == out[blocks]
+            sign[blocks[largest & (data < 0)]] = -1
+            out *= sign
+
+    out[area == 0] = np.nan
+    return out.reshape(shape)
+
+
+def reduction_factor(size, max_size):
+    """
+    Return the smallest integer factor that reduces size to max_size or less.
+    """
+    return max(1, -(-int(size) // int(max_size)))
+
+
+def matrix_to_rgba(cmat, lower_triangle_only=True, cmap='RdBu_r', color_anchor=0,
+                   zoom=None, colorbar=True, max_size=None,
+                   reduce_method='mean'):
+    """
+    Compose the image of a connectivity matrix into one RGBA array.
+
+    Each cell of the matrix is drawn as a zoom x zoom block of pixels and NaN
+    cells are transparent. The colorbar is a horizontal strip under the
+    matrix without tick labels.
+
+    @param cmat: ndarray or scipy.sparse matrix
+    Square matrix.
+
+    @param lower_triangle_only: bool
+    If True, will only show the cells below the diagonal.
+
+    @param cmap: matplotlib colormap, string or ndarray
+    See cajal.utils.image.colormap_lut.
+
+    @param color_anchor: None, 0 or (a, b)
+    See color_limits.
+
+    @param zoom: int, optional
+    Number of pixels per cell side. By default, enough to make the matrix
+    about 512 pixels wide.
+
+    @param colorbar: bool
+
+    @param max_size: int, optional
+    If the matrix has more rows or columns than this, its cells are pooled
+    in blocks with reduce_method to fit in max_size x max_size cells,
+    see block_reduce_matrix.
+
+    @param reduce_method: string
+    'mean', 'max' or 'absmax'.
+
+    @return: ndarray
+    uint8 array of shape (height, width, 4)
+    """
+    factor = 1
+    if max_size is not None:
+        factor = reduction_factor(max(cmat.shape), max_size)
+
+    if factor > 1 and lower_triangle_only:
+        # without the empty first row and last column, like lower_triangle
+        n = cmat.shape[0]
+        m = block_reduce_matrix(cmat, factor, reduce_method, lower_triangle_only,
+                                rows=slice(1, n), cols=slice(0, n - 1))
+    elif factor > 1:
+        m = block_reduce_matrix(cmat, factor, reduce_method)
+    elif lower_triangle_only:
+        m = lower_triangle(cmat)
+    else:
+        m = dense_matrix(cmat)
+
+    if zoom is None:
+        zoom = max(1, 512 // max(m.shape))
+
+    lut = colormap_lut(cmap)
+    vmin, vmax = color_limits(m, color_anchor)
+
+    img = scalar_to_rgba(m, lut, vmin=vmin, vmax=vmax)
+    if zoom > 1:
+        img = img.repeat(zoom, axis=0).repeat(zoom, axis=1)
+
+    if colorbar:
+        img = _add_horizontal_colorbar(img, lut)
+
+    return img
+
+
+def _add_horizontal_colorbar(img, lut):
+    """
+    Append a horizontal colorbar strip under img, with the size ratios of the
+    draw_square_matrix_channels colorbar.
+    """
+    height, width = img.shape[:2]
+    pad_height = max(1, int(round(0.02 * height)))
+    bar_height = max(1, int(round(0.10 * height)))
+
+    idx = np.linspace(0, len(lut) - 1, width).round().astype(np.intp)
+    bar = np.repeat(lut[idx][np.newaxis, :, :], bar_height, axis=0)
+    pad = np.zeros((pad_height, width, 4), dtype=np.uint8)
+
+    return np.vstack([img, pad, bar])
+
+
+def write_deep_zoom(output_dir, name, cmat, lower_triangle_only=True,
+                    cmap='RdBu_r', color_anchor=0, reduce_method='mean',
+                    tile_size=256, max_cells=1 << 22):
+    """
+    Write a Deep Zoom (DZI) tile pyramid of a matrix image, one pixel per cell
+    at the full resolution level, to browse large matrices with viewers such
+    as OpenSeadragon.
+
+    Each level halves the previous one pooling the cells with reduce_method.
+    The levels larger than max_cells, and all the levels of scipy.sparse
+    matrices, are pooled tile by tile from the matrix region under each
+    tile, see block_reduce_matrix. Dense regions are read by bands and
+    sparse ones only read their stored entries. The first level with at
+    most max_cells cells is pooled from the matrix once, and each coarser
+    level by pooling 2 x 2 blocks of the one below, keeping the sums and
+    counts of the cells so the means are exact. So the matrix is never in
+    memory as a whole.
+
+    @param output_dir: string
+    @param name: string
+    Writes output_dir/name.dzi and the tiles in output_dir/name_files/.
+
+    @param cmat: 2D ndarray or scipy.sparse matrix
+    Can be a numpy.memmap.
+
+    @param lower_triangle_only: bool
+    @param cmap: matplotlib colormap, string or ndarray
+    @param color_anchor: None, 0 or (a, b)
+    @param reduce_method: string
+    See matrix_to_rgba.
+
+    @param tile_size: int
+
+    @param max_cells: int
+    Number of cells of the largest level kept in memory.
+
+    @return: string
+    The path of the .dzi file.
+    """
+    import skimage.io as skio
+
+    if sp.issparse(cmat):
+        cmat = cmat.tocsr()
+
+    height, width = cmat.shape
+    lut = colormap_lut(cmap)
+    vmin, vmax = _matrix_color_limits(cmat, color_anchor, lower_triangle_only)
+
+    max_level = int(np.ceil(np.log2(max(height, width, 1))))
+    tiles_dir = os.path.join(output_dir, name + '_files')
+
+    stats = None
+    # from the full resolution level to the coarsest one
+    for level in range(max_level, -1, -1):
+        factor = 2 ** (max_level - level)
+        level_dir = os.path.join(tiles_dir, str(level))
+        os.makedirs(level_dir, exist_ok=True)
+
+        if stats is not None:
+            stats = _pool_stats(stats, np.arange(0, stats[0].shape[0], 2),
+                                np.arange(0, stats[0].shape[1], 2), reduce_method)
+        elif (not sp.issparse(cmat) and
+              -(-height // factor) * -(-width // factor) <= max_cells):
+            stats = _region_stats(cmat, slice(0, height), slice(0, width), factor,
+                                  reduce_method, lower_triangle_only)
+        level_values = None if stats is None else _stats_values(stats, reduce_method)
+
+        span = tile_size * factor
+        for row, top in enumerate(range(0, height, span)):
+            for col, left in enumerate(range(0, width, span)):
+                if level_values is not None:
+                    values = level_values[row * tile_size:(row + 1) * tile_size,
+                                          col * tile_size:(col + 1) * tile_size]
+                else:
+                    rows = slice(top, min(top + span, height))
+                    cols = slice(left, min(left + span, width))
+                    values = block_reduce_matrix(cmat, factor, reduce_method,
+                                                 lower_triangle_only,
+                                                 rows=rows, cols=cols)
+                tile = scalar_to_rgba(values, lut, vmin=vmin, vmax=vmax)
+                tile_name = '{}_{}.png'.format(col, row)
+                skio.imsave(os.path.join(level_dir, tile_name), tile)
+
+    dzi_path = os.path.join(output_dir, name + '.dzi')
+    with open(dzi_path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+                'Format="png" Overlap="0" TileSize="{}">\n'
+                '  <Size Width="{}" Height="{}"/>\n'
+                '</Image>\n'.format(tile_size, width, height))
+
+    return dzi_path
+
+
+def _matrix_color_limits(cmat, color_anchor=None, lower_triangle_only=False):
+    """
+    Same as color_limits, reading cmat by bands.
+    """
+    if color_anchor is not None and not np.isscalar(color_anchor):
+        return color_anchor[0], color_anchor[1]
+
+    if sp.issparse(cmat):
+        coo = cmat.tocoo(copy=True)
+        coo.sum_duplicates()
+        keep = ~np.isnan(coo.data)
+        n_cells = coo.shape[0] * coo.shape[1]
+        if lower_triangle_only:
+            keep &= coo.col < coo.row
+            n_cells = coo.shape[0] * (coo.shape[0] - 1) // 2
+
+        data = coo.data[keep]
+        values = [data.min(), data.max()] if data.size else []
+        if data.size < n_cells:
+            # the cells that are not stored are zeros
+            values.append(0)
+        if not values:
+            return 0, 0
+        return color_limits(np.array(values), color_anchor)
+
+    mins, maxs = [], []
+    n_rows = cmat.shape[0]
+    band = max(1, (1 << 22) // max(cmat.shape[1], 1))
+    for start in range(0, n_rows, band):
+        block = _read_region(cmat, slice(start, min(start + band, n_rows)),
+                             slice(0, cmat.shape[1]), lower_triangle_only)
+        if np.isnan(block).all():
+            continue
+        mins.append(np.nanmin(block))
+        maxs.append(np.nanmax(block))
+
+    if not mins:
+        return 0, 0
+
+    return color_limits(np.array([min(mins), max(maxs)]), color_anchor)
+
+
+def memmap_reference(stack, idx):
+    """
+    Return a picklable reference to the matrix stack[idx] of a memory mapped
+    stack, so worker processes can map it themselves instead of receiving a
+    copy of the data.
+
+    @param stack: numpy.memmap
+    Array of shape (n_matrices, n, n).
+
+    @param idx: int
+
+    @return: tuple or None
+    (filename, dtype, shape, offset), or None if stack[idx] is not a C
+    contiguous part of a file.
+    """
+    item = stack[idx]
+    root = stack
+    while isinstance(root.base, np.ndarray):
+        root = root.base
+
+    filename = getattr(root, 'filename', None)
+    if filename is None or not item.flags.c_contiguous:
+        return None
+
+    address = item.__array_interface__['data'][0]
+    root_address = root.__array_interface__['data'][0]
+    offset = root.offset + address - root_address
+    return filename, item.dtype.str, item.shape, offset
+
+
+def load_matrix(source):
+    """
+    Return the matrix of a source given by slicesdir_connectivity_matrices:
+    either the matrix itself or a memmap_reference to it.
+
+    @param source: ndarray or tuple
+
+    @return: ndarray
+    """
+    if isinstance(source, tuple):
+        filename, dtype, shape, offset = source
+        return np.memmap(filename, dtype=dtype, mode='r', shape=shape, offset=offset)
+    return source
@@ -0,0 +1,221 @@
+# coding=utf-8
+#-------------------------------------------------------------------------------
+# License: BSD 3 clause
+#-------------------------------------------------------------------------------
+"""
+Iso-surface meshes of volumes, extracted once with marching cubes and kept
+on disk, to show brain surfaces in mayavi without rebuilding a VTK contour
+filter over the whole volume every time.
+"""
+import  os
+import  os.path     as op
+import  hashlib
+import  logging
+import  tempfile
+
+import  numpy       as np
+
+from    .config     import CACHE_DIR
+
+log = logging.getLogger(__name__)
+
+
+def volume_digest(vol, blocksize=1 << 24):
+    """Return a hash of the shape, data type and values of vol.
+
+    Parameters
+    ----------
+    vol: numpy.ndarray
+
+    blocksize: int
+        Number of bytes hashed at once.
+
+    Returns
+    -------
+    str
+    """
+    vol = np.ascontiguousarray(vol)
+    sha = hashlib.sha1('{}|{}|'.format(vol.shape, vol.dtype.str).encode('utf-8'))
+    data = memoryview(vol.reshape(-1)).cast('B')
+    for start in range(0, len(data), blocksize):
+        sha.update(data[start:start + blocksize])
+    return sha.hexdigest()
+
+
+def iso_level(vol, level_fraction=0.1):
+    """Return the value at level_fraction of the way from the minimum
+    to the maximum of vol."""
+    vmin = np.nanmin(vol)
+    return float(vmin + level_fraction * (np.nanmax(vol) - vmin))
+
+
+class MeshCache(object):
+    """Folder with the vertices and faces of iso-surface meshes, one .npz
+    file per mesh.
+
+    Parameters
+    ----------
+    cache_dir: str, optional
+        Folder of the cache. By default cajal.config.CACHE_DIR/meshes,
+        which can be set with the CAJAL_CACHE_DIR environment variable.
+    """
+
+    def __init__(self, cache_dir=None):
+        if cache_dir is None:
+            cache_dir = op.join(CACHE_DIR, 'meshes')
+
+        self.cache_dir = cache_dir
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, digest, level, step_size):
+        """Return the cache key of the mesh of the volume with hash digest."""
+        text = '{}|{!r}|{}'.format(digest, float(level), int(step_size))
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return op.join(self.cache_dir, key + '.npz')
+
+    def load(self, key):
+        """Return the (vertices, faces) stored with key, or None."""
+        path = self.path(key)
+        if not op.exists(path):
+            return None
+
+        try:
+            with np.load(path) as data:
+                return data['vertices'], data['faces']
+        except (IOError, ValueError, KeyError):
+            log.warning('Ignoring the damaged mesh file {}.'.format(path))
+            return None
+
+    def save(self, key, vertices, faces):
+        """Store vertices and faces with key."""
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, vertices=vertices, faces=faces)
+            os.rename(tmp_path, self.path(key))
+        except:
+            os.remove(tmp_path)
+            raise
+
+    def clear(self):
+        """Remove all the meshes in the cache."""
+        for name in os.listdir(self.cache_dir):
+            path = op.join(self.cache_dir, name)
+            if op.isfile(path):
+                os.remove(path)
+
+
+def _marching_cubes(vol, level, step_size):
+    try:
+        from skimage.measure import marching_cubes
+    except ImportError:
+        # scikit-image < 0.19
+        from skimage.measure import marching_cubes_lewiner as marching_cubes
+
+    vertices, faces = marching_cubes(vol, level=level, step_size=step_size)[:2]
+    return vertices.astype(np.float32), faces.astype(np.int32)
+
+
+def iso_surface_mesh(vol, level=None, level_fraction=0.1, lod=0, cache=True,
+                     digest=None):
+    """Return the triangular mesh of the iso-surface of vol at level.
+
+    Parameters
+    ----------
+    vol: numpy.ndarray
+        3D volume.
+
+    level: float, optional
+        Value of the iso-surface. By default the one at level_fraction,
+        see iso_level.
+
+    level_fraction: float
+
+    lod: int
+        Level of detail. Level 0 runs marching cubes over every voxel and
+        each level above doubles the step between the voxels it uses, which
+        makes about 4 times fewer faces.
+
+    cache: MeshCache, bool or None
+        If True, the default MeshCache, if a MeshCache, that one.
+        Otherwise the mesh is not cached.
+
+    digest: str, optional
+        volume_digest(vol), to avoid hashing the volume again when
+        extracting several meshes of it.
+
+    Returns
+    -------
+    vertices: numpy.ndarray
+        float32 array of shape (n_vertices, 3), in voxel coordinates.
+
+    faces: numpy.ndarray
+        int32 array of shape (n_faces, 3), indices of vertices.
+    """
+    if level is None:
+        level = iso_level(vol, level_fraction)
+
+    step_size = 2 ** int(lod)
+
+    if cache is True:
+        cache = MeshCache()
+
+    key = None
+    if cache:
+        if digest is None:
+            digest = volume_digest(vol)
+        key = cache.key(digest, level, step_size)
+        mesh = cache.load(key)
+        if mesh is not None:
+            return mesh
+
+    log.debug('Extracting the iso-surface at {} with step {}.'.format(level, step_size))
+    vertices, faces = _marching_cubes(vol, level, step_size)
+
+    if cache:
+        cache.save(key, vertices, faces)
+
+    return vertices, faces
+
+
+def show_mesh(vertices, faces, color=(0.8, 0.8, 0.8), opacity=1., **kwargs):
+    """Show a triangular mesh with mayavi.
+
+    Parameters
+    ----------
+    vertices: numpy.ndarray
+    faces: numpy.ndarray
+        See iso_surface_mesh.
+
+    color: tuple of 3 floats
+    opacity: float
+
+    kwargs: other arguments to mayavi.mlab.triangular_mesh
+
+    Returns
+    -------
+    mayavi surface module
+    """
+    from mayavi import mlab
+
+    x, y, z = vertices.T
+    return mlab.triangular_mesh(x, y, z, faces, color=color, opacity=opacity,
+                                **kwargs)
+
+
+def show_iso_surface(vol, level=None, level_fraction=0.1, lod=0, cache=True,
+                     **kwargs):
+    """Show the iso-surface of vol as a triangular mesh with mayavi,
+    see iso_surface_mesh and show_mesh.
+
+    Returns
+    -------
+    mayavi surface module
+    """
+    vertices, faces = iso_surface_mesh(vol, level=level,
+                                       level_fraction=level_fraction,
+                                       lod=lod, cache=cache)
+    return show_mesh(vertices, faces, **kwargs)
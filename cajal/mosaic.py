@@ -0,0 +1,266 @@
+# coding=utf-8
+#-------------------------------------------------------------------------------
+# License: BSD 3 clause
+#-------------------------------------------------------------------------------
+"""
+Slice mosaics composed directly with numpy, without matplotlib figures.
+"""
+import  logging
+
+import  numpy       as np
+
+from    .utils.math     import makespread
+from    .utils.image    import colormap_lut, scalar_to_rgba, alpha_composite
+from    .roi            import get_rois_outline
+
+log = logging.getLogger(__name__)
+
+LABEL_COLOR = (0, 85, 255, 255) # '#0055ff'
+
+# 3x5 bitmaps of the digits used for the slice labels
+_DIGITS = {
+    '0': ['111', '101', '101', '101', '111'],
+    '1': ['010', '110', '010', '010', '111'],
+    '2': ['111', '001', '111', '100', '111'],
+    '3': ['111', '001', '011', '001', '111'],
+    '4': ['101', '101', '111', '001', '001'],
+    '5': ['111', '100', '111', '001', '111'],
+    '6': ['111', '100', '111', '101', '111'],
+    '7': ['111', '001', '010', '010', '010'],
+    '8': ['111', '101', '111', '101', '111'],
+    '9': ['111', '101', '111', '001', '111'],
+}
+_DIGITS = dict((k, np.array([[c == '1' for c in row] for row in v]))
+               for k, v in _DIGITS.items())
+
+
+def get_mosaic_slices(size, n_slices=[8, 8], slices_idx=None):
+    """
+    Return the indices of the slices shown in a mosaic.
+
+    @param size: int
+    Number of slices of the volume in the mosaic axis.
+
+    @param n_slices: list of int
+    Number of slices in each row of the mosaic.
+
+    @param slices_idx: list of int, optional
+    If given, these are the slices shown.
+
+    @return: list of int
+    """
+    if slices_idx:
+        return list(slices_idx)
+
+    return list(makespread(list(range(size)), np.sum(n_slices))[:-2])
+
+
+def text_mask(text, scale=1):
+    """
+    Rasterize a string of digits with a small bitmap font.
+
+    @param text: string
+    @param scale: int
+    Size in pixels of each dot of the font.
+
+    @return: boolean ndarray
+    """
+    glyphs = []
+    for c in text:
+        glyphs.append(_DIGITS[c])
+        glyphs.append(np.zeros((5, 1), dtype=bool))
+
+    mask = np.hstack(glyphs[:-1])
+    return mask.repeat(scale, axis=0).repeat(scale, axis=1)
+
+
+def draw_text(img, text, x, y, color=LABEL_COLOR, scale=1):
+    """
+    Draw text on an RGBA image, horizontally centered on x and with its
+    top at y. The parts outside of img are clipped.
+
+    @param img: ndarray
+    uint8 array of shape (height, width, 4), modified in place.
+
+    @param text: string
+    @param x: int
+    @param y: int
+    @param color: tuple of 4 ints
+    @param scale: int
+
+    @return: ndarray
+    img
+    """
+    mask = text_mask(text, scale)
+    top  = int(y)
+    left = int(x) - mask.shape[1] // 2
+
+    rows = slice(max(top, 0), min(top + mask.shape[0], img.shape[0]))
+    cols = slice(max(left, 0), min(left + mask.shape[1], img.shape[1]))
+    mask = mask[rows.start - top:rows.stop - top, cols.start - left:cols.stop - left]
+
+    img[rows, cols][mask] = color
+    return img
+
+
+def render_many_slices(vol, vol2=None, volaxis=1, n_slices=[8, 8], slices_idx=None,
+                       vol1_colormap=None, vol1_transp_val=None,
+                       vol2_colormap=None, vol2_transp_val=0,
+                       is_red_outline=False, show_colorbar=True,
+                       show_labels=True, zoom=1, vol1_clim=None, vol2_clim=None,
+                       **kwargs):
+    """
+    Compose the same mosaic as cajal.render.show_many_slices into one
+    RGBA image, without creating any matplotlib figure.
+
+    The slices are shown at their size in voxels, times zoom.
+
+    @param vol: numpy 3D array
+    @param vol2: numpy 3D array
+    @param volaxis: int
+    @param n_slices: list of int
+    @param slices_idx: list of int
+    @param vol1_colormap: matplotlib colormap
+    @param vol1_transp_val: vol1.dtype scalar
+    Volume1 transparent value
+
+    @param vol2_colormap: matplotlib colormap
+    @param vol2_transp_val: vol2.dtype scalar
+    Volume2 transparent value
+
+    @param is_red_outline: boolean, optional
+    If True, will show the outlines of the ROIs in vol2, in red if there is
+    only one ROI, or with vol2_colormap over the ROI values if there are more.
+
+    @param show_colorbar: boolean, optional
+    If True, will add a colorbar strip for vol2 on the right side.
+
+    @param show_labels: boolean, optional
+    If True, will write the slice index on top of each slice.
+
+    @param zoom: int, optional
+    Number of pixels per voxel side.
+
+    @param vol1_clim: (vmin, vmax), optional
+    @param vol2_clim: (vmin, vmax), optional
+    Fixed color limits for all the slices of vol and vol2. By default
+    each slice of vol is scaled to its own range, and so are the slices
+    of vol2 unless there is a colorbar.
+
+    @param kwargs: other arguments to show_many_slices
+    Arguments that only make sense for matplotlib figures,
+    such as interpolation, figtitle or facecolor, are ignored.
+
+    @return: ndarray
+    uint8 array of shape (height, width, 4)
+    """
+    has_vol2 = isinstance(vol2, np.ndarray)
+    if has_vol2:
+        assert vol.shape == vol2.shape, 'vol do not have the same shape as vol2'
+
+    lut1 = colormap_lut(vol1_colormap if vol1_colormap is not None else 'gray')
+    lut2 = colormap_lut(vol2_colormap if vol2_colormap is not None else 'jet')
+
+    clim2 = None
+    if has_vol2 and is_red_outline:
+        vol2 = get_rois_outline(vol2, axis=volaxis, background=0)
+        vol2_transp_val = 0
+        show_colorbar = False
+
+        labels = np.unique(vol2[vol2 != 0])
+        if len(labels) <= 1:
+            lut2 = np.array([[255, 0, 0, 255]], dtype=np.uint8)
+        else:
+            clim2 = (labels.min(), labels.max())
+
+    slice_idx = get_mosaic_slices(vol.shape[volaxis], n_slices, slices_idx)
+
+    n_rows = len(n_slices)
+    n_cols = max(n_slices)
+
+    # slices are shown rotated by 90 degrees, as in show_many_slices
+    cell_shape = np.delete(vol.shape, volaxis)[::-1]
+    height, width = cell_shape
+    mosaic = np.zeros((n_rows * height, n_cols * width, 4), dtype=np.uint8)
+
+    overlays = []
+    for c, i in enumerate(slice_idx):
+        row, col = c % n_rows, c // n_rows
+        if col >= n_cols:
+            log.debug('Slice {} does not fit in the mosaic.'.format(i))
+            break
+
+        cell = mosaic[row*height:(row+1)*height, col*width:(col+1)*width]
+
+        img = np.rot90(vol.take(i, axis=volaxis))
+        mask = None
+        if vol1_transp_val is not None:
+            mask = img == vol1_transp_val
+        cell[:] = scalar_to_rgba(img, lut1, *(vol1_clim or (None, None)), mask=mask)
+
+        if has_vol2:
+            img2 = np.rot90(vol2.take(i, axis=volaxis))
+            overlays.append((cell, np.ma.masked_where(img2 == vol2_transp_val, img2)))
+
+    if clim2 is None and vol2_clim is not None:
+        clim2 = tuple(vol2_clim)
+
+    vmin, vmax = clim2 if clim2 is not None else (None, None)
+    if has_vol2 and show_colorbar and clim2 is None:
+        # the overlays share the color scale when there is a colorbar
+        valid = [img2.compressed() for _, img2 in overlays]
+        valid = np.concatenate(valid) if valid else np.array([])
+        if valid.size:
+            vmin, vmax = valid.min(), valid.max()
+
+    for cell, img2 in overlays:
+        alpha_composite(cell, scalar_to_rgba(img2, lut2, vmin=vmin, vmax=vmax))
+
+    if zoom > 1:
+        mosaic = mosaic.repeat(zoom, axis=0).repeat(zoom, axis=1)
+
+    if show_labels:
+        scale = max(1, (min(height, width) * zoom) // 48)
+        for c, i in enumerate(slice_idx[:n_rows * n_cols]):
+            row, col = c % n_rows, c // n_rows
+            draw_text(mosaic, str(i), x=(col*width + width/2.) * zoom,
+                      y=row*height*zoom + scale, scale=scale)
+
+    if has_vol2 and show_colorbar and vmin is not None:
+        mosaic = _add_colorbar(mosaic, lut2, cell_width=width * zoom)
+
+    return mosaic
+
+
+def _add_colorbar(img, lut, cell_width):
+    """
+    Append a vertical colorbar strip to the right side of img, with the
+    size ratios of the show_many_slices ImageGrid colorbar.
+    """
+    pad_width = max(1, int(round(0.05 * cell_width)))
+    bar_width = max(1, int(round(0.10 * cell_width)))
+    height = img.shape[0]
+
+    idx = np.linspace(len(lut) - 1, 0, height).round().astype(np.intp)
+    bar = np.repeat(lut[idx][:, np.newaxis, :], bar_width, axis=1)
+    pad = np.zeros((height, pad_width, 4), dtype=np.uint8)
+
+    return np.hstack([img, pad, bar])
+
+
+def save_many_slices(filepath, vol, vol2=None, **kwargs):
+    """
+    Render the mosaic of vol (and vol2) with render_many_slices and save
+    it as a PNG file.
+
+    @param filepath: string
+    @param vol: numpy 3D array
+    @param vol2: numpy 3D array
+    @param kwargs: arguments to render_many_slices
+
+    @return: string
+    filepath
+    """
+    import skimage.io as skio
+    skio.imsave(filepath, render_many_slices(vol, vol2, **kwargs))
+    return filepath
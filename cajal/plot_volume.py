@@ -2,12 +2,32 @@
 
 import os.path as op
 import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 from boyle.utils.filenames import get_extension
 
+from .volume_cache import uncompressed_path
+from .utils.image import colormap_lut
+
 log = logging.getLogger(__name__)
 
 
-def open_volume_file(filepath):
+MHD_TO_NUMPY_TYPE = {'MET_CHAR': np.int8,
+                     'MET_UCHAR': np.uint8,
+                     'MET_SHORT': np.int16,
+                     'MET_USHORT': np.uint16,
+                     'MET_INT': np.int32,
+                     'MET_UINT': np.uint32,
+                     'MET_LONG': np.int64,
+                     'MET_ULONG': np.uint64,
+                     'MET_FLOAT': np.float32,
+                     'MET_DOUBLE': np.float64}
+
+
+def open_volume_file(filepath, lazy=False, cache=None):
     """Open a volumetric file using the tools following the file extension.
 
     Parameters
@@ -15,13 +35,25 @@ def open_volume_file(filepath):
     filepath: str
         Path to a volume file
 
+    lazy: bool
+        If True, will not read the volume data. Instead, volume_data is a
+        read-only np.memmap for uncompressed .nii files and .mhd/.raw pairs,
+        or the nibabel array proxy of any other NIfTI file.
+        Both can be sliced, and only the voxels of the slice are read.
+
+    cache: cajal.volume_cache.DecompressionCache, bool or str, optional
+        If given, gzipped files are read from their uncompressed copy in this
+        cache, or in the default one if True. Together with lazy, repeated
+        slice reads of .nii.gz files do not decompress them again.
+
     Returns
     -------
-    volume_data: np.ndarray
+    volume_data: np.ndarray, np.memmap or nibabel.arrayproxy.ArrayProxy
         Volume data
 
     pixdim: 1xN np.ndarray
         Vector with the description of the voxels physical size (usually in mm) for each volume dimension.
+        For .mhd files, the ElementSpacing string of the header, lazy or not.
 
     Raises
     ------
@@ -41,37 +73,390 @@ def open_volume_file(filepath):
         pixdim = hdr_data['ElementSpacing']
         return vol_data, pixdim
 
+    def open_lazy_mhd_file(filepath):
+        hdr_data = read_mhd_header(filepath)
+        vol_data = mhd_memmap(filepath, hdr_data)
+        if vol_data is None:
+            log.debug('Can not memory-map {}, reading all of it.'.format(filepath))
+            return open_mhd_file(filepath)
+        # the header value, as boyle.mhd.load_raw_data_with_mhd returns it
+        pixdim = hdr_data['ElementSpacing']
+        return vol_data, pixdim
+
     if not op.exists(filepath):
         raise IOError('Could not find file {}.'.format(filepath))
 
     ext = get_extension(filepath)
+    filepath = uncompressed_path(filepath, cache)
     if 'nii' in ext:
         try:
-            return open_nifti_file(filepath)
+            return open_lazy_nifti_file(filepath) if lazy else open_nifti_file(filepath)
         except:
             log.exception('Could not read {}.'.format(filepath))
             raise
 
     if 'mhd' in ext:
         try:
-            return open_mhd_file(filepath)
+            return open_lazy_mhd_file(filepath) if lazy else open_mhd_file(filepath)
         except:
             log.exception('Could not read {}.'.format(filepath))
             raise
 
 
+def open_lazy_nifti_file(filepath):
+    """Open a NIfTI file without reading its data.
+
+    Parameters
+    ----------
+    filepath: str
+        Path to a NIfTI file
+
+    Returns
+    -------
+    volume_data: np.memmap or nibabel.arrayproxy.ArrayProxy
+        A read-only memory map of the data of uncompressed files without
+        intensity scaling, or the nibabel proxy of the data otherwise.
+
+    pixdim: np.ndarray
+        The voxel sizes.
+    """
+    import nibabel as nib
+
+    img = nib.load(filepath)
+    hdr = img.header
+    pixdim = np.array(hdr.get_zooms())
+
+    slope, inter = hdr.get_slope_inter()
+    is_scaled = slope not in (None, 1) or inter not in (None, 0)
+    if filepath.endswith('.nii') and not is_scaled:
+        vol_data = np.memmap(filepath, dtype=hdr.get_data_dtype(), mode='r',
+                             offset=int(hdr.get_data_offset()),
+                             shape=hdr.get_data_shape(), order='F')
+        return vol_data, pixdim
+
+    return img.dataobj, pixdim
+
+
+def read_volume_frame(filepath, frame='middle', chunk_size=16, cache=None):
+    """Read one 3D volume of a NIfTI file. If the file is a 4D series,
+    only the voxels of the requested frame are read, through the nibabel
+    array proxy, instead of the whole series.
+
+    Parameters
+    ----------
+    filepath: str
+        Path to a NIfTI file
+
+    frame: int, 'middle' or 'mean'
+        Index of the frame of a 4D series to read, 'middle' for the one at
+        the center of the series, or 'mean' for the temporal mean of the
+        series, summed over chunks of chunk_size frames at a time.
+        Ignored for 3D files.
+
+    chunk_size: int
+        Number of frames read at once for the temporal mean.
+
+    cache: cajal.volume_cache.DecompressionCache, bool or str, optional
+        See open_volume_file.
+
+    Returns
+    -------
+    np.ndarray
+        3D volume
+    """
+    import nibabel as nib
+
+    img = nib.load(uncompressed_path(filepath, cache))
+    shape = img.shape
+    if len(shape) <= 3:
+        return np.asarray(img.dataobj)
+
+    n_frames = shape[3]
+    index = (slice(None),) * 3
+
+    if frame == 'mean':
+        total = np.zeros(shape[:3], dtype=np.float64)
+        for start in range(0, n_frames, chunk_size):
+            chunk = np.asarray(img.dataobj[index + (slice(start, start + chunk_size),)])
+            total += chunk.sum(axis=3, dtype=np.float64)
+        return total / n_frames
+
+    if frame == 'middle':
+        frame = int(np.floor(n_frames/2))
+
+    if not -n_frames <= frame < n_frames:
+        raise IndexError('Frame {} is out of bounds for {} with {} frames.'.format(frame, filepath,
+                                                                                  n_frames))
+
+    return np.asarray(img.dataobj[index + (int(frame),)])
+
+
+def read_mhd_header(filepath):
+    """Read the 'key = value' lines of a MetaImage header file.
+
+    Parameters
+    ----------
+    filepath: str
+        Path to a .mhd file
+
+    Returns
+    -------
+    dict
+        The header fields, with their values as strings.
+    """
+    hdr = OrderedDict()
+    with open(filepath) as f:
+        for line in f:
+            if '=' not in line:
+                continue
+            key, value = line.split('=', 1)
+            hdr[key.strip()] = value.strip()
+            if key.strip() == 'ElementDataFile':
+                break
+    return hdr
+
+
+def mhd_memmap(filepath, hdr):
+    """Return a read-only memory map of the raw data of a MetaImage file.
+
+    The array is indexed in the reverse order of DimSize, (z, y, x), with x
+    being the fastest varying index in the file, as MetaImage stores it.
+    That is the same array boyle.mhd.load_raw_data_with_mhd reads.
+
+    Parameters
+    ----------
+    filepath: str
+        Path to the .mhd file
+
+    hdr: dict
+        Its header, see read_mhd_header.
+
+    Returns
+    -------
+    np.memmap or None
+        None if the data can not be memory-mapped, e.g., if it is
+        compressed, in several files, in the header file, or has several
+        channels per voxel.
+    """
+    if hdr.get('CompressedData', 'False').lower() == 'true':
+        return None
+
+    if int(hdr.get('ElementNumberOfChannels', 1)) != 1:
+        return None
+
+    data_file = hdr.get('ElementDataFile', 'LOCAL')
+    if data_file == 'LOCAL' or data_file.startswith('LIST') or '%' in data_file:
+        return None
+
+    offset = int(hdr.get('HeaderSize', 0))
+    if offset < 0:
+        return None
+
+    dtype = np.dtype(MHD_TO_NUMPY_TYPE[hdr['ElementType']])
+    msb = hdr.get('BinaryDataByteOrderMSB', hdr.get('ElementByteOrderMSB', 'False'))
+    dtype = dtype.newbyteorder('>' if msb.lower() == 'true' else '<')
+
+    shape = tuple(int(d) for d in reversed(hdr['DimSize'].split()))
+    return np.memmap(op.join(op.dirname(filepath), data_file), dtype=dtype,
+                     mode='r', offset=offset, shape=shape, order='C')
+
+
+def data_range(vol_data, chunk_size=16):
+    """Return the minimum and maximum of the volume data, ignoring NaNs.
+    Memory maps and array proxies are read chunk_size slices of their last
+    axis at a time, instead of loading them whole.
+
+    Parameters
+    ----------
+    vol_data: np.ndarray, np.memmap or nibabel.arrayproxy.ArrayProxy
+
+    chunk_size: int
+
+    Returns
+    -------
+    (vmin, vmax)
+    """
+    if isinstance(vol_data, np.ndarray) and not isinstance(vol_data, np.memmap):
+        return np.nanmin(vol_data), np.nanmax(vol_data)
+
+    mins, maxs = [], []
+    for start in range(0, vol_data.shape[-1], chunk_size):
+        chunk = np.asarray(vol_data[..., start:start + chunk_size])
+        valid = chunk[~np.isnan(chunk)] if chunk.dtype.kind == 'f' else chunk
+        if valid.size:
+            mins.append(valid.min())
+            maxs.append(valid.max())
+
+    if not mins:
+        return np.nan, np.nan
+    return min(mins), max(maxs)
+
+
+class SliceCache(object):
+    """Least recently used cache of 2D slices, bounded by their total size in bytes.
+
+    The slices are stored C-contiguous and read-only, so they can be handed
+    to the display code as they are and shared safely. It can be used from
+    several threads.
+
+    Parameters
+    ----------
+    max_bytes: int
+        Maximum total size of the cached slices.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._slices = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self._slices
+
+    def __len__(self):
+        return len(self._slices)
+
+    def get(self, key):
+        """Return the slice stored with key, or None if it is not in the cache."""
+        with self._lock:
+            img = self._slices.pop(key, None)
+            if img is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._slices[key] = img
+            return img
+
+    def put(self, key, img):
+        """Store img with key and return the stored copy.
+
+        Slices larger than max_bytes are returned without being stored.
+        Masked arrays keep their mask.
+        """
+        if np.ma.isMaskedArray(img):
+            img = np.ma.array(_frozen_copy(np.ma.getdata(img)),
+                              mask=_frozen_copy(np.ma.getmaskarray(img)),
+                              copy=False)
+        else:
+            img = _frozen_copy(img)
+
+        if _nbytes(img) > self.max_bytes:
+            return img
+
+        with self._lock:
+            old = self._slices.pop(key, None)
+            if old is not None:
+                self.nbytes -= _nbytes(old)
+
+            self._slices[key] = img
+            self.nbytes += _nbytes(img)
+
+            while self.nbytes > self.max_bytes:
+                _, old = self._slices.popitem(last=False)
+                self.nbytes -= _nbytes(old)
+
+        return img
+
+    def clear(self):
+        with self._lock:
+            self._slices.clear()
+            self.nbytes = 0
+
+
+def _frozen_copy(img):
+    """Return a C-contiguous read-only array with the content of img which
+    does not share memory with any other array."""
+    img = np.ascontiguousarray(img)
+    if img.base is not None:
+        img = img.copy()
+    img.flags.writeable = False
+    return img
+
+
+def _nbytes(img):
+    if np.ma.isMaskedArray(img):
+        return img.data.nbytes + np.ma.getmaskarray(img).nbytes
+    return img.nbytes
+
+
+def orient_slice(img, orientation=None):
+    """Return the 2D slice img in the given orientation.
+
+    Parameters
+    ----------
+    img: np.ndarray
+        2D slice
+
+    orientation: str or None
+        None to leave it as it is, or 'rot90' to rotate it 90 degrees
+        counter-clockwise, as the slice plots of cajal.render show them.
+
+    Returns
+    -------
+    np.ndarray
+    """
+    if orientation is None:
+        return img
+    if orientation == 'rot90':
+        return np.rot90(img)
+
+    raise ValueError('Unknown slice orientation {}.'.format(orientation))
+
+
 class VolumeContainer(object):
-    """This class is a container of 3D volumetric data with a few members to store metadata."""
+    """This class is a container of 3D volumetric data with a few members to store metadata.
+
+    Parameters
+    ----------
+    vol_data: np.ndarray
+        Volume data
 
-    def __init__(self, vol_data, pixdim=None):
+    pixdim: 1xN np.ndarray
+        Voxel size for each volume dimension.
+
+    cache_bytes: int, optional
+        If given, the slices are kept in a SliceCache of this size in bytes.
+        Very useful for lazy volumes.
+
+    prefetch: int
+        Number of neighbour slices at each side of a requested slice
+        that display_slice puts in the cache too, in a background thread.
+        Only used with cache_bytes.
+    """
+
+    def __init__(self, vol_data, pixdim=None, cache_bytes=None, prefetch=0):
         self._voldata = vol_data
         self._pixdim = pixdim
         self._filepath = None
+        self._cache = SliceCache(cache_bytes) if cache_bytes else None
+        self._prefetch = prefetch
+        self._prefetcher = None
+        self._prefetch_job = None
 
     @classmethod
-    def from_file(cls, filepath):
+    def from_file(cls, filepath, lazy=False, cache=None, **kwargs):
+        """Create a container with the data of filepath.
+
+        Parameters
+        ----------
+        filepath: str
+            Path to a volume file
+
+        lazy: bool
+            If True, the data is only read when its slices are taken.
+            See open_volume_file.
+
+        cache: cajal.volume_cache.DecompressionCache, bool or str, optional
+            See open_volume_file.
+
+        kwargs: arguments to the class constructor
+        """
         try:
-            obj = cls(*open_volume_file(filepath))
+            obj = cls(*open_volume_file(filepath, lazy=lazy, cache=cache), **kwargs)
             obj._filepath = filepath
             return obj
         except:
@@ -84,16 +469,92 @@ class VolumeContainer(object):
 
     @property
     def ndims(self):
-        return self._voldata.ndim
+        return len(self._voldata.shape)
 
     @property
     def pixdim(self):
         return self._pixdim
 
+    @property
+    def cache(self):
+        return self._cache
+
     def take_slice(self, slice_idx, axis=0):
-        """Get one slice of the volume given its index and axis"""
+        """Get one slice of the volume given its index and axis.
+        The slice is a new array, which can be modified."""
+        if self._cache is not None:
+            return self.display_slice(slice_idx, axis=axis, orientation=None).copy()
+
+        return self._take_slice(slice_idx, axis)
+
+    def display_slice(self, slice_idx, axis=0, orientation='rot90'):
+        """Get one slice of the volume ready to be displayed: C-contiguous and in
+        the given orientation.
+
+        If the container has a cache, the slice is kept there and is read-only.
+        If prefetch is set, its neighbour slices are read into the cache in a
+        background thread, so they are ready when the next event asks for them.
+
+        Parameters
+        ----------
+        slice_idx: int
+
+        axis: int
+
+        orientation: str or None
+            See orient_slice.
+
+        Returns
+        -------
+        np.ndarray
+        """
+        if self._cache is None:
+            return np.ascontiguousarray(orient_slice(self._take_slice(slice_idx, axis), orientation))
+
+        img = self._cached_slice(slice_idx, axis, orientation)
+
+        if self._prefetch:
+            self._start_prefetch(slice_idx, axis, orientation)
+
+        return img
+
+    def _start_prefetch(self, slice_idx, axis, orientation):
+        # only the neighbours of the last requested slice are worth reading
+        if self._prefetch_job is not None:
+            self._prefetch_job.cancel()
+
+        if self._prefetcher is None:
+            self._prefetcher = ThreadPoolExecutor(max_workers=1)
+
+        self._prefetch_job = self._prefetcher.submit(self._prefetch_slices,
+                                                     slice_idx, axis, orientation)
+
+    def _prefetch_slices(self, slice_idx, axis, orientation):
+        for offset in range(1, self._prefetch + 1):
+            for idx in (slice_idx + offset, slice_idx - offset):
+                if 0 <= idx < self.shape[axis] and (axis, idx, orientation) not in self._cache:
+                    self._cached_slice(idx, axis, orientation)
+
+    def _cached_slice(self, slice_idx, axis, orientation):
+        key = (axis, int(slice_idx), orientation)
+        img = self._cache.get(key)
+        if img is None:
+            img = self._cache.put(key, orient_slice(self._take_slice(slice_idx, axis), orientation))
+        return img
+
+    def _take_slice(self, slice_idx, axis):
         try:
-            return self._voldata.take(slice_idx, axis=axis, mode='raise')
+            if isinstance(self._voldata, np.ndarray) and not isinstance(self._voldata, np.memmap):
+                return self._voldata.take(slice_idx, axis=axis, mode='raise')
+
+            # memory maps and array proxies only read what is indexed
+            if not -self.shape[axis] <= slice_idx < self.shape[axis]:
+                raise IndexError('Index {} is out of bounds for axis {} with '
+                                 'size {}.'.format(slice_idx, axis, self.shape[axis]))
+            index = [slice(None)] * self.ndims
+            index[axis] = slice_idx
+            # a copy, the slices of read-only memory maps are not writable
+            return np.array(self._voldata[tuple(index)])
         except:
             log.exception('Could not get slice {} in axis {} from {}.'.format(slice_idx, axis, self._filepath))
             raise
@@ -105,16 +566,40 @@ class PlotVolume(VolumeContainer):
     _cmap = None
     _opacity = 1
     _is_visible = True
+    _transp_val = None
     _axis = 0
     _slice = 0
 
-    def __init__(self):
+    def __init__(self, vol_data=None, pixdim=None, **kwargs):
+        super(PlotVolume, self).__init__(vol_data, pixdim, **kwargs)
         self._cmap = None
         # self.type enum(gray, stats, fibers...)
         self._is_visible = True
         self._opacity = 1
+        self._transp_val = None
+        self._clim = None
+        self._lut = None
         # self.
 
+    @property
+    def clim(self):
+        """Data range mapped to the colormap, by default the minimum and
+        maximum of the volume, see data_range."""
+        if self._clim is None:
+            self._clim = data_range(self._voldata)
+        return self._clim
+
+    @clim.setter
+    def clim(self, value):
+        self._clim = value
+
+    @property
+    def lut(self):
+        """Lookup table of the colormap of the volume, see cajal.utils.image.colormap_lut."""
+        if self._lut is None or self._lut[0] is not self._cmap:
+            self._lut = (self._cmap, colormap_lut(self._cmap))
+        return self._lut[1]
+
     def switch_visible(self):
         self.is_visible = not self.is_visible
 
@@ -161,7 +646,7 @@ class PlotVolume(VolumeContainer):
             raise ValueError('Number of dimensions {} and {} mismatch.'.format(self.ndims, other.ndims))
         if self.shape != other.shape:
             raise ValueError('Shapes {} and {} mismatch.'.format(self.shape, other.shape))
-        if self.pixdim != other.pixdim:
+        if not np.array_equal(self.pixdim, other.pixdim):
             raise ValueError('Pixel dimensions {} and {} mismatch.'.format(self.pixdim, other.pixdim))
 
 #
@@ -9,26 +9,41 @@
 #Use this at your own risk!
 #-------------------------------------------------------------------------------
 import  os
+import  hashlib
+import  logging
+import  weakref
+import  multiprocessing
+from    collections import OrderedDict
 
 import  numpy       as np
 import  skimage.io  as skio
 
 import  matplotlib.pyplot   as plt
-from    matplotlib          import colors
 import  matplotlib.cm       as cm
 from    matplotlib.widgets  import Slider
 import  matplotlib.ticker   as ticker
+from    matplotlib.colors   import Colormap
 
 from    mpl_toolkits.axes_grid  import make_axes_locatable
 from    mpl_toolkits.axes_grid1 import ImageGrid
 
-from    nipy.labs.viz_tools.edge_detect import _edge_detect
 from    nitime.viz          import drawmatrix_channels
 
-from    boyle.nifti.read    import get_nii_data
 from    boyle.files.names   import get_temp_file, remove_ext
 
-from    ..utils.math        import makespread
+from    .utils.parallel     import imap_ordered, imap_unordered, effective_n_jobs
+from    .mosaic             import get_mosaic_slices, render_many_slices
+from    .manifest           import RenderManifest, file_signature, params_digest
+from    .gallery            import create_gallery
+from    .utils.image        import (area_downscale, crop_bounds, batch_crop_bounds,
+                                    volume_bounds, block_downsample, colormap_lut)
+from    .roi                import get_rois_outline
+from    .plot_volume        import SliceCache, read_volume_frame
+from    .matrix             import (matrix_to_rgba, memmap_reference, load_matrix,
+                                    block_reduce_matrix, reduction_factor,
+                                    write_deep_zoom, dense_matrix)
+
+log = logging.getLogger(__name__)
 
 #-------------------------------------------------------------------------------------
 # Matplotlib-based options
@@ -37,7 +52,8 @@ def show_many_slices(vol, vol2=None, volaxis=1, n_slices=[8, 8], slices_idx=None
                      vol1_colormap=None, vol1_transp_val=None,
                      vol2_colormap=None, vol2_transp_val=0,
                      interpolation='nearest', figtitle=None, facecolor='',
-                     is_red_outline=False, show_colorbar=True):
+                     is_red_outline=False, show_colorbar=True,
+                     vol1_clim=None, vol2_clim=None):
     """
     @param vol: numpy 3D array
     @param vol2: numpy 3D array
@@ -58,109 +74,248 @@ def show_many_slices(vol, vol2=None, volaxis=1, n_slices=[8, 8], slices_idx=None
     @param is_red_outline: boolean, optional
     @param show_colorbar: boolean, optional
 
+    @param vol1_clim: (vmin, vmax), optional
+    @param vol2_clim: (vmin, vmax), optional
+    Fixed color limits for all the slices of vol and vol2. By default
+    each slice of vol is scaled to its own range, and so are the slices
+    of vol2 unless there is a colorbar.
+
     @return: matplotlib figure
     """
+    has_overlay = isinstance(vol2, np.ndarray)
+    if has_overlay:
+        assert vol.shape == vol2.shape, 'vol do not have the same shape as vol2'
 
-    class ImageObserver:
-        'update image in response to changes in clim or cmap on another image'
-        def __init__(self, follower):
-            self.follower = follower
-        def __call__(self, leader):
-            self.follower.set_cmap(leader.get_cmap())
-            self.follower.set_clim(leader.get_clim())
+    figure = ManySlicesFigure(vol.shape, has_overlay=has_overlay,
+                              volaxis=volaxis, n_slices=n_slices,
+                              slices_idx=slices_idx,
+                              vol1_colormap=vol1_colormap,
+                              vol1_transp_val=vol1_transp_val,
+                              vol2_colormap=vol2_colormap,
+                              vol2_transp_val=vol2_transp_val,
+                              interpolation=interpolation, figtitle=figtitle,
+                              facecolor=facecolor,
+                              is_red_outline=is_red_outline,
+                              show_colorbar=show_colorbar)
+
+    figure.set_volumes(vol, vol2 if has_overlay else None,
+                       vol1_clim=vol1_clim, vol2_clim=vol2_clim)
+
+    return figure.fig
+
+
+class ManySlicesFigure(object):
+    """
+    The figure of show_many_slices, built once and reusable to draw other
+    volumes of the same shape: only the image data and color limits of its
+    artists change from one volume to the next.
+
+    @param shape: tuple of int
+    Shape of the volumes.
+
+    @param has_overlay: bool
+    True if the volumes will come with an overlay volume.
+
+    See show_many_slices for the other arguments.
+    """
+    def __init__(self, shape, has_overlay=False, volaxis=1, n_slices=[8, 8],
+                 slices_idx=None, vol1_colormap=None, vol1_transp_val=None,
+                 vol2_colormap=None, vol2_transp_val=0,
+                 interpolation='nearest', figtitle=None, facecolor='',
+                 is_red_outline=False, show_colorbar=True):
+
+        if vol1_colormap is None:
+            vol1_colormap = plt.cm.gray
 
-    if isinstance(vol2, np.ndarray):
-        assert vol.shape == vol2.shape, 'vol do not have the same shape as vol2'
         if vol2_colormap is None:
             vol2_colormap = plt.cm.jet
 
-    if vol1_colormap is None:
-        vol1_colormap = plt.cm.gray
-
-    size   = vol.shape[volaxis]
-    n_rows = len(n_slices)
-    n_cols = max(n_slices)
+        self.shape           = tuple(shape)
+        self.has_overlay     = has_overlay
+        self.volaxis         = volaxis
+        self.vol1_transp_val = vol1_transp_val
+        self.vol2_transp_val = vol2_transp_val
+        self.is_red_outline  = is_red_outline
+        self.vol2_colormap   = vol2_colormap
+        self.show_colorbar   = show_colorbar and has_overlay and not is_red_outline
+        self.slice_idx       = get_mosaic_slices(self.shape[volaxis], n_slices, slices_idx)
+
+        self.fig = plt.figure(figtitle, frameon=False)
+
+        if facecolor:
+            self.fig.set_facecolor(facecolor)
+
+        barargs = {}
+        if self.show_colorbar:
+            barargs = dict(cbar_location="right",
+                           cbar_mode='single',
+                           cbar_size='10%',
+                           cbar_pad=0.05)
+
+        grid = ImageGrid(self.fig, 111,
+                         nrows_ncols=(len(n_slices), max(n_slices)),
+                         axes_pad=0,
+                         direction='column',
+                         **barargs)
+
+        for g in grid:
+            g.axis('off')
+
+        #slices are shown rotated 90 degrees
+        blank = np.zeros(np.delete(self.shape, volaxis)[::-1])
+
+        self._images   = []
+        self._overlays = []
+        for c, i in enumerate(self.slice_idx):
+            g = grid[c]
+
+            self._images.append(g.imshow(blank, cmap=vol1_colormap,
+                                         interpolation=interpolation))
+            if has_overlay:
+                self._overlays.append(g.imshow(blank, cmap=vol2_colormap,
+                                               interpolation=interpolation))
+
+            g.text(blank.shape[1]/2, 4, str(i), horizontalalignment='center',
+                   fontsize=12, fontname='Arial', color = '#0055ff')
+
+        if self.show_colorbar:
+            grid[len(self.slice_idx) - 1].cax.colorbar(self._overlays[-1])
+
+    def set_volumes(self, vol, vol2=None, vol1_clim=None, vol2_clim=None):
+        """
+        Show the slices of vol, and of vol2 over them, in the figure.
+
+        @param vol: numpy 3D array
+        @param vol2: numpy 3D array, only if the figure has an overlay
+
+        @param vol1_clim: (vmin, vmax), optional
+        @param vol2_clim: (vmin, vmax), optional
+        Fixed color limits, see show_many_slices.
+
+        @return: ManySlicesFigure
+        self
+        """
+        if vol.shape != self.shape:
+            raise ValueError('Expected a volume of shape {}, got {}.'.format(self.shape, vol.shape))
+
+        if self.has_overlay != (vol2 is not None):
+            raise ValueError('This figure was built {} an overlay '
+                             'volume.'.format('with' if self.has_overlay else 'without'))
+
+        for i, im in zip(self.slice_idx, self._images):
+            img = np.rot90(vol.take(i, axis=self.volaxis))
+            if self.vol1_transp_val is not None:
+                img = np.ma.masked_where(img == self.vol1_transp_val, img)
+            _set_image_data(im, img, vol1_clim)
+
+        if not self.has_overlay:
+            return self
+
+        transp_val = self.vol2_transp_val
+        if self.is_red_outline:
+            vol2, cmap, clim = _outline_overlay(vol2, self.volaxis,
+                                                self.vol2_colormap)
+            transp_val = 0
+            for im in self._overlays:
+                im.set_cmap(cmap)
+
+        vmin =  1e40
+        vmax = -1e40
+        for i, im in zip(self.slice_idx, self._overlays):
+            img2 = np.rot90(vol2.take(i, axis=self.volaxis))
+            img2 = np.ma.masked_where(img2 == transp_val, img2)
+
+            _set_image_data(im, img2)
+            if img2.count():
+                vmin = min(vmin, img2.min())
+                vmax = max(vmax, img2.max())
+
+        if self.is_red_outline:
+            vmin, vmax = clim
+        elif vol2_clim is not None:
+            vmin, vmax = vol2_clim
+
+        if (self.show_colorbar or self.is_red_outline or vol2_clim is not None) and vmin <= vmax:
+            for im in self._overlays:
+                im.set_clim(vmin, vmax)
+
+        return self
+
+    def export(self, filepath, dpi=150, **kwargs):
+        """
+        Save the figure, see export_figure.
+        """
+        return export_figure(self.fig, filepath, dpi=dpi, **kwargs)
+
+    def close(self):
+        plt.close(self.fig)
+
+
+def _outline_overlay(vol2, volaxis, colormap):
+    """
+    Return the ROI outlines of vol2 in the slices across volaxis, with the
+    colormap and color limits to show them: red for a single ROI, or
+    colormap over the ROI values so each ROI keeps its color.
+    """
+    outline = get_rois_outline(vol2, axis=volaxis, background=0)
 
-    if not slices_idx:
-        slice_idx = makespread(list(range(size)), np.sum(n_slices))
+    labels = np.unique(outline[outline != 0])
+    if len(labels) <= 1:
+        top = labels[0] if len(labels) else 1
+        return outline, plt.cm.autumn_r, (min(0, top), max(0, top))
 
-    fig  = plt.figure(figtitle, frameon=False)
+    return outline, colormap, (labels.min(), labels.max())
 
-    if facecolor:
-        fig.set_facecolor(facecolor)
 
-    barargs = {}
-    if show_colorbar:
-        barargs = dict(cbar_location="right",
-                       cbar_mode='single',
-                       cbar_size='10%',
-                       cbar_pad=0.05)
+def _set_image_data(im, img, clim=None):
+    """
+    Set img as the data of the AxesImage im and scale its color limits
+    to it, as imshow does, or set them to clim if given.
+    """
+    im.set_data(img)
+    if clim is not None:
+        im.set_clim(*clim)
+    elif np.ma.count(img):
+        im.set_clim(img.min(), img.max())
 
-    grid = ImageGrid(fig, 111,
-                     nrows_ncols=(n_rows, n_cols),
-                     axes_pad=0,
-                     direction='column',
-                     **barargs)
 
-    axes   = []
-    images = []
-    vmin   =  1e40
-    vmax   = -1e40
+#Figures kept by the slicesdir functions to reuse them with the next subjects
+_FIGURE_TEMPLATES     = OrderedDict()
+_MAX_FIGURE_TEMPLATES = 4
 
-    for g in grid:
-        g.axis('off')
 
-    c = 1
-    for i in slice_idx[:-2]:
-        g = grid[c-1]
+def _get_figure_template(shape, has_overlay, **kwargs):
+    """
+    Return a ManySlicesFigure for the given layout, reusing the one of the
+    last subject with the same layout if there is one.
+    """
+    params = dict((name, _colormap_signature(value)) for name, value in kwargs.items())
+    key = (tuple(shape), has_overlay, params_digest(params))
 
-        img = vol.take([i], volaxis).squeeze()
-        if vol1_transp_val is not None:
-            img = np.ma.masked_where(img == vol1_transp_val, img)
-        g.imshow(np.rot90(img), cmap=vol1_colormap,
-                 interpolation=interpolation)
+    figure = _FIGURE_TEMPLATES.pop(key, None)
+    if figure is None:
+        figure = ManySlicesFigure(shape, has_overlay=has_overlay, **kwargs)
+    _FIGURE_TEMPLATES[key] = figure
 
-        if isinstance(vol2, np.ndarray):
-            img2 = vol2.take([i], volaxis).squeeze()
-            img2 = np.rot90(img2)
+    while len(_FIGURE_TEMPLATES) > _MAX_FIGURE_TEMPLATES:
+        _FIGURE_TEMPLATES.popitem(last=False)[1].close()
 
-            if is_red_outline:
-                _, img2 = _edge_detect(img2)
-                img2 = np.ma.masked_where(img2 == 0, img2)
+    return figure
 
-                #change vol2 colormap
-                vol2_colormap = plt.cm.autumn_r
-                show_colorbar = False
 
-            else:
-                img2 = np.ma.masked_where(img2 == vol2_transp_val, img2)
-
-            images.append(g.imshow(img2, cmap=vol2_colormap,
-                                   interpolation=interpolation))
-            dd = np.ravel(img2)
-            vmin = min(vmin, np.amin(dd))
-            vmax = max(vmax, np.amax(dd))
-
-        #gpos  = g.get_position()
-        #gaxis = g.get_axis()
-        axes.append(g)
-        textx = img.shape[0]/2
-        texty = 4
-        g.text(textx, texty, str(i), horizontalalignment='center',
-               fontsize=12, fontname='Arial', color = '#0055ff')
-
-        c += 1
-
-    if show_colorbar:
-        norm = colors.Normalize(vmin=vmin, vmax=vmax)
-        for i, im in enumerate(images):
-            im.set_norm(norm)
-            if i > 0:
-                images[0].callbacksSM.connect('changed', ImageObserver(im))
+def _colormap_signature(value):
+    """
+    Return a hash of the colors of value if it is a colormap, value otherwise.
+    Different colormaps can have the same name.
+    """
+    if isinstance(value, Colormap):
+        return 'lut:' + hashlib.sha1(colormap_lut(value).tobytes()).hexdigest()
+    return value
 
-        axes[-1].cax.colorbar(images[-1])
 
-    return fig
+def _clear_figure_templates():
+    while _FIGURE_TEMPLATES:
+        _FIGURE_TEMPLATES.popitem()[1].close()
 
 
 def create_imglist_html(output_dir, img_files, filename='index.html'):
@@ -195,25 +350,47 @@ def show_connectivity_matrix(image, cmap=None):
     skio.imshow(image, cmap=cmap)
 
 
-def autocrop_img(image, color=0):
+def autocrop_img(image, color=0, margin=0):
     """
     Crops the borders of the given color of an image.
 
     @param image: ndarray
     @param color: int
+
+    @param margin: int
+    Number of border pixels to keep around the content.
+
     @return:
     ndarray
     """
-    if len(image.shape) == 3:
-        img = image[..., 3] if image.shape[2] == 4 else image[..., 0]
-    else:
-        img = image
+    bounds = crop_bounds(image, color, margin=margin)
+    if bounds is None:
+        return image
+
+    top, bottom, left, right = bounds
+    return image[top:bottom, left:right, ...]
 
-    mask = (img != color).astype(int)
 
-    left, right, top, bottom = borders(mask, 0)
+def autocrop_imgs(images, color=0, margin=0, common=False):
+    """
+    Crops the borders of the given color of several images.
 
-    return image[top:bottom, left:right, :]
+    @param images: ndarray or list of ndarrays
+    Stack or list of images.
+
+    @param color: int
+    @param margin: int
+
+    @param common: bool
+    If True, all the images are cropped with the same bounding box.
+
+    @return:
+    list of ndarrays
+    """
+    bounds = batch_crop_bounds(images, color=color, margin=margin,
+                               common=common)
+    return [image[top:bottom, left:right, ...]
+            for image, (top, bottom, left, right) in zip(images, bounds)]
 
 
 def imshow(image, **kwargs):
@@ -225,28 +402,36 @@ def imshow(image, **kwargs):
 
 def borders(im, color):
     """
-    @param im:
-    @param color:
+    @param im: ndarray
+    2D image, or multichannel image of shape (height, width, channels).
+
+    @param color: scalar or sequence
+    Background value, or one value for each channel.
+
     @return:
+    left, right, top, bottom
+    The first and last columns and rows with pixels different from color,
+    in any of their channels.
     """
-    #left, right, top, bottom = -1,-1,-1,-1
-
-    non_color_pix = np.where(im != color)
-    top = non_color_pix[0].min()
-    bottom = non_color_pix[0].max()
-    left = non_color_pix[1].min()
-    right = non_color_pix[1].max()
+    bounds = crop_bounds(im, color, all_channels=True)
+    if bounds is None:
+        raise ValueError('The image only has pixels of color {}.'.format(color))
 
-    return left, right, top, bottom
+    top, bottom, left, right = bounds
+    return left, right - 1, top, bottom - 1
 
 
 def slicesdir_paired_overlays(output_dir, file_list1, file_list2, dpi=150,
-                              is_red_outline=False, **kwargs):
+                              is_red_outline=False, n_jobs=None, executor=None,
+                              resume=False, gallery=None, frame='middle',
+                              volaxes=None, combine_axes=True, cache=None,
+                              **kwargs):
     """
     @param output_dir:
     @param file_list1: list of strings
     Paths to the background image, can be either 3D or 4D images.
-    If they are 4D images, will pick one of the center.
+    If they are 4D images, will pick one of the center, or the one
+    given by frame.
 
     @param file_list2: list of strings
     Paths to the overlay images, must be 3D images.
@@ -254,58 +439,476 @@ def slicesdir_paired_overlays(output_dir, file_list1, file_list2, dpi=150,
     @param is_red_outline: boolean, optional
     If True will show from the files in list2 a red outline border.
 
+    @param n_jobs: int, optional
+    Number of worker processes to render the subjects with.
+    None or 1 renders them serially in this process, -1 uses all CPUs.
+    In parallel mode a subject that fails is logged and left out of the
+    index instead of stopping the whole run.
+
+    @param executor: concurrent.futures.Executor, optional
+    Running executor to submit the subjects to, instead of creating a
+    process pool with n_jobs workers.
+
+    @param resume: bool, optional
+    If True, will keep a manifest of the rendered images in output_dir
+    and skip the subjects whose input files and rendering arguments did not
+    change since their image was made. See cajal.manifest.RenderManifest.
+
+    @param gallery: bool or dict, optional
+    If given, will write a paginated gallery with thumbnails instead of a
+    single index.html with all the images. A dict is passed as arguments
+    to cajal.gallery.create_gallery.
+
+    @param frame: int, 'middle' or 'mean', optional
+    Volume of the 4D images to show: its index, the one at the center of
+    the series, or the temporal mean. Only that frame is read from the
+    files, see cajal.plot_volume.read_volume_frame.
+
+    @param volaxes: list of int, optional
+    If given, e.g., [0, 1, 2], will make the mosaics across all these axes
+    from one read of each file, sharing their color limits, instead of
+    only the one across volaxis.
+
+    @param combine_axes: bool, optional
+    If True, the mosaics of volaxes of each subject are stacked into one
+    image. Otherwise each is saved in its own file, with an _axis<N>
+    suffix in its name.
+
+    @param cache: bool or string, optional
+    Cache of decompressed copies of the .nii.gz files, so the next runs
+    over the same files do not decompress them again: True for the default
+    one or the path to its folder. See cajal.volume_cache.DecompressionCache.
+
     @param kwargs: arguments to show_many_slices
     See macuto.render.show_many_slices docstring.
+    It can also include engine='numpy' to compose the images with
+    cajal.mosaic.render_many_slices, much faster for large batches.
+    With pyramid={'thumbs': 8, 'medium': 2} it will also save reduced
+    versions of each image in those sub-folders, see save_image.
 
     @return:
     """
     assert(len(file_list1) > 0)
     assert(len(file_list1) == len(file_list2))
 
+    kwargs['is_red_outline'] = is_red_outline
+    kwargs['dpi'] = dpi
+    kwargs['frame'] = frame
+    kwargs['volaxes'] = volaxes
+    kwargs['combine_axes'] = combine_axes
+
+    #CREATE separate images of each file_list2 file
+    # on the corresponding file_list1 file
+    jobs = [((_slicesdir_png_path(output_dir, file_list1[idx]),
+              file_list1[idx], file_list2[idx]), kwargs)
+            for idx in list(range(len(file_list1)))]
+
+    return _run_slicesdir(output_dir, jobs, n_jobs=n_jobs, executor=executor,
+                          resume=resume, gallery=gallery, cache=cache)
+
+
+def _slicesdir_png_path(output_dir, filepath):
+    """
+    Return the path of the output image of filepath in output_dir.
+    """
+    png_fname = os.path.relpath(remove_ext(filepath))
+    png_fname = png_fname.replace('.', '').replace('/', '_').replace('__', '') + '.png'
+    return os.path.join(output_dir, png_fname)
+
+
+def _render_slicesdir_subject(png_path, vol_file, overlay_file=None, dpi=150,
+                              engine='matplotlib', pyramid=None, frame='middle',
+                              volaxes=None, combine_axes=True, cache=None,
+                              **kwargs):
+    """
+    Render the slices of one subject into png_path.
+    This is the unit of work of the slicesdir functions, it must stay at
+    module level so it can be sent to a process pool.
+
+    @param png_path: string
+    @param vol_file: string
+    @param overlay_file: string, optional
+    @param dpi: int
+
+    @param engine: string
+    'matplotlib' to draw a show_many_slices figure, reusing the one
+    of the previous subject if it had the same layout, or
+    'numpy' to compose the image with cajal.mosaic.render_many_slices,
+    which ignores dpi and uses its zoom argument instead.
+
+    @param pyramid: dict, optional
+    Reduced versions of the image to save, see save_image.
+
+    @param frame: int, 'middle' or 'mean'
+    Volume of vol_file to show if it is a 4D series,
+    see cajal.plot_volume.read_volume_frame.
+
+    @param volaxes: list of int, optional
+    If given, will render the mosaics across each of these axes from the
+    same loaded volumes, with the same color limits, instead of only the
+    one across volaxis.
+
+    @param combine_axes: bool
+    If True, the mosaics of volaxes are stacked into one image in png_path,
+    otherwise each one is saved in its own file, see _slicesdir_outputs.
+
+    @param cache: bool or string, optional
+    Decompression cache of the input files, see
+    cajal.volume_cache.uncompressed_path.
+
+    @param kwargs: arguments to show_many_slices
+
+    @return: list of strings
+    The base names of the saved images.
+    """
+    if plt.get_backend().lower() != 'agg' and _is_worker_process():
+        plt.switch_backend('Agg')
+
+    f1_vol = read_volume_frame(vol_file, frame=frame, cache=cache)
+
+    f2_vol = None
+    if overlay_file is not None:
+        f2_vol = read_volume_frame(overlay_file, cache=cache)
+
+    outputs = _slicesdir_outputs(png_path, volaxes, combine_axes)
+
+    if volaxes is None:
+        img = _render_slices_rgba(f1_vol, f2_vol, engine, dpi, **kwargs)
+        save_image(png_path, autocrop_img(img), pyramid=pyramid)
+        return outputs
+
+    #the color limits are computed once and shared by all the axes
+    kwargs.pop('volaxis', None)
+    if kwargs.get('vol1_clim') is None:
+        kwargs['vol1_clim'] = _value_range(f1_vol, kwargs.get('vol1_transp_val'))
+    if f2_vol is not None and kwargs.get('vol2_clim') is None and not kwargs.get('is_red_outline'):
+        kwargs['vol2_clim'] = _value_range(f2_vol, kwargs.get('vol2_transp_val', 0))
+
+    imgs = [autocrop_img(_render_slices_rgba(f1_vol, f2_vol, engine, dpi,
+                                             volaxis=axis, **kwargs))
+            for axis in volaxes]
+
+    if combine_axes:
+        imgs = [stack_images(imgs)]
+
+    output_dir = os.path.dirname(png_path)
+    for img, img_file in zip(imgs, outputs):
+        save_image(os.path.join(output_dir, img_file), img, pyramid=pyramid)
+
+    return outputs
+
 
+def _render_slices_rgba(vol, vol2, engine='matplotlib', dpi=150,
+                        vol1_clim=None, vol2_clim=None, **kwargs):
+    """
+    Return the RGBA image of the slice mosaic of vol and vol2 made with the
+    given engine, see _render_slicesdir_subject.
+    """
+    if engine == 'numpy':
+        return render_many_slices(vol, vol2, vol1_clim=vol1_clim,
+                                  vol2_clim=vol2_clim, **kwargs)
+
+    if engine == 'matplotlib':
+        figure = _get_figure_template(vol.shape, vol2 is not None, **kwargs)
+        figure.set_volumes(vol, vol2, vol1_clim=vol1_clim, vol2_clim=vol2_clim)
+        return figure_to_rgba(figure.fig, dpi=dpi)
+
+    raise ValueError('Unknown rendering engine {}.'.format(engine))
+
+
+def _value_range(vol, transp_val=None):
+    """
+    Return the (min, max) of vol without its transp_val voxels,
+    or None if there are no other voxels.
+    """
+    data = vol if transp_val is None else vol[vol != transp_val]
+    if data.size == 0:
+        return None
+    return np.nanmin(data), np.nanmax(data)
+
+
+def _slicesdir_outputs(png_path, volaxes=None, combine_axes=True, **kwargs):
+    """
+    Return the base names of the images a slicesdir job saves:
+    the one of png_path, or one for each axis in volaxes when they
+    are not combined, e.g., subj_axis0.png, subj_axis2.png.
+    """
+    png_name = os.path.basename(png_path)
+    if volaxes is None or combine_axes:
+        return [png_name]
+
+    base, ext = os.path.splitext(png_name)
+    return ['{}_axis{}{}'.format(base, axis, ext) for axis in volaxes]
+
+
+def stack_images(imgs):
+    """
+    Stack RGBA images vertically, centered and padded with transparent pixels
+    to the width of the widest one.
+
+    @param imgs: list of ndarrays
+    uint8 arrays of shape (height, width, 4)
+
+    @return: ndarray
+    """
+    width = max(img.shape[1] for img in imgs)
+
+    padded = []
+    for img in imgs:
+        left  = (width - img.shape[1]) // 2
+        right = width - img.shape[1] - left
+        padded.append(np.pad(img, [(0, 0), (left, right), (0, 0)], mode='constant'))
+
+    return np.vstack(padded)
+
+
+def _is_worker_process():
+    return multiprocessing.current_process().name != 'MainProcess'
+
+
+def _render_tracked_slicesdir_subject(png_path, vol_file, overlay_file=None,
+                                      **kwargs):
+    """
+    Same as _render_slicesdir_subject, but also returns the signatures of
+    the input files for the manifest.
+
+    @return: list of strings, list of dict
+    """
+    inputs = [f for f in (vol_file, overlay_file) if f is not None]
+    signatures = [file_signature(f) for f in inputs]
+
+    png_names = _render_slicesdir_subject(png_path, vol_file, overlay_file,
+                                          **kwargs)
+    return png_names, signatures
+
+
+def _run_slicesdir(output_dir, jobs, n_jobs=None, executor=None, resume=False,
+                   gallery=None, cache=None):
+    """
+    Render the jobs of a slicesdir function and write the index.html file.
+
+    @param output_dir: string
+    @param jobs: list of (args, kwargs) for _render_slicesdir_subject
+    @param n_jobs: int, optional
+    @param executor: concurrent.futures.Executor, optional
+
+    @param resume: bool, optional
+    If True, will skip the jobs which are up to date in the output_dir
+    manifest and record the new ones. The index then lists all the images
+    in the manifest, also the ones of subjects from earlier runs.
+
+    @param gallery: bool or dict, optional
+    See write_index.
+
+    @param cache: bool or string, optional
+    Decompression cache passed to every job, it is not part of the rendering
+    parameters recorded in the manifest.
+
+    @return: list of strings
+    The image file names, in the same order as jobs.
+    """
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    img_files = []
+    is_parallel = executor is not None or n_jobs not in (None, 1)
+
+    outputs = [_slicesdir_outputs(args[0], **kwargs) for args, kwargs in jobs]
+    names   = [job_outputs[0] for job_outputs in outputs]
+    pending = list(range(len(jobs)))
+
+    manifest = None
+    render   = _render_slicesdir_subject
+    if resume:
+        manifest = RenderManifest(output_dir)
+        render   = _render_tracked_slicesdir_subject
+        pending  = [idx for idx in pending
+                    if not manifest.is_up_to_date(names[idx],
+                                                  [f for f in jobs[idx][0][1:] if f is not None],
+                                                  jobs[idx][1])]
+        log.info('{} of {} subjects are up to date in {}.'.format(len(jobs) - len(pending),
+                                                                 len(jobs), output_dir))
+
+    done = set()
+    render_jobs = [(jobs[idx][0], dict(jobs[idx][1], cache=cache)) for idx in pending]
+    try:
+        #each subject is recorded as soon as it is done, so a run that dies
+        #keeps all the finished ones, not only those before the slowest one
+        for idx, result in imap_unordered(render, render_jobs,
+                                          n_jobs=n_jobs, executor=executor,
+                                          skip_errors=is_parallel):
+            job_idx = pending[idx]
+            if manifest is not None:
+                manifest.record(names[job_idx], result[1], jobs[job_idx][1],
+                                outputs=result[0])
+            done.add(job_idx)
+    finally:
+        _clear_figure_templates()
+
+    if manifest is not None:
+        manifest.compact()
+
+    pending = set(pending)
+    rendered = [idx for idx in range(len(jobs)) if idx not in pending or idx in done]
+    img_files = [img_file for idx in rendered for img_file in outputs[idx]]
+
+    if len(rendered) < len(jobs):
+        log.error('Could not render {} of {} subjects, see the log '
+                  'for details.'.format(len(jobs) - len(rendered), len(jobs)))
+
+    #Create the index.html file with all images, including the ones
+    #of the subjects rendered by earlier runs into the same output_dir
+    #in the order of the jobs, as the manifest is in the order they finished
+    index_files = img_files
+    if manifest is not None:
+        current      = set(img_files)
+        index_files  = img_files + [img_file for img_file in manifest.image_files()
+                                    if img_file not in current]
+    write_index(output_dir, index_files, gallery)
 
-    #CREATE separate images of each file_list2 file
-    # on the corresponding file_list1 file
-    for idx in list(range(len(file_list1))):
-        f1_vol = get_nii_data(file_list1[idx])
-        f2_vol = get_nii_data(file_list2[idx])
+    return img_files
 
-        if len(f1_vol.shape) > 3:
-            f1_vol = f1_vol[..., int(np.floor(f1_vol.shape[3]/2))]
 
-        fig = show_many_slices(f1_vol, f2_vol, is_red_outline=is_red_outline,
-                               **kwargs)
+def write_index(output_dir, img_files, gallery=None):
+    """
+    Write the index of the images in output_dir.
 
-        png_fname = os.path.relpath(remove_ext(file_list1[idx]))
-        png_fname = png_fname.replace('.', '').replace('/', '_').replace('__', '') + '.png'
-        png_path = os.path.join(output_dir, png_fname)
+    @param output_dir: string
+    @param img_files: list of strings
 
-        export_figure(fig, png_path, dpi=dpi)
+    @param gallery: bool or dict, optional
+    If None or False, will write one index.html with all the images,
+    see create_imglist_html. Otherwise will write a paginated gallery,
+    a dict is passed as arguments to cajal.gallery.create_gallery.
 
-        plt.close(fig)
+    @return: list of strings
+    The file names of the index pages.
+    """
+    if not gallery:
+        create_imglist_html(output_dir, img_files)
+        return ['index.html']
 
-        img_files.append(os.path.basename(png_path))
+    gallery_kwargs = gallery if isinstance(gallery, dict) else {}
+    return create_gallery(output_dir, img_files, **gallery_kwargs)
 
-    #Create the index.html file with all images
-    create_imglist_html(output_dir, img_files)
 
-    return img_files
+def figure_to_rgba(fig, dpi=150, transparent=True):
+    """
+    Render fig with the Agg canvas and return its pixels without going
+    through a file.
 
+    @param fig: matplotlib Figure
+    @param dpi: int
+    @param transparent: bool
+    Same as in Figure.savefig
+
+    @return: ndarray
+    uint8 array of shape (height, width, 4), the same pixels that
+    savefig would write into a PNG file.
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
 
-def export_figure(fig, filepath, dpi=150):
+    orig_canvas = fig.canvas
+    canvas = orig_canvas if isinstance(orig_canvas, FigureCanvasAgg) else FigureCanvasAgg(fig)
 
-    tmpf = get_temp_file(suffix='.png').name
-    fig.savefig(tmpf, transparent=True, dpi=dpi)
-    img = autocrop_img(skio.imread(tmpf))
-    skio.imsave(filepath, img)
+    orig_dpi = fig.dpi
+    patches  = [fig.patch] + [ax.patch for ax in fig.axes]
+    colors   = [(patch.get_facecolor(), patch.get_edgecolor()) for patch in patches]
+    try:
+        fig.set_dpi(dpi)
+        if transparent:
+            for patch in patches:
+                patch.set_facecolor('none')
+                patch.set_edgecolor('none')
+
+        data, (width, height) = canvas.print_to_buffer()
+    finally:
+        fig.set_dpi(orig_dpi)
+        for patch, (facecolor, edgecolor) in zip(patches, colors):
+            patch.set_facecolor(facecolor)
+            patch.set_edgecolor(edgecolor)
+        if canvas is not orig_canvas:
+            fig.set_canvas(orig_canvas)
+
+    img = np.frombuffer(data, dtype=np.uint8)
+    return img.reshape((height, width, 4))
+
+
+def export_figure(fig, filepath, dpi=150, in_memory=True, pyramid=None):
+    """
+    Save fig into filepath as a PNG image with its transparent borders cropped.
+
+    @param fig: matplotlib Figure
+    @param filepath: string
+    @param dpi: int
+
+    @param in_memory: bool
+    If True, will take the pixels directly from the Agg canvas and encode
+    the PNG only once. Otherwise will save the figure into a temporary
+    PNG file and read it back before cropping.
+
+    @param pyramid: dict, optional
+    Smaller versions of the image to save from the same render.
+    See save_image.
+
+    @return: string
+    filepath
+    """
+    if in_memory:
+        img = figure_to_rgba(fig, dpi=dpi, transparent=True)
+    else:
+        tmpf = get_temp_file(suffix='.png').name
+        fig.savefig(tmpf, transparent=True, dpi=dpi)
+        img = skio.imread(tmpf)
+
+    save_image(filepath, autocrop_img(img), pyramid=pyramid)
     return filepath
 
 
-def slicesdir_oneset(output_dir, file_list1, dpi=150, **kwargs):
+def save_image(filepath, img, pyramid=None):
+    """
+    Save img into filepath and, optionally, reduced versions of it.
+
+    @param filepath: string
+    @param img: ndarray
+
+    @param pyramid: dict, optional
+    Maps sub-folder names to integer reduction factors, e.g.,
+    {'thumbs': 8, 'medium': 2}. Each reduced image is made averaging
+    factor x factor pixel blocks of img and is saved with the same file
+    name as filepath in that sub-folder next to it. The thumbs folder is
+    the one cajal.gallery.create_gallery uses by default.
+
+    @return: list of strings
+    The paths of all the saved images, starting with filepath.
+    """
+    skio.imsave(filepath, img)
+    paths = [filepath]
+
+    if not pyramid:
+        return paths
+
+    #each level is reduced from the largest previous one it is a multiple of
+    levels = [(1, img)]
+    for subdir, factor in sorted(pyramid.items(), key=lambda item: item[1]):
+        src_factor, src_img = [level for level in levels if factor % level[0] == 0][-1]
+        level_img = area_downscale(src_img, factor // src_factor)
+        levels.append((factor, level_img))
+
+        level_path = os.path.join(os.path.dirname(filepath), subdir,
+                                  os.path.basename(filepath))
+        # the workers of a parallel run may create it at the same time
+        os.makedirs(os.path.dirname(level_path), exist_ok=True)
+
+        skio.imsave(level_path, level_img)
+        paths.append(level_path)
+
+    return paths
+
+
+def slicesdir_oneset(output_dir, file_list1, dpi=150, n_jobs=None,
+                     executor=None, resume=False, gallery=None, frame='middle',
+                     volaxes=None, combine_axes=True, cache=None,
+                     **kwargs):
     """
     Creates a folder with a html file and png images of slices
     of each of nifti file in file_list1.
@@ -315,49 +918,72 @@ def slicesdir_oneset(output_dir, file_list1, dpi=150, **kwargs):
 
     @param file_list1: list of strings
     Paths to the background image, can be either 3D or 4D images.
-    If they are 4D images, will pick one of the center.
-
-    @param file_list2: list of strings
-    Paths to the overlay images, must be 3D images.
+    If they are 4D images, will pick one of the center, or the one
+    given by frame.
+
+    @param n_jobs: int, optional
+    Number of worker processes to render the subjects with.
+    None or 1 renders them serially in this process, -1 uses all CPUs.
+    In parallel mode a subject that fails is logged and left out of the
+    index instead of stopping the whole run.
+
+    @param executor: concurrent.futures.Executor, optional
+    Running executor to submit the subjects to, instead of creating a
+    process pool with n_jobs workers.
+
+    @param resume: bool, optional
+    If True, will keep a manifest of the rendered images in output_dir
+    and skip the subjects whose input files and rendering arguments did not
+    change since their image was made. See cajal.manifest.RenderManifest.
+
+    @param gallery: bool or dict, optional
+    If given, will write a paginated gallery with thumbnails instead of a
+    single index.html with all the images. A dict is passed as arguments
+    to cajal.gallery.create_gallery.
+
+    @param frame: int, 'middle' or 'mean', optional
+    Volume of the 4D images to show: its index, the one at the center of
+    the series, or the temporal mean. Only that frame is read from the
+    files, see cajal.plot_volume.read_volume_frame.
+
+    @param volaxes: list of int, optional
+    If given, e.g., [0, 1, 2], will make the mosaics across all these axes
+    from one read of each file, sharing their color limits, instead of
+    only the one across volaxis.
+
+    @param combine_axes: bool, optional
+    If True, the mosaics of volaxes of each subject are stacked into one
+    image. Otherwise each is saved in its own file, with an _axis<N>
+    suffix in its name.
+
+    @param cache: bool or string, optional
+    Cache of decompressed copies of the .nii.gz files, so the next runs
+    over the same files do not decompress them again: True for the default
+    one or the path to its folder. See cajal.volume_cache.DecompressionCache.
 
     @param kwargs: arguments to show_many_slices
     See macuto.render.show_many_slices docstring.
+    It can also include engine='numpy' to compose the images with
+    cajal.mosaic.render_many_slices, much faster for large batches.
+    With pyramid={'thumbs': 8, 'medium': 2} it will also save reduced
+    versions of each image in those sub-folders, see save_image.
 
     @return:
     """
     assert(len(file_list1) > 0)
 
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-
-    img_files = []
-
-    show_colorbar = kwargs.pop('show_colorbar', False)
+    kwargs['show_colorbar'] = kwargs.pop('show_colorbar', False)
 
-    #CREATE separate images of each file_list2 file
-    # on the corresponding file_list1 file
-    for idx in list(range(len(file_list1))):
-        f1_vol = get_nii_data(file_list1[idx])
-
-        if len(f1_vol.shape) > 3:
-            f1_vol = f1_vol[..., int(np.floor(f1_vol.shape[3]/2))]
-
-        fig = show_many_slices(f1_vol, show_colorbar=show_colorbar, **kwargs)
-
-        png_fname = os.path.relpath(remove_ext(file_list1[idx]))
-        png_fname = png_fname.replace('.', '').replace('/', '_').replace('__', '') + '.png'
-        png_path = os.path.join(output_dir, png_fname)
+    kwargs['dpi'] = dpi
+    kwargs['frame'] = frame
+    kwargs['volaxes'] = volaxes
+    kwargs['combine_axes'] = combine_axes
+    jobs = [((_slicesdir_png_path(output_dir, file_list1[idx]),
+              file_list1[idx], None), kwargs)
+            for idx in list(range(len(file_list1)))]
 
-        export_figure(fig, png_path, dpi=dpi)
-
-        plt.close(fig)
-
-        img_files.append(os.path.basename(png_path))
-
-    #Create the index.html file with all images
-    create_imglist_html(output_dir, img_files)
-
-    return img_files
+    return _run_slicesdir(output_dir, jobs, n_jobs=n_jobs, executor=executor,
+                          resume=resume, gallery=gallery, cache=cache)
 
 
 def show_3slices(vol, vol2=None, x=None, y=None, z=None, fig=None,
@@ -377,94 +1003,163 @@ def show_3slices(vol, vol2=None, x=None, y=None, z=None, fig=None,
 
     @return: matplotlib figure
     """
+    viewer = OrthoSlicesViewer(vol, vol2, x=x, y=y, z=z, fig=fig,
+                               vol2_colormap=vol2_colormap,
+                               vol2_transp_val=vol2_transp_val,
+                               interpolation=interpolation)
+    viewer.show()
 
-    assert vol.shape == vol2.shape, 'vol do not have the same shape as vol2'
-
-    if not x:
-        x = np.floor(vol.shape[0]/2)
-    if not y:
-        y = np.floor(vol.shape[1]/2)
-    if not z:
-        z = np.floor(vol.shape[2]/2)
-
-    if not fig:
-        fig = plt.figure()
-    else:
-        fig = plt.figure(fig.number)
-
-    try:
-        if not np.ma.is_masked(vol2):
-            vol2 = np.ma.masked_equal(vol2, vol2_transp_val)
-    except:
-        pass
+    return viewer.fig
 
-    if vol2_colormap is None:
-        vol2_colormap = plt.cm.hot
 
-    plt.subplot (2, 2, 1)
-    plt.axis('off')
-    plt.imshow(np.rot90(vol[x, ...]), cmap=plt.cm.gray, interpolation=interpolation)
-    try:
-        plt.imshow(np.rot90(vol2[x, ...]), cmap=vol2_colormap, interpolation=interpolation)
-    except:
-        pass
-    #plt.imshow(vol[x,...], cmap=plt.cm.gray)
-    plt.title ('X:' + str(int(x)))
-
-    plt.subplot (2, 2, 2)
-    plt.axis('off')
-    plt.imshow(np.rot90(vol[:, y, :]), cmap=plt.cm.gray, interpolation=interpolation)
-    try:
-        plt.imshow(np.rot90(vol2[:, y, :]), cmap=vol2_colormap, interpolation=interpolation)
-    except:
-        pass
+class OrthoSlicesViewer(object):
+    """
+    Three orthogonal slices of a volume, and optionally of an overlay
+    volume, with one slider for each axis.
 
-    plt.title ('Y:' + str(int(y)))
+    The subplots, images and sliders are created once. Moving a slider
+    only changes the data of the images of that axis and asks for a redraw
+    when the GUI is idle, and the slices are kept in a small cache so going
+    back and forth over them is fast.
 
-    plt.subplot (2, 2, 3)
-    plt.axis ('off')
-    plt.imshow(np.rot90(vol[..., z]), cmap=plt.cm.gray, interpolation=interpolation)
-    try:
-        plt.imshow(np.rot90(vol2[..., z]), cmap=vol2_colormap, interpolation=interpolation)
-    except:
-        pass
-    plt.title ('Z:' + str(int(z)))
+    @param vol: numpy 3D array
+    @param vol2: numpy 3D array, optional
+    @param x: int
+    @param y: int
+    @param z: int
+    @param fig: matplotlib Figure
+    @param vol2_colormap: matplotlib colormap
+    @param vol2_transp_val: scalar
+    Volume2 transparent value
 
-    plt.subplot (2, 2, 4)
+    @param interpolation: string
 
-    plt.axis('off')
-    axcolor = 'lightgoldenrodyellow'
-    xval = plt.axes([0.60, 0.20, 0.20, 0.03], axisbg=axcolor)
-    yval = plt.axes([0.60, 0.15, 0.20, 0.03], axisbg=axcolor)
-    zval = plt.axes([0.60, 0.10, 0.20, 0.03], axisbg=axcolor)
+    @param cache_bytes: int
+    Maximum size in bytes of the slices kept in the cache.
+    """
+    def __init__(self, vol, vol2=None, x=None, y=None, z=None, fig=None,
+                 vol2_colormap=None, vol2_transp_val=0,
+                 interpolation='nearest', cache_bytes=64 * 1024 * 1024):
 
-    xsli = Slider(xval, 'X', 0, vol.shape[0]-1, valinit=x, valfmt='%i')
-    ysli = Slider(yval, 'Y', 0, vol.shape[1]-1, valinit=y, valfmt='%i')
-    zsli = Slider(zval, 'Z', 0, vol.shape[2]-1, valinit=z, valfmt='%i')
+        if vol2 is not None:
+            assert vol.shape == vol2.shape, 'vol do not have the same shape as vol2'
+            if not np.ma.is_masked(vol2):
+                vol2 = np.ma.masked_equal(vol2, vol2_transp_val)
 
-    def update(val):
-        x = np.around(xsli.val)
-        y = np.around(ysli.val)
-        z = np.around(zsli.val)
-        #debug_here()
-        show_3slices(vol, vol2, x, y, z, fig)
-        #fig.set_data()
+        if vol2_colormap is None:
+            vol2_colormap = plt.cm.hot
 
-    xsli.on_changed(update)
-    ysli.on_changed(update)
-    zsli.on_changed(update)
+        self.vols   = [vol, vol2]
+        self._cache = SliceCache(cache_bytes)
 
-    plt.show()
+        self.position = []
+        for axis, idx in enumerate([x, y, z]):
+            if idx is None:
+                idx = np.floor(vol.shape[axis]/2)
+            self.position.append(int(idx))
 
-    return fig
+        if not fig:
+            fig = plt.figure()
+        else:
+            fig = plt.figure(fig.number)
+        self.fig = fig
+
+        clims = [(vol.min(), vol.max())]
+        if vol2 is not None and vol2.count():
+            clims.append((vol2.min(), vol2.max()))
+
+        self._axes   = []
+        self._images = []
+        for axis in range(3):
+            ax = fig.add_subplot(2, 2, axis + 1)
+            ax.axis('off')
+
+            images = []
+            for which, cmap in enumerate([plt.cm.gray, vol2_colormap]):
+                if self.vols[which] is None:
+                    continue
+                im = ax.imshow(self.get_slice(axis, self.position[axis], which),
+                               cmap=cmap, interpolation=interpolation)
+                if which < len(clims):
+                    im.set_clim(*clims[which])
+                images.append(im)
+
+            self._axes.append(ax)
+            self._images.append(images)
+            self._set_title(axis)
+
+        ax = fig.add_subplot(2, 2, 4)
+        ax.axis('off')
+
+        axcolor = 'lightgoldenrodyellow'
+        self.sliders = []
+        for axis, (name, bottom) in enumerate(zip('XYZ', [0.20, 0.15, 0.10])):
+            slider_ax = fig.add_axes([0.60, bottom, 0.20, 0.03], facecolor=axcolor)
+            slider = Slider(slider_ax, name, 0, vol.shape[axis] - 1,
+                            valinit=self.position[axis], valfmt='%i')
+            slider.on_changed(self._slider_callback(axis))
+            self.sliders.append(slider)
+
+        #keep the viewer alive as long as its figure, for the slider callbacks
+        fig.ortho_slices_viewer = self
+
+    def get_slice(self, axis, idx, which=0):
+        """
+        Return the rotated slice idx across axis of the volume (which=0)
+        or of the overlay (which=1), going through the cache.
+
+        @param axis: int
+        @param idx: int
+        @param which: int
+
+        @return: ndarray
+        """
+        key = (which, axis, idx)
+        img = self._cache.get(key)
+        if img is None:
+            img = self._cache.put(key, np.rot90(self.vols[which].take(idx, axis=axis)))
+
+        return img
+
+    def set_slice(self, axis, idx):
+        """
+        Show the slice idx across axis.
+
+        @param axis: int
+        @param idx: int
+        """
+        idx = int(np.clip(np.around(idx), 0, self.vols[0].shape[axis] - 1))
+        if idx == self.position[axis]:
+            return
+
+        self.position[axis] = idx
+        for which, im in enumerate(self._images[axis]):
+            im.set_data(self.get_slice(axis, idx, which))
+
+        self._set_title(axis)
+        self.fig.canvas.draw_idle()
+
+    def show(self):
+        plt.show()
+
+    def _set_title(self, axis):
+        self._axes[axis].set_title('XYZ'[axis] + ':' + str(self.position[axis]))
+
+    def _slider_callback(self, axis):
+        def update(val):
+            self.set_slice(axis, val)
+        return update
 
 
 def slicesdir_connectivity_matrices(output_dir, cmat_list, dpi=150,
-                                    lower_triangle=True, **kwargs):
+                                    lower_triangle=True, engine='matplotlib',
+                                    n_jobs=None, executor=None, gallery=None,
+                                    deep_zoom=False, **kwargs):
     """
     @param output_dir:
     @param file_list1: list of ndarrays
-    List of connectivity matrices
+    List of connectivity matrices, which can be scipy.sparse matrices,
+    or an ndarray or numpy.memmap stack of shape (n_matrices, n, n).
 
     @param dpi: int
     Dots per inch resolution of the plot images
@@ -473,6 +1168,26 @@ def slicesdir_connectivity_matrices(output_dir, cmat_list, dpi=150,
     If true, will plot a lower triangle of the matrix,
     the full matrix otherwise.
 
+    @param engine: string
+    'matplotlib' to draw each matrix in a figure with
+    drawmatrix_channels or draw_square_matrix_channels, or
+    'numpy' to compose the images with cajal.matrix.matrix_to_rgba, which
+    is much faster but does not write the channel names nor the colorbar
+    ticks and uses its zoom argument instead of dpi and size.
+
+    @param n_jobs: int, optional
+    Number of worker processes, see cajal.utils.parallel.effective_n_jobs.
+    The matrices of a memmap stack are mapped by each worker instead of
+    being copied to it.
+
+    @param executor: concurrent.futures.Executor, optional
+    @param gallery: bool or dict, optional
+    See slicesdir_paired_overlays.
+
+    @param deep_zoom: bool, optional
+    If True, will also write a Deep Zoom tile pyramid of each matrix at one
+    pixel per cell, connectivity_matrix<N>.dzi, see cajal.matrix.write_deep_zoom.
+
     @param kwargs: arguments to show_many_slices
     See draw_square_matrix_channels named arguments.
     """
@@ -480,44 +1195,99 @@ def slicesdir_connectivity_matrices(output_dir, cmat_list, dpi=150,
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    img_files = []
-
     #cmap = kwargs.pop('cmap', plt.cm.rainbow)
-    channel_names = kwargs.pop('channel_names', None)
-    color_anchor = kwargs.pop('color_anchor', 0)
-    size = kwargs.pop('size', [10., 10.])
+    kwargs.setdefault('color_anchor', 0)
+    if engine == 'matplotlib':
+        kwargs.setdefault('channel_names', None)
+        kwargs.setdefault('size', [10., 10.])
 
-    #CREATE separate images of each file_list2 file
-    # on the corresponding file_list1 file
-    for idx in list(range(len(cmat_list))):
-        cmat = cmat_list[idx]
+    is_parallel = executor is not None or effective_n_jobs(n_jobs) > 1
+    send_references = is_parallel and isinstance(cmat_list, np.memmap)
 
-        if lower_triangle:
-            fig = drawmatrix_channels(cmat, channel_names, size=size,
-                                      color_anchor=color_anchor, **kwargs)
-        else:
-            fig = draw_square_matrix_channels(cmat, channel_names, size=size,
-                                              color_anchor=color_anchor,
-                                              **kwargs)
+    jobs = []
+    for idx in list(range(len(cmat_list))):
+        cmat = None
+        if send_references:
+            cmat = memmap_reference(cmat_list, idx)
+        if cmat is None:
+            cmat = cmat_list[idx]
 
         png_fname = 'connectivity_matrix' + str(idx) + '.png'
         png_path = os.path.join(output_dir, png_fname)
 
-        export_figure(fig, png_path, dpi=dpi)
+        jobs.append(((png_path, cmat, lower_triangle, dpi, engine, deep_zoom),
+                     kwargs))
 
-        img_files.append(os.path.basename(png_path))
+    img_files = [png_name for _, png_name in
+                 imap_ordered(_render_connectivity_matrix, jobs, n_jobs=n_jobs,
+                              executor=executor, skip_errors=is_parallel)]
 
-        plt.close()
+    if len(img_files) < len(jobs):
+        log.error('Could not render {} of {} matrices, see the log '
+                  'for details.'.format(len(jobs) - len(img_files), len(jobs)))
 
     #Create the index.html file with all images
-    create_imglist_html(output_dir, img_files)
+    write_index(output_dir, img_files, gallery=gallery)
 
     return img_files
 
 
+def _render_connectivity_matrix(png_path, cmat, lower_triangle=True, dpi=150,
+                                engine='matplotlib', deep_zoom=False, **kwargs):
+    """
+    Render one connectivity matrix into png_path.
+    This is the unit of work of slicesdir_connectivity_matrices.
+
+    @param cmat: ndarray or tuple
+    The matrix or a cajal.matrix.memmap_reference to it.
+
+    @return: string
+    The base name of png_path.
+    """
+    cmat = load_matrix(cmat)
+
+    if deep_zoom:
+        write_deep_zoom(os.path.dirname(png_path),
+                        remove_ext(os.path.basename(png_path)), cmat,
+                        lower_triangle_only=lower_triangle,
+                        cmap=kwargs.get('cmap', 'RdBu_r'),
+                        color_anchor=kwargs.get('color_anchor', 0),
+                        reduce_method=kwargs.get('reduce_method', 'mean'))
+
+    if engine == 'numpy':
+        kwargs.pop('channel_names', None)
+        kwargs.pop('size', None)
+        kwargs.pop('title', None)
+        kwargs.pop('x_tick_rot', None)
+        img = matrix_to_rgba(cmat, lower_triangle_only=lower_triangle, **kwargs)
+        save_image(png_path, autocrop_img(img))
+        return os.path.basename(png_path)
+
+    if engine != 'matplotlib':
+        raise ValueError('Unknown rendering engine {}.'.format(engine))
+
+    if plt.get_backend().lower() != 'agg' and _is_worker_process():
+        plt.switch_backend('Agg')
+
+    channel_names = kwargs.pop('channel_names', None)
+    if lower_triangle:
+        kwargs.pop('reduce_method', None)
+        kwargs.pop('max_size', None)
+        fig = drawmatrix_channels(dense_matrix(cmat), channel_names, **kwargs)
+    else:
+        fig = draw_square_matrix_channels(cmat, channel_names, dpi=dpi, **kwargs)
+
+    export_figure(fig, png_path, dpi=dpi)
+    plt.close(fig)
+
+    return os.path.basename(png_path)
+
+
 def draw_square_matrix_channels(in_m, channel_names=None, fig=None,
                                 x_tick_rot=None, size=None, cmap=plt.cm.RdBu_r,
-                                colorbar=True, color_anchor=None, title=None):
+                                colorbar=True, color_anchor=None, title=None,
+                                max_size=None, reduce_method='mean',
+                                label_fontsize=6, dpi=None):
     """
     Copied from nitime.plotting import drawmatrix_channels
 
@@ -525,8 +1295,9 @@ def draw_square_matrix_channels(in_m, channel_names=None, fig=None,
     This is the typical format to show a symmetrical bivariate quantity (such as
     correlation or coherence between two different ROIs).
 
-    @param cmat: nxn array
-    with values of relationships between two sets of rois or channels
+    @param cmat: nxn array or scipy.sparse matrix
+    with values of relationships between two sets of rois or channels.
+    Sparse matrices are only made dense after being reduced to max_size.
 
     @param channel_names (optional): list of strings
     with the labels to be applied to the channels in the input.
@@ -546,17 +1317,27 @@ def draw_square_matrix_channels(in_m, channel_names=None, fig=None,
         if 0, min and max of colormap correspond to max of abs(in_m)
         if (a,b), min and max of colormap correspond to (a,b)
 
-    @return: fig
-    a figure object
-    """
+    @param max_size (optional): int, 'auto' or None
+    If the matrix has more rows than this, its cells are pooled in blocks
+    with reduce_method to fit in max_size x max_size cells, see
+    cajal.matrix.block_reduce_matrix. 'auto' is the pixel size of the figure
+    at dpi, None, the default, shows every cell.
+    The channel names are not shown when the matrix is reduced.
 
-    N = in_m.shape[0]
-    ind = np.arange(N)  # the evenly spaced plot indices
+    @param reduce_method (optional): string
+    'mean', 'max' or 'absmax'.
 
-    def channel_formatter(x):
-        thisind = np.clip(int(x), 0, N - 1)
-        return channel_names[thisind]
+    @param label_fontsize (optional): int
+    Font size of the channel names. They are only written if the matrix
+    cells are at least this tall in points.
+
+    @param dpi (optional): int
+    Resolution the figure will be saved with, for max_size='auto'.
+    By default the one of fig.
 
+    @return: fig
+    a figure object
+    """
     if fig is None:
         fig = plt.figure()
 
@@ -567,8 +1348,38 @@ def draw_square_matrix_channels(in_m, channel_names=None, fig=None,
     w = fig.get_figwidth()
     h = fig.get_figheight()
 
+    if max_size == 'auto':
+        max_size = int(max(w, h) * (dpi or fig.dpi))
+
+    factor = 1
+    if max_size is not None:
+        factor = reduction_factor(in_m.shape[0], max_size)
+
+    if factor > 1:
+        log.debug('Pooling the {0}x{0} matrix in blocks of {1}x{1} '
+                  'cells.'.format(in_m.shape[0], factor))
+        in_m = block_reduce_matrix(in_m, factor, reduce_method)
+        channel_names = None
+
+    in_m = dense_matrix(in_m)
+
+    N = in_m.shape[0]
+    ind = np.arange(N)  # the evenly spaced plot indices
+
+    def channel_formatter(x):
+        thisind = np.clip(int(x), 0, N - 1)
+        return channel_names[thisind]
+
     ax_im = fig.add_subplot(1, 1, 1)
 
+    #Only write the channel names if they fit in the cells
+    if channel_names is not None:
+        cell_height = ax_im.get_position().height * h * 72. / N
+        if cell_height < label_fontsize:
+            log.debug('Not writing the channel names, the cells are {:.1f} '
+                      'points tall.'.format(cell_height))
+            channel_names = None
+
     #If you want to draw the colorbar:
     if colorbar:
         divider = make_axes_locatable(ax_im)
@@ -620,7 +1431,7 @@ def draw_square_matrix_channels(in_m, channel_names=None, fig=None,
             if i > 0:
                 ax.text(-1, i - 1, channel_names[i],
                         horizontalalignment='right',
-                        fontsize=6,
+                        fontsize=label_fontsize,
                         linespacing=4.)
 
         ax.set_axis_off()
@@ -675,59 +1486,211 @@ def draw_square_matrix_channels(in_m, channel_names=None, fig=None,
 #-------------------------------------------------------------------------------
 # Mayavi2 options
 #-------------------------------------------------------------------------------
+# Full resolution data of the sources made with volume_scalar_field
+_LOD_SOURCES = weakref.WeakKeyDictionary()
+
+
+def volume_scalar_field(vol, lod=0, crop=True, background=0):
+    """
+    Return a mayavi scalar field source of vol, optionally cropped to its
+    content and block-downsampled, placed so it keeps the voxel coordinates
+    of vol.
+
+    @param vol: numpy 3d array
+
+    @param lod: int
+    Level of detail, each level above 0 halves the resolution averaging
+    blocks of voxels, see cajal.utils.image.block_downsample.
+    Use save_full_resolution_snapshot to save images at full resolution.
+
+    @param crop: bool
+    If True, only the bounding box of the voxels different from background
+    is sent to VTK.
+
+    @param background: scalar
+
+    @return: mayavi ArraySource
+    """
+    from mayavi import mlab
+
+    start = np.zeros(3)
+    if crop:
+        bounds = volume_bounds(vol, background=background)
+        if bounds is not None:
+            vol = vol[tuple(slice(a, b) for a, b in bounds)]
+            start = np.array([a for a, _ in bounds], dtype=float)
+
+    factor = 2 ** int(lod)
+    data = block_downsample(vol, factor) if factor > 1 else vol
+
+    src = mlab.pipeline.scalar_field(data)
+    # the center of the first block, in voxels of the original volume
+    src.origin = start + (factor - 1) / 2.
+    src.spacing = np.ones(3) * factor
+
+    if factor > 1:
+        _LOD_SOURCES[src] = (vol, start)
+
+    return src
+
+
+def _source_index(src, axis, index):
+    """
+    Return the index in the data of src of the slice index of the
+    original volume along axis.
+    """
+    n_slices = src.scalar_data.shape[axis]
+    idx = int((index - src.origin[axis]) / src.spacing[axis] + 0.5)
+    return int(np.clip(idx, 0, n_slices - 1))
+
+
+def _plane_widgets(src):
+    for module_manager in src.children:
+        for module in module_manager.children:
+            if hasattr(module, 'ipw'):
+                yield module
+
+
+def save_full_resolution_snapshot(filepath, **kwargs):
+    """
+    Save the current mayavi scene into filepath with the full resolution
+    data in the sources made with volume_scalar_field, then go back to
+    their reduced data for interaction.
+
+    @param filepath: string
+    @param kwargs: arguments to mayavi.mlab.savefig
+    """
+    from mayavi import mlab
+
+    swapped = []
+    for src, (full_data, start) in list(_LOD_SOURCES.items()):
+        planes = [(plane, plane.ipw.slice_position) for plane in _plane_widgets(src)]
+        swapped.append((src, src.scalar_data, src.origin, src.spacing, planes))
+
+        src.scalar_data = full_data
+        src.origin = start
+        src.spacing = np.ones(3)
+        for plane, position in planes:
+            plane.ipw.slice_position = position
+
+    try:
+        mlab.savefig(filepath, **kwargs)
+    finally:
+        for src, data, origin, spacing, planes in swapped:
+            src.scalar_data = data
+            src.origin = origin
+            src.spacing = spacing
+            for plane, position in planes:
+                plane.ipw.slice_position = position
+
+
 def show_cutplanes (vol, first_idx=10, second_idx=10,
-                    first_plane='x_axes', second_plane='y_axes'):
+                    first_plane='x_axes', second_plane='y_axes',
+                    lod=0, crop=True):
     """
     @param vol: numpy 3d array
     @param first_idx: int
     @param second_idx: int
     @param first_plane: string
     @param second_plane: string
+
+    @param lod: int
+    @param crop: bool
+    See volume_scalar_field.
     """
     from mayavi import mlab
 
-    mlab.pipeline.image_plane_widget(mlab.pipeline.scalar_field(vol),
+    src = volume_scalar_field(vol, lod=lod, crop=crop)
+    axes = {'x_axes': 0, 'y_axes': 1, 'z_axes': 2}
+
+    mlab.pipeline.image_plane_widget(src,
                             plane_orientation=first_plane,
-                            slice_index=first_idx,
+                            slice_index=_source_index(src, axes[first_plane], first_idx),
                             colormap='gray')
 
-    mlab.pipeline.image_plane_widget(mlab.pipeline.scalar_field(vol),
+    mlab.pipeline.image_plane_widget(src,
                             plane_orientation=second_plane,
-                            slice_index=second_idx,
+                            slice_index=_source_index(src, axes[second_plane], second_idx),
                             colormap='gray')
 
     mlab.outline()
 
 
-def show_dynplane(vol):
+def show_dynplane(vol, lod=0, mesh_cache=True, crop=True):
     """
     @param vol: numpy 3d array
+
+    @param lod: int
+    Level of detail of the iso-surface, see cajal.mesh.iso_surface_mesh,
+    and of the image plane, see volume_scalar_field.
+
+    @param mesh_cache: cajal.mesh.MeshCache or bool
+    Cache of the iso-surface mesh, see cajal.mesh.iso_surface_mesh.
+
+    @param crop: bool
+    See volume_scalar_field.
     """
     from mayavi import mlab
-    src = mlab.pipeline.scalar_field(vol)
-    mlab.pipeline.iso_surface(src, contours=[vol.min()+0.1*vol.ptp(), ],
-                              opacity=0.1)
+    from .mesh import show_iso_surface
+
+    src = volume_scalar_field(vol, lod=lod, crop=crop)
+    show_iso_surface(vol, level_fraction=0.1, lod=lod, cache=mesh_cache,
+                     opacity=0.1)
     #mlab.pipeline.iso_surface(src, contours=[vol.max()-0.1*vol.ptp(), ],)
     mlab.pipeline.image_plane_widget(src,
                             plane_orientation='z_axes',
-                            slice_index=10,
+                            slice_index=_source_index(src, 2, 10),
                             colormap='gray')
 
 
-def show_contour(vol):
+def show_contour(vol, contours=5, lod=0, mesh_cache=True):
     """
     @param vol: numpy 3d array
-    """
-    from mayavi import mlab
-    mlab.contour3d(vol, colormap='gray')
 
+    @param contours: int
+    Number of iso-surfaces, evenly spaced between the minimum and the
+    maximum of vol, as mayavi.mlab.contour3d does.
+
+    @param lod: int
+    Level of detail of the iso-surfaces, see cajal.mesh.iso_surface_mesh.
 
-def show_render(vol, vmin=0, vmax=0.8):
+    @param mesh_cache: cajal.mesh.MeshCache or bool
+    Cache of the iso-surface meshes, see cajal.mesh.iso_surface_mesh.
+    """
+    from .mesh import iso_surface_mesh, show_mesh, volume_digest, MeshCache
+
+    vmin, vmax = float(np.nanmin(vol)), float(np.nanmax(vol))
+    if vmax <= vmin:
+        log.warning('The volume is constant, there is no contour to show.')
+        return
+
+    if mesh_cache is True:
+        mesh_cache = MeshCache()
+    digest = volume_digest(vol) if mesh_cache else None
+
+    gray = plt.get_cmap('gray')
+    for level in np.linspace(vmin, vmax, contours + 2)[1:-1]:
+        try:
+            vertices, faces = iso_surface_mesh(vol, level=level, lod=lod,
+                                               cache=mesh_cache, digest=digest)
+        except (ValueError, RuntimeError) as exc:
+            # marching cubes raises when no surface is found at a level
+            log.debug('No contour at {}: {}'.format(level, exc))
+            continue
+        color = gray((level - vmin) / (vmax - vmin))[:3]
+        show_mesh(vertices, faces, color=tuple(color))
+
+
+def show_render(vol, vmin=0, vmax=0.8, lod=0, crop=True):
     """
     @param vol: numpy 3d array
     @param vmin: float
     @param vmax: float
+
+    @param lod: int
+    @param crop: bool
+    See volume_scalar_field.
     """
     from mayavi import mlab
-    mlab.pipeline.volume(mlab.pipeline.scalar_field(vol), vmin=vmin, vmax=vmax,
-                         colormap='gray')
+    mlab.pipeline.volume(volume_scalar_field(vol, lod=lod, crop=crop),
+                         vmin=vmin, vmax=vmax, colormap='gray')
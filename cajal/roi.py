@@ -55,6 +55,60 @@ def drain_rois(img_data):
     return out
 
 
+def get_rois_outline(vol, axis=None, background=0):
+    """
+    Return a volume with only the outline voxels of each ROI in vol,
+    keeping their values, so a multi-label volume keeps its labels.
+
+    A voxel is in the outline if it is not background and one of its
+    neighbours, or the border of the volume, is next to it with a different
+    value. The whole volume is processed at once comparing shifted views of
+    it along each axis.
+
+    @param vol: numpy array
+    Label volume.
+
+    @param axis: int, optional
+    If given, the neighbours along this axis are not compared, so the
+    outlines are the 2D contours of the ROIs in each slice across axis.
+
+    @param background: scalar
+    Value of the voxels out of any ROI.
+
+    @return:
+    an array of same shape and dtype as vol
+    """
+    vol  = np.asarray(vol)
+    edge = np.zeros(vol.shape, dtype=bool)
+
+    for ax in range(vol.ndim):
+        if axis is not None and ax == axis % vol.ndim:
+            continue
+
+        lower = [slice(None)] * vol.ndim
+        upper = [slice(None)] * vol.ndim
+        lower[ax] = slice(None, -1)
+        upper[ax] = slice(1, None)
+        lower, upper = tuple(lower), tuple(upper)
+
+        diff = vol[lower] != vol[upper]
+        edge[lower] |= diff
+        edge[upper] |= diff
+
+        #the ROIs touching the volume border are closed there
+        first = [slice(None)] * vol.ndim
+        last  = [slice(None)] * vol.ndim
+        first[ax], last[ax] = 0, -1
+        edge[tuple(first)] = True
+        edge[tuple(last)]  = True
+
+    edge &= vol != background
+
+    out = np.full(vol.shape, background, dtype=vol.dtype)
+    out[edge] = vol[edge]
+    return out
+
+
 def create_rois_mask(roislist, filelist):
     """
     Looks for the files in filelist containing the names
@@ -137,18 +191,120 @@ def get_rois_centers_of_mass(vol):
     :return: OrderedDict
 
     """
-    from scipy.ndimage.measurements import center_of_mass
-
-    roisvals = np.unique(vol)
-    roisvals = roisvals[roisvals != 0]
+    stats = get_rois_statistics(vol)
 
     rois_centers = OrderedDict()
-    for r in roisvals:
-        rois_centers[r] = center_of_mass(vol, vol, r)
+    for r, center in zip(stats['labels'], stats['centroids']):
+        rois_centers[r] = tuple(center)
 
     return rois_centers
 
 
+def _label_indices(values):
+    """
+    Return the sorted unique values and the index of each value among them.
+    Integer labels are counted with bincount instead of sorted when their
+    range is not much larger than the number of values.
+    """
+    if np.issubdtype(values.dtype, np.integer) and len(values):
+        lowest = int(values.min())
+        span = int(values.max()) - lowest + 1
+        if span <= max(2 * len(values), 1 << 16):
+            offsets = (values - lowest).astype(np.intp)
+            present = np.bincount(offsets, minlength=span) > 0
+            lookup = np.cumsum(present) - 1
+            labels = (np.flatnonzero(present) + lowest).astype(values.dtype)
+            return labels, lookup[offsets]
+
+    return np.unique(values, return_inverse=True)
+
+
+def get_rois_statistics(vol, image=None, affine=None, background=0):
+    """
+    Compute the voxel count, centroid and bounding box of every ROI in vol,
+    and optionally the intensity statistics of image in each ROI, with one
+    pass over the voxels.
+
+    @param vol: numpy ndarray
+    Label volume.
+
+    @param image: numpy ndarray, optional
+    Volume of the same shape as vol.
+
+    @param affine: numpy ndarray, optional
+    4x4 voxel to world transform, e.g., the affine of a nibabel image,
+    to compute the centroids in world coordinates (mm). Only for 3D vol.
+
+    @param background: scalar
+    Value of the voxels out of any ROI.
+
+    @return: OrderedDict
+    With arrays of one row for each ROI, in the order of 'labels':
+    - 'labels': ROI values, sorted.
+    - 'counts': number of voxels.
+    - 'centroids': (n_rois, vol.ndim) centers of mass in voxel coordinates.
+    - 'centroids_mm': same in world coordinates, only if affine is given.
+    - 'bbox_min', 'bbox_max': (n_rois, vol.ndim) first and last voxel index
+    of each ROI along each axis, both inclusive.
+    - 'mean', 'min', 'max': intensities of image, only if image is given.
+    """
+    vol = np.asarray(vol)
+    if affine is not None:
+        assert(vol.ndim == 3)
+
+    flat = vol.ravel()
+
+    voxels = np.flatnonzero(flat != background)
+    labels, label_idx = _label_indices(flat[voxels])
+    n_rois = len(labels)
+
+    counts = np.bincount(label_idx, minlength=n_rois)
+
+    stats = OrderedDict()
+    stats['labels'] = labels
+    stats['counts'] = counts
+
+    centroids = np.zeros((n_rois, vol.ndim))
+    bbox_min  = np.zeros((n_rois, vol.ndim), dtype=int)
+    bbox_max  = np.zeros((n_rois, vol.ndim), dtype=int)
+    for ax, coords in enumerate(np.unravel_index(voxels, vol.shape)):
+        centroids[:, ax] = np.bincount(label_idx, weights=coords,
+                                       minlength=n_rois) / np.maximum(counts, 1)
+
+        #which slices along ax each ROI touches
+        size = vol.shape[ax]
+        present = np.bincount(label_idx * size + coords, minlength=n_rois * size)
+        present = present.reshape((n_rois, size)) > 0
+        bbox_min[:, ax] = np.argmax(present, axis=1)
+        bbox_max[:, ax] = size - 1 - np.argmax(present[:, ::-1], axis=1)
+
+    stats['centroids'] = centroids
+
+    if affine is not None:
+        affine = np.asarray(affine)
+        stats['centroids_mm'] = centroids.dot(affine[:3, :3].T) + affine[:3, 3]
+
+    stats['bbox_min'] = bbox_min
+    stats['bbox_max'] = bbox_max
+
+    if image is not None:
+        image = np.asarray(image)
+        assert(image.shape == vol.shape)
+
+        values = image.ravel()[voxels]
+        stats['mean'] = np.bincount(label_idx, weights=values,
+                                    minlength=n_rois) / np.maximum(counts, 1)
+
+        #sorting by label and value, each ROI is a run of its sorted values
+        order  = np.lexsort((values, label_idx))
+        values = values[order]
+        starts = np.cumsum(counts) - counts
+        stats['min'] = values[starts]
+        stats['max'] = values[starts + counts - 1]
+
+    return stats
+
+
 def extract_timeseries_dict(tsvol, roivol, maskvol=None, roi_list=None):
     """
     Partitions the timeseries in tsvol according to the
@@ -0,0 +1,466 @@
+# coding=utf-8
+#-------------------------------------------------------------------------------
+# License: BSD 3 clause
+#-------------------------------------------------------------------------------
+
+import numpy as np
+
+
+def colormap_lut(cmap=None, n_colors=None):
+    """
+    Return the lookup table of a colormap as an uint8 RGBA array.
+
+    @param cmap: matplotlib colormap, string or ndarray
+    A matplotlib colormap, the name of one, or an array of N colors
+    with 3 or 4 columns, either float in [0, 1] or uint8.
+    If None, will use the gray colormap.
+
+    @param n_colors: int, optional
+    Number of entries of the table. By default the number of colors
+    of the colormap.
+
+    @return: ndarray
+    Array of shape (N, 4) and dtype uint8.
+    """
+    if isinstance(cmap, np.ndarray):
+        lut = cmap
+        if lut.dtype != np.uint8:
+            lut = np.round(np.clip(lut, 0, 1) * 255).astype(np.uint8)
+        if lut.shape[1] == 3:
+            lut = np.column_stack([lut, np.full(len(lut), 255, dtype=np.uint8)])
+        return np.ascontiguousarray(lut)
+
+    import matplotlib.pyplot as plt
+    cmap = plt.get_cmap(cmap if cmap is not None else 'gray')
+    if n_colors is None or n_colors == cmap.N:
+        # integer input indexes the colormap table directly,
+        # which is what imshow ends up doing
+        return cmap(np.arange(cmap.N), bytes=True)
+
+    return cmap(np.linspace(0, 1, n_colors), bytes=True)
+
+
+def scalar_to_rgba(data, lut, vmin=None, vmax=None, mask=None):
+    """
+    Map scalar data to RGBA colors with a lookup table, the same way
+    matplotlib does it with a linear Normalize.
+
+    @param data: ndarray or masked array
+
+    @param lut: ndarray
+    Lookup table of shape (N, 4), see colormap_lut.
+
+    @param vmin: scalar, optional
+    @param vmax: scalar, optional
+    Data range mapped to the first and last colors of lut.
+    By default the minimum and maximum of the valid data.
+
+    @param mask: boolean ndarray, optional
+    True where the data must be transparent.
+    Masked and non-finite values are transparent too.
+
+    @return: ndarray
+    uint8 array of shape data.shape + (4,)
+    """
+    bad = np.ma.getmaskarray(data)
+    data = np.ma.getdata(data).astype(np.float64)
+    bad = bad | ~np.isfinite(data)
+    if mask is not None:
+        bad |= mask
+
+    if vmin is None or vmax is None:
+        valid = data[~bad]
+        if valid.size:
+            vmin = valid.min() if vmin is None else vmin
+            vmax = valid.max() if vmax is None else vmax
+        else:
+            vmin, vmax = 0, 0
+
+    n_colors = len(lut)
+    if vmax > vmin:
+        idx = data - vmin
+        idx *= n_colors / float(vmax - vmin)
+        idx[bad] = 0
+        np.clip(idx, 0, n_colors - 1, out=idx)
+        idx = idx.astype(np.intp)
+    else:
+        idx = np.zeros(data.shape, dtype=np.intp)
+
+    rgba = lut[idx]
+    rgba[bad] = 0
+    return rgba
+
+
+def alpha_composite(dst, src, opacity=1.):
+    """
+    Blend src over dst, both RGBA images with straight (not premultiplied)
+    alpha. dst is modified in place.
+
+    @param dst: ndarray
+    uint8 or float array of shape (..., 4)
+
+    @param src: ndarray
+    uint8 array of shape (..., 4), same shape as dst
+
+    @param opacity: float
+    Extra factor for the alpha channel of src.
+
+    @return: ndarray
+    dst
+    """
+    src = src.astype(np.float32)
+    dst_f = dst if dst.dtype == np.float32 else dst.astype(np.float32)
+
+    src_a = src[..., 3:] * (opacity / 255.)
+    dst_a = dst_f[..., 3:] / 255.
+    out_a = src_a + dst_a * (1 - src_a)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out_rgb = (src[..., :3] * src_a + dst_f[..., :3] * dst_a * (1 - src_a)) / out_a
+    out_rgb[np.broadcast_to(out_a == 0, out_rgb.shape)] = 0
+
+    dst[..., :3] = np.round(out_rgb) if dst.dtype == np.uint8 else out_rgb
+    dst[..., 3:] = np.round(out_a * 255) if dst.dtype == np.uint8 else out_a * 255
+    return dst
+
+
+def composite_workspace(shape):
+    """
+    Return the work buffers of composite_over for images of shape.
+
+    @param shape: tuple of int
+    (height, width)
+
+    @return: dict of ndarrays
+    """
+    shape = tuple(shape[:2])
+    return {'values': np.empty(shape, dtype=np.float32),
+            'index':  np.empty(shape, dtype=np.intp),
+            'bad':    np.empty(shape, dtype=bool),
+            'src':    np.empty(shape + (4,), dtype=np.float32),
+            'src_a':  np.empty(shape, dtype=np.float32),
+            'dst_w':  np.empty(shape, dtype=np.float32),
+            'out_a':  np.empty(shape, dtype=np.float32),
+            'opaque': np.empty(shape, dtype=bool)}
+
+
+def composite_over(acc, data, lut, vmin, vmax, mask=None, opacity=1., work=None):
+    """
+    Color scalar data with a lookup table and blend it over acc, the same
+    way as alpha_composite(acc, scalar_to_rgba(data, lut, vmin, vmax, mask),
+    opacity), but computing everything in place in preallocated buffers.
+
+    @param acc: ndarray
+    float32 array of shape (height, width, 4) with alpha in [0, 255],
+    modified in place.
+
+    @param data: ndarray or masked array
+    Array of shape (height, width).
+
+    @param lut: ndarray
+    Lookup table of shape (N, 4), see colormap_lut.
+
+    @param vmin: scalar
+    @param vmax: scalar
+
+    @param mask: boolean ndarray, optional
+    True where data must be transparent.
+
+    @param opacity: float
+
+    @param work: dict, optional
+    Buffers from composite_workspace(data.shape), allocated here if not given.
+
+    @return: ndarray
+    acc
+    """
+    if work is None:
+        work = composite_workspace(data.shape)
+
+    values, index, bad = work['values'], work['index'], work['bad']
+    src, src_a, dst_w = work['src'], work['src_a'], work['dst_w']
+    out_a, opaque = work['out_a'], work['opaque']
+
+    np.subtract(np.ma.getdata(data), vmin, out=values)
+    np.isfinite(values, out=bad)
+    np.logical_not(bad, out=bad)
+    if np.ma.is_masked(data):
+        bad |= np.ma.getmaskarray(data)
+    if mask is not None:
+        bad |= mask
+
+    n_colors = len(lut)
+    if vmax > vmin:
+        values *= n_colors / float(vmax - vmin)
+        values[bad] = 0
+        np.clip(values, 0, n_colors - 1, out=values)
+        index[:] = values
+    else:
+        index[:] = 0
+
+    np.take(lut.astype(np.float32), index, axis=0, out=src, mode='clip')
+
+    # straight alpha "over": acc = src * a_s + acc * a_d * (1 - a_s), normalized
+    np.multiply(src[..., 3], opacity / 255., out=src_a)
+    src_a[bad] = 0
+    np.subtract(1, src_a, out=dst_w)
+    dst_w *= acc[..., 3]
+    dst_w /= 255.
+    np.add(src_a, dst_w, out=out_a)
+
+    acc[..., :3] *= dst_w[..., np.newaxis]
+    src[..., :3] *= src_a[..., np.newaxis]
+    acc[..., :3] += src[..., :3]
+
+    np.greater(out_a, 0, out=opaque)
+    np.divide(acc[..., :3], out_a[..., np.newaxis], out=acc[..., :3],
+              where=opaque[..., np.newaxis])
+    acc[~opaque, :3] = 0
+    np.multiply(out_a, 255, out=acc[..., 3])
+    return acc
+
+
+def area_downscale(image, factor):
+    """
+    Reduce the size of an image by an integer factor averaging the pixels
+    of each factor x factor block.
+
+    The color of RGBA images is averaged weighted by the alpha channel,
+    so transparent pixels do not darken the borders.
+    If the image size is not a multiple of factor, the last blocks
+    are padded, with transparent pixels for RGBA images or repeating
+    the border for the others.
+
+    @param image: ndarray
+    Array of shape (height, width) or (height, width, channels)
+
+    @param factor: int
+
+    @return: ndarray
+    Image of the same dtype as image.
+    """
+    factor = int(factor)
+    if factor <= 1:
+        return image
+
+    has_alpha = image.ndim == 3 and image.shape[2] == 4
+    height, width = image.shape[:2]
+
+    img = image.astype(np.float64)
+    if has_alpha:
+        img[..., :3] *= img[..., 3:]
+
+    pad = [(0, -height % factor), (0, -width % factor)] + [(0, 0)] * (img.ndim - 2)
+    img = np.pad(img, pad, mode='constant' if has_alpha else 'edge')
+
+    new_shape = (img.shape[0] // factor, factor, img.shape[1] // factor, factor) + img.shape[2:]
+    img = img.reshape(new_shape).mean(axis=3).mean(axis=1)
+
+    if has_alpha:
+        alpha = img[..., 3:]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            img[..., :3] = np.where(alpha > 0, img[..., :3] / alpha, 0)
+
+    if np.issubdtype(image.dtype, np.integer):
+        info = np.iinfo(image.dtype)
+        img = np.clip(np.round(img), info.min, info.max)
+
+    return img.astype(image.dtype)
+
+
+def _content_plane(image):
+    """
+    Return the 2D plane of image used to look for its content:
+    the alpha channel of RGBA images, the first channel of other
+    multichannel images, or the image itself.
+    """
+    if image.ndim == 3:
+        return image[..., 3] if image.shape[2] == 4 else image[..., 0]
+    return image
+
+
+def crop_bounds(image, color=0, margin=0, block_rows=1024, all_channels=False):
+    """
+    Return the bounding box of the pixels of image different from color.
+
+    It only looks at the row and column projections of the content, processing
+    block_rows rows at a time, so it does not allocate any array as large
+    as the image.
+
+    @param image: ndarray
+    Array of shape (height, width) or (height, width, channels).
+    RGBA images are cropped by their alpha channel, other multichannel
+    images by their first channel, unless all_channels is True.
+
+    @param color: scalar or sequence
+    Background value, or one value for each channel.
+
+    @param margin: int
+    Number of background pixels to keep around the content, as long as
+    they are inside of the image.
+
+    @param block_rows: int
+    Number of rows compared with color at once.
+
+    @param all_channels: bool
+    If True, the background pixels of multichannel images are the ones
+    with every channel equal to color.
+
+    @return: tuple of 4 ints or None
+    (top, bottom, left, right) with bottom and right exclusive,
+    or None if the image only has background.
+    """
+    multichannel = all_channels and image.ndim == 3
+    plane  = image if multichannel else _content_plane(image)
+    height = plane.shape[0]
+
+    rows = np.zeros(height, dtype=bool)
+    cols = np.zeros(plane.shape[1], dtype=bool)
+    for start in range(0, height, block_rows):
+        block = plane[start:start + block_rows] != color
+        if multichannel:
+            block = block.any(axis=-1)
+        rows[start:start + block_rows] = block.any(axis=1)
+        cols |= block.any(axis=0)
+
+    if not rows.any():
+        return None
+
+    top    = np.argmax(rows)
+    bottom = height - np.argmax(rows[::-1])
+    left   = np.argmax(cols)
+    right  = len(cols) - np.argmax(cols[::-1])
+
+    return (int(max(top - margin, 0)), int(min(bottom + margin, height)),
+            int(max(left - margin, 0)), int(min(right + margin, len(cols))))
+
+
+def batch_crop_bounds(images, color=0, margin=0, common=False):
+    """
+    Return the bounding boxes of the content of several images.
+
+    A stack of images is processed at once with array operations, a list
+    of images of different sizes one image at a time with crop_bounds.
+
+    @param images: ndarray or list of ndarray
+    A stack of shape (n_images, height, width[, channels]) or a list of
+    images, which may have different sizes.
+
+    @param color: scalar
+    @param margin: int
+    See crop_bounds.
+
+    @param common: bool
+    If True, every row of the result is the union of all the bounding boxes,
+    so all the cropped images have the same size. Only for images of the
+    same size.
+
+    @return: ndarray
+    int array of shape (n_images, 4) with (top, bottom, left, right) rows.
+    The images with only background get their full size.
+    """
+    if isinstance(images, np.ndarray) and images.ndim >= 3:
+        bounds = _stack_crop_bounds(images, color=color, margin=margin)
+    else:
+        bounds = []
+        for image in images:
+            box = crop_bounds(image, color=color, margin=margin)
+            if box is None:
+                box = (0, image.shape[0], 0, image.shape[1])
+            bounds.append(box)
+        bounds = np.array(bounds, dtype=int).reshape((-1, 4))
+
+    if common and len(bounds):
+        union = [bounds[:, 0].min(), bounds[:, 1].max(),
+                 bounds[:, 2].min(), bounds[:, 3].max()]
+        bounds[:] = union
+
+    return bounds
+
+
+def _stack_crop_bounds(images, color=0, margin=0):
+    """
+    batch_crop_bounds for a stack of images of the same size.
+    """
+    if images.ndim == 4:
+        planes = images[..., 3] if images.shape[3] == 4 else images[..., 0]
+    else:
+        planes = images
+
+    n_images, height, width = planes.shape
+    content = planes != color
+    rows = content.any(axis=2)
+    cols = content.any(axis=1)
+
+    top    = np.argmax(rows, axis=1)
+    bottom = height - np.argmax(rows[:, ::-1], axis=1)
+    left   = np.argmax(cols, axis=1)
+    right  = width - np.argmax(cols[:, ::-1], axis=1)
+
+    bounds = np.column_stack([np.maximum(top - margin, 0),
+                              np.minimum(bottom + margin, height),
+                              np.maximum(left - margin, 0),
+                              np.minimum(right + margin, width)]).astype(int)
+
+    empty = ~rows.any(axis=1)
+    bounds[empty] = (0, height, 0, width)
+    return bounds
+
+
+def volume_bounds(vol, background=0, margin=0):
+    """
+    Return the bounding box of the voxels of vol different from background.
+
+    @param vol: ndarray
+    @param background: scalar
+
+    @param margin: int
+    Number of background voxels to keep around the content, as long as
+    they are inside of the volume.
+
+    @return: list of (int, int) or None
+    (start, stop) of each axis, with stop exclusive,
+    or None if vol only has background.
+    """
+    content = vol != background
+    if not content.any():
+        return None
+
+    bounds = []
+    for axis in range(vol.ndim):
+        others = tuple(a for a in range(vol.ndim) if a != axis)
+        proj = content.any(axis=others)
+        start = int(np.argmax(proj))
+        stop = len(proj) - int(np.argmax(proj[::-1]))
+        bounds.append((max(start - margin, 0), min(stop + margin, len(proj))))
+
+    return bounds
+
+
+def block_downsample(vol, factor):
+    """
+    Reduce the size of a volume by an integer factor along every axis,
+    averaging the voxels of each block. The last blocks are padded
+    repeating the border if the shape is not a multiple of factor.
+
+    @param vol: ndarray
+    @param factor: int
+
+    @return: ndarray
+    Float array, of the same dtype as vol if it is a float one,
+    float32 otherwise.
+    """
+    factor = int(factor)
+    dtype = vol.dtype if np.issubdtype(vol.dtype, np.floating) else np.float32
+    if factor <= 1:
+        return vol.astype(dtype, copy=False)
+
+    pad = [(0, -size % factor) for size in vol.shape]
+    padded = np.pad(vol, pad, mode='edge')
+
+    new_shape = []
+    for size in padded.shape:
+        new_shape.extend([size // factor, factor])
+    blocks = padded.reshape(new_shape)
+
+    return blocks.mean(axis=tuple(range(1, 2 * vol.ndim, 2)), dtype=np.float64).astype(dtype)
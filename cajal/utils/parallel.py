@@ -0,0 +1,104 @@
+# coding=utf-8
+#-------------------------------------------------------------------------------
+# License: BSD 3 clause
+#-------------------------------------------------------------------------------
+
+import  os
+import  logging
+from    concurrent.futures import ProcessPoolExecutor, as_completed
+
+log = logging.getLogger(__name__)
+
+
+def effective_n_jobs(n_jobs=None):
+    """
+    Return the number of worker processes to use for n_jobs.
+
+    @param n_jobs: int or None
+    None or 1 means serial execution, negative values count backwards
+    from the number of CPUs (-1 is all of them, -2 all but one, ...).
+
+    @return: int
+    """
+    if n_jobs is None:
+        return 1
+
+    n_jobs = int(n_jobs)
+    if n_jobs == 0:
+        raise ValueError('n_jobs == 0 has no meaning.')
+
+    if n_jobs < 0:
+        n_jobs = max((os.cpu_count() or 1) + 1 + n_jobs, 1)
+
+    return n_jobs
+
+
+def imap_ordered(func, jobs, n_jobs=None, executor=None, skip_errors=False):
+    """
+    Call func(*args, **kwargs) for each (args, kwargs) in jobs and yield
+    (job_index, result) pairs in the same order as jobs.
+
+    @param func: callable
+    Must be a module-level function if the jobs run in a process pool.
+
+    @param jobs: list of (tuple, dict)
+
+    @param n_jobs: int, optional
+    Number of worker processes. None or 1 runs the jobs serially in this
+    process. See effective_n_jobs.
+
+    @param executor: concurrent.futures.Executor, optional
+    An already running executor to submit the jobs to. It takes precedence
+    over n_jobs and it is not shut down here.
+
+    @param skip_errors: bool
+    If True, a job that raises is logged and left out of the output
+    instead of stopping the whole run.
+
+    @return: generator of (int, object)
+    """
+    return _imap(func, jobs, n_jobs, executor, skip_errors, ordered=True)
+
+
+def imap_unordered(func, jobs, n_jobs=None, executor=None, skip_errors=False):
+    """
+    Same as imap_ordered, but yields the (job_index, result) pairs as soon
+    as each job is done, so a slow job does not hold back the results of
+    the jobs after it.
+
+    @return: generator of (int, object)
+    """
+    return _imap(func, jobs, n_jobs, executor, skip_errors, ordered=False)
+
+
+def _imap(func, jobs, n_jobs=None, executor=None, skip_errors=False, ordered=True):
+    jobs = list(jobs)
+
+    if executor is None and effective_n_jobs(n_jobs) == 1:
+        for idx, (args, kwargs) in enumerate(jobs):
+            try:
+                yield idx, func(*args, **kwargs)
+            except Exception:
+                if not skip_errors:
+                    raise
+                log.exception('Error in job {} with arguments {}.'.format(idx, args))
+        return
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=effective_n_jobs(n_jobs))
+
+    try:
+        futures = [executor.submit(func, *args, **kwargs) for args, kwargs in jobs]
+        indices = dict((future, idx) for idx, future in enumerate(futures))
+        for future in (futures if ordered else as_completed(futures)):
+            idx = indices[future]
+            try:
+                yield idx, future.result()
+            except Exception:
+                if not skip_errors:
+                    raise
+                log.exception('Error in job {} with arguments {}.'.format(idx, jobs[idx][0]))
+    finally:
+        if own_executor:
+            executor.shutdown(wait=True)
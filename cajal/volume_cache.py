@@ -0,0 +1,158 @@
+# coding=utf-8
+#-------------------------------------------------------------------------------
+# License: BSD 3 clause
+#-------------------------------------------------------------------------------
+"""
+Local cache of decompressed copies of gzipped volume files, so their slices
+can be read with memory maps instead of decompressing the whole file again
+every time.
+"""
+import  os
+import  os.path     as op
+import  gzip
+import  shutil
+import  hashlib
+import  logging
+import  tempfile
+
+from    .config     import CACHE_DIR, CACHE_MAX_BYTES
+
+log = logging.getLogger(__name__)
+
+
+class DecompressionCache(object):
+    """Folder with uncompressed copies of .gz files, bounded by a disk budget.
+
+    Each copy is named after a hash of the absolute path, size and
+    modification time of its source file, so it is made again when the source
+    changes. The least recently used copies are removed when the folder goes
+    over max_bytes.
+
+    Parameters
+    ----------
+    cache_dir: str, optional
+        Folder of the cache. By default cajal.config.CACHE_DIR/decompressed,
+        which can be set with the CAJAL_CACHE_DIR environment variable.
+
+    max_bytes: int, optional
+        Disk budget of the cache. By default cajal.config.CACHE_MAX_BYTES.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=None):
+        if cache_dir is None:
+            cache_dir = op.join(CACHE_DIR, 'decompressed')
+        if max_bytes is None:
+            max_bytes = CACHE_MAX_BYTES
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, filepath):
+        """Return the cache key of filepath."""
+        st = os.stat(filepath)
+        text = '{}|{}|{}'.format(op.abspath(filepath), st.st_size, st.st_mtime)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def cached_path(self, filepath):
+        """Return the path of the decompressed copy of filepath, which may not exist yet."""
+        name = op.basename(filepath)
+        if name.endswith('.gz'):
+            name = name[:-len('.gz')]
+        return op.join(self.cache_dir, self.key(filepath) + '_' + name)
+
+    def get(self, filepath):
+        """Return the path to an uncompressed copy of filepath,
+        decompressing it into the cache if it is not there yet.
+
+        Parameters
+        ----------
+        filepath: str
+            Path to a gzipped file.
+
+        Returns
+        -------
+        str
+        """
+        path = self.cached_path(filepath)
+        if op.exists(path):
+            # the modification time of the copies is their last use
+            os.utime(path, None)
+            return path
+
+        log.debug('Decompressing {} into {}.'.format(filepath, path))
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as dst, gzip.open(filepath, 'rb') as src:
+                shutil.copyfileobj(src, dst, 1 << 20)
+            os.rename(tmp_path, path)
+        except:
+            os.remove(tmp_path)
+            raise
+
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep=None):
+        """Remove the least recently used copies until the cache fits in max_bytes.
+
+        Parameters
+        ----------
+        keep: str, optional
+            Path of a copy that must not be removed.
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = op.join(self.cache_dir, name)
+            if name.endswith('.part') or not op.isfile(path):
+                continue
+            st = os.stat(path)
+            entries.append((st.st_mtime, st.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                log.exception('Could not remove {} from the cache.'.format(path))
+
+    def clear(self):
+        """Remove all the copies in the cache."""
+        for name in os.listdir(self.cache_dir):
+            path = op.join(self.cache_dir, name)
+            if op.isfile(path):
+                os.remove(path)
+
+
+def uncompressed_path(filepath, cache=None):
+    """Return a path to an uncompressed version of filepath.
+
+    Parameters
+    ----------
+    filepath: str
+
+    cache: DecompressionCache, bool, str or None
+        If filepath is gzipped and cache is a DecompressionCache, True for
+        the default one, or the folder of one, return the path to its copy
+        in the cache. Folders and True can be sent to worker processes.
+
+    Returns
+    -------
+    str
+        filepath itself if it is not gzipped or there is no cache.
+    """
+    if not cache or not filepath.endswith('.gz'):
+        return filepath
+
+    if cache is True:
+        cache = DecompressionCache()
+    elif isinstance(cache, str):
+        cache = DecompressionCache(cache)
+
+    return cache.get(filepath)
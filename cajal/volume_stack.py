@@ -4,6 +4,7 @@ import logging
 import numpy as np
 
 from .plot_volume import PlotVolume
+from .utils.image import composite_over, composite_workspace
 
 log = logging.getLogger(__name__)
 
@@ -11,12 +12,18 @@ log = logging.getLogger(__name__)
 class PlotVolumeStack(object):
     """A stack of PlotVolumes for overlapping volume slice plots"""
 
-    vols = []
     cut_point = np.zeros(3)
     vol_type = PlotVolume
 
     def __init__(self):
         self.cut_points = np.zeros(3, dtype=int)
+        self._layers = []
+        self._buffers = {}
+
+    @property
+    def vols(self):
+        """The PlotVolumes of the stack, from bottom to top."""
+        return self._layers
 
     def add_volume(self, plot_volume):
         """Add one PlotVolume to the plot stack
@@ -26,20 +33,83 @@ class PlotVolumeStack(object):
         plot_volume: slicy.plot_volume.PlotVolume
         """
         # check if volume has same metadata as other volumes in self
-        if self.vols:
-            try:
-                plot_volume.check_compatibility_with(self.vols[0])
-            except:
-                raise
-        else:
-            self.vols.append(plot_volume)
-
-    def add_from_file(self, filepath):
+        if self._layers:
+            plot_volume.check_compatibility_with(self._layers[0])
+
+        self._layers.append(plot_volume)
+
+    def add_from_file(self, filepath, **kwargs):
         """Add one volume to the plot stack from the file path.
 
         Parameters
         ----------
         filepath: str
             Path to a volume file
+
+        kwargs: arguments to PlotVolume.from_file
+        """
+        self.add_volume(self.vol_type.from_file(filepath, **kwargs))
+
+    def composite_slice(self, axis, index, orientation='rot90', out=None):
+        """Blend the slice of all the visible volumes of the stack into one
+        RGBA image, from bottom to top.
+
+        Each volume is colored with the lookup table of its colormap and its
+        color limits, its voxels equal to its transparent value are left out,
+        and it is blended with its opacity.
+
+        Parameters
+        ----------
+        axis: int
+
+        index: int
+
+        orientation: str or None
+            See cajal.plot_volume.orient_slice.
+
+        out: np.ndarray, optional
+            uint8 array of shape (height, width, 4) for the result.
+            If not given, a buffer of the stack is reused, which is overwritten
+            by the next call with a slice of the same size.
+
+        Returns
+        -------
+        np.ndarray
+            uint8 array of shape (height, width, 4)
         """
-        self.add_volume(self.vol_type.from_file(filepath))
\ No newline at end of file
+        acc = None
+        for layer in self._layers:
+            if not layer.is_visible:
+                continue
+
+            img = layer.display_slice(index, axis=axis, orientation=orientation)
+            if acc is None:
+                acc, buf, work = self._get_buffers(img.shape)
+                acc[:] = 0
+
+            mask = None
+            if layer._transp_val is not None:
+                mask = img == layer._transp_val
+
+            vmin, vmax = layer.clim
+            composite_over(acc, img, layer.lut, vmin, vmax, mask=mask,
+                           opacity=layer._opacity, work=work)
+
+        if acc is None:
+            raise ValueError('There are no visible volumes in the stack.')
+
+        if out is None:
+            out = buf
+        np.round(acc, out=acc)
+        out[:] = acc
+        return out
+
+    def _get_buffers(self, shape):
+        """Return the float accumulator, the uint8 output and the work buffers
+        of composite_over for slices of shape, allocated once for each shape."""
+        shape = tuple(shape[:2])
+        if shape not in self._buffers:
+            self._buffers[shape] = (np.zeros(shape + (4,), dtype=np.float32),
+                                    np.zeros(shape + (4,), dtype=np.uint8),
+                                    composite_workspace(shape))
+        return self._buffers[shape]
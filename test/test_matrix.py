@@ -0,0 +1,115 @@
+# coding=utf-8
+#-------------------------------------------------------------------------------
+# License: BSD 3 clause
+#-------------------------------------------------------------------------------
+import  numpy           as np
+import  scipy.sparse    as sp
+import  pytest
+
+from    cajal.matrix    import (block_reduce_matrix, reduce_region, select_edges,
+                                node_indices)
+
+
+def sparse_test_matrix(size=23, seed=0):
+    """Square matrix with positive, negative, NaN and mostly zero cells."""
+    rng = np.random.RandomState(seed)
+    m = rng.randn(size, size)
+    m[rng.rand(size, size) < 0.6] = 0
+    m[rng.rand(size, size) < 0.05] = np.nan
+    return m
+
+
+@pytest.mark.parametrize('method', ['mean', 'max', 'absmax'])
+@pytest.mark.parametrize('lower_triangle_only', [False, True])
+@pytest.mark.parametrize('factor', [2, 5])
+def test_sparse_reduction_matches_dense(method, lower_triangle_only, factor):
+    m = sparse_test_matrix()
+    n = m.shape[0]
+    assert n % factor
+
+    expected = reduce_region(m, slice(0, n), slice(0, n), factor, method,
+                             lower_triangle_only)
+    reduced = block_reduce_matrix(sp.csr_matrix(m), factor, method,
+                                  lower_triangle_only)
+    np.testing.assert_allclose(reduced, expected, equal_nan=True)
+
+    # a region off the diagonal, as matrix_to_rgba pools a lower triangle
+    rows, cols = slice(1, n), slice(0, n - 1)
+    expected = reduce_region(m, rows, cols, factor, method, lower_triangle_only)
+    reduced = block_reduce_matrix(sp.csr_matrix(m), factor, method,
+                                  lower_triangle_only, rows=rows, cols=cols)
+    np.testing.assert_allclose(reduced, expected, equal_nan=True)
+
+
+def edge_list(n_edges=40, seed=0):
+    """Edges numbered by their position, with many tied weights."""
+    rng = np.random.RandomState(seed)
+    rows = np.arange(n_edges)
+    cols = rows[::-1].copy()
+    weights = rng.randint(0, 8, n_edges).astype(float)
+    return rows, cols, weights
+
+
+def check_selection(selected, edges, n_kept, threshold=None):
+    """Compare the selected edges with the n_kept largest ones of a full sort."""
+    rows, cols, weights = selected
+    all_rows, all_cols, all_weights = edges
+
+    assert len(rows) == len(cols) == len(weights) == n_kept
+    # in their original order, with their own columns and weights
+    assert np.all(np.diff(rows) > 0)
+    np.testing.assert_array_equal(cols, all_cols[rows])
+    np.testing.assert_array_equal(weights, all_weights[rows])
+    # the largest ones, whichever of the tied edges are kept
+    np.testing.assert_array_equal(np.sort(weights),
+                                  np.sort(all_weights)[len(all_weights) - n_kept:])
+    if threshold is not None:
+        assert np.all(weights >= threshold)
+
+
+@pytest.mark.parametrize('top_k', [0, 1, 7, 39, 40, 100])
+def test_select_edges_top_k(top_k):
+    edges = edge_list()
+    selected = select_edges(*edges, top_k=top_k)
+    check_selection(selected, edges, min(top_k, len(edges[2])))
+
+
+@pytest.mark.parametrize('percentile', [0, 25, 50, 90, 100])
+def test_select_edges_percentile(percentile):
+    edges = edge_list()
+    weights = np.sort(edges[2])
+
+    # linear interpolation between the closest ranks of the sorted weights
+    rank = percentile / 100. * (len(weights) - 1)
+    low, high = int(np.floor(rank)), int(np.ceil(rank))
+    threshold = weights[low] + (weights[high] - weights[low]) * (rank - low)
+
+    selected = select_edges(*edges, percentile=percentile)
+    check_selection(selected, edges, np.sum(weights >= threshold), threshold)
+
+
+@pytest.mark.parametrize('density, top_k', [(0.1, None), (0.1, 2), (1., None)])
+def test_select_edges_density(density, top_k):
+    edges = edge_list()
+    n_nodes = 7
+    n_kept = int(round(density * n_nodes * (n_nodes - 1)))
+    if top_k is not None:
+        n_kept = min(n_kept, top_k)
+
+    selected = select_edges(*edges, top_k=top_k, density=density, n_nodes=n_nodes)
+    check_selection(selected, edges, min(n_kept, len(edges[2])))
+
+    with pytest.raises(ValueError):
+        select_edges(*edges, density=density)
+
+
+def test_node_indices():
+    node_values = np.array([40, 3, 17, 8, 25])
+    pairs = np.array([[3, 40, 25], [8, 17, 3]])
+
+    indices = node_indices(node_values, pairs)
+    expected = [[list(node_values).index(value) for value in row] for row in pairs]
+    np.testing.assert_array_equal(indices, expected)
+
+    with pytest.raises(ValueError):
+        node_indices(node_values, [[3, 50], [8, 5]])
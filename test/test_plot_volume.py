@@ -0,0 +1,55 @@
+# coding=utf-8
+#-------------------------------------------------------------------------------
+# License: BSD 3 clause
+#-------------------------------------------------------------------------------
+import  os.path     as op
+
+import  numpy       as np
+import  pytest
+
+from    cajal.plot_volume   import open_volume_file, read_mhd_header, mhd_memmap
+
+
+def write_mhd(dirpath, vol, spacing=(1., 2., 3.)):
+    """Write vol, indexed (z, y, x), as a MetaImage .mhd/.raw pair."""
+    mhd_file = op.join(str(dirpath), 'vol.mhd')
+    with open(op.join(str(dirpath), 'vol.raw'), 'wb') as f:
+        f.write(vol.astype(np.int16).tobytes())
+
+    with open(mhd_file, 'w') as f:
+        f.write('ObjectType = Image\n')
+        f.write('NDims = 3\n')
+        f.write('DimSize = {}\n'.format(' '.join(str(d) for d in vol.shape[::-1])))
+        f.write('ElementSpacing = {}\n'.format(' '.join(str(s) for s in spacing)))
+        f.write('ElementType = MET_SHORT\n')
+        f.write('ElementDataFile = vol.raw\n')
+    return mhd_file
+
+
+def test_lazy_mhd_matches_eager(tmpdir):
+    pytest.importorskip('boyle.mhd')
+
+    vol = np.arange(2 * 3 * 4, dtype=np.int16).reshape((2, 3, 4))
+    mhd_file = write_mhd(tmpdir, vol)
+
+    eager_data, eager_pixdim = open_volume_file(mhd_file, lazy=False)
+    lazy_data, lazy_pixdim = open_volume_file(mhd_file, lazy=True)
+
+    assert isinstance(lazy_data, np.memmap)
+    assert lazy_data.shape == eager_data.shape
+    np.testing.assert_array_equal(np.asarray(lazy_data), eager_data)
+    np.testing.assert_array_equal(lazy_data[1, :, 2], eager_data[1, :, 2])
+
+    assert type(lazy_pixdim) is type(eager_pixdim)
+    assert lazy_pixdim == eager_pixdim
+
+
+def test_multichannel_mhd_is_not_memory_mapped(tmpdir):
+    vol = np.arange(2 * 3 * 4 * 3, dtype=np.int16)
+    mhd_file = write_mhd(tmpdir, vol.reshape((2, 3, 12)))
+    with open(mhd_file) as f:
+        header = f.read().replace('DimSize = 12 3 2', 'DimSize = 4 3 2')
+    with open(mhd_file, 'w') as f:
+        f.write('ElementNumberOfChannels = 3\n' + header)
+
+    assert mhd_memmap(mhd_file, read_mhd_header(mhd_file)) is None
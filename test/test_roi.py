@@ -0,0 +1,110 @@
+# coding=utf-8
+#-------------------------------------------------------------------------------
+# License: BSD 3 clause
+#-------------------------------------------------------------------------------
+import  numpy           as np
+import  scipy.ndimage   as scn
+import  pytest
+
+from    cajal.roi       import get_rois_statistics, get_rois_outline
+
+
+def toy_volume():
+    """Label volume with three ROIs of different shapes, label 2 is missing."""
+    vol = np.zeros((6, 7, 8), dtype=np.int16)
+    vol[1:3, 2:5, 0:2] = 1
+    vol[4, 0:7, 3] = 3
+    vol[0:6, 6, 5:8] = 4
+    vol[5, 1, 7] = 4
+    return vol
+
+
+def test_rois_statistics_match_ndimage():
+    vol = toy_volume()
+    image = np.random.RandomState(0).rand(*vol.shape)
+    labels = [1, 3, 4]
+
+    stats = get_rois_statistics(vol, image=image)
+
+    np.testing.assert_array_equal(stats['labels'], labels)
+    np.testing.assert_array_equal(stats['counts'],
+                                  [np.sum(vol == label) for label in labels])
+
+    np.testing.assert_allclose(stats['centroids'],
+                               scn.center_of_mass(np.ones(vol.shape), vol, labels))
+
+    objects = scn.find_objects(vol)
+    for row, label in enumerate(labels):
+        bbox = objects[label - 1]
+        np.testing.assert_array_equal(stats['bbox_min'][row], [s.start for s in bbox])
+        np.testing.assert_array_equal(stats['bbox_max'][row], [s.stop - 1 for s in bbox])
+
+    np.testing.assert_allclose(stats['mean'], scn.mean(image, vol, labels))
+    np.testing.assert_allclose(stats['min'], scn.minimum(image, vol, labels))
+    np.testing.assert_allclose(stats['max'], scn.maximum(image, vol, labels))
+
+
+def test_rois_statistics_affine():
+    vol = toy_volume()
+    affine = np.diag([2., 2., 2., 1.])
+    affine[:3, 3] = [-10, 5, 0]
+
+    stats = get_rois_statistics(vol, affine=affine)
+    np.testing.assert_allclose(stats['centroids_mm'],
+                               stats['centroids'] * 2 + [-10, 5, 0])
+
+    with pytest.raises(AssertionError):
+        get_rois_statistics(vol[0], affine=affine)
+
+
+def two_label_volume():
+    """A 5x5x5 cube of label 1 inside the volume and a box of label 7
+    touching it and the volume border."""
+    vol = np.zeros((9, 9, 9), dtype=np.uint8)
+    vol[2:7, 2:7, 2:7] = 1
+    vol[2:7, 2:7, 7:9] = 7
+    return vol
+
+
+def outline_reference(vol, axis=None, background=0):
+    """Voxel by voxel: a ROI voxel with a face neighbour of another value,
+    or on the border of the volume, skipping the neighbours along axis."""
+    out = np.full(vol.shape, background, dtype=vol.dtype)
+    for idx in zip(*np.nonzero(vol != background)):
+        for ax in range(vol.ndim):
+            if ax == axis:
+                continue
+            for step in (-1, 1):
+                neighbour = list(idx)
+                neighbour[ax] += step
+                if (not 0 <= neighbour[ax] < vol.shape[ax] or
+                        vol[tuple(neighbour)] != vol[idx]):
+                    out[idx] = vol[idx]
+    return out
+
+
+@pytest.mark.parametrize('axis', [None, 0, 2])
+def test_rois_outline(axis):
+    vol = two_label_volume()
+    outline = get_rois_outline(vol, axis=axis)
+
+    assert outline.shape == vol.shape and outline.dtype == vol.dtype
+    np.testing.assert_array_equal(outline, outline_reference(vol, axis=axis))
+
+    # the labels are kept and the inside of the ROIs is left out
+    in_outline = outline != 0
+    np.testing.assert_array_equal(outline[in_outline], vol[in_outline])
+    assert set(np.unique(outline)) == {0, 1, 7}
+    assert outline[4, 4, 4] == 0
+
+
+def test_rois_outline_axis():
+    vol = two_label_volume()
+
+    # on the top face of the cube, its only other neighbour is along axis 0
+    assert get_rois_outline(vol)[2, 4, 4] == 1
+    assert get_rois_outline(vol, axis=0)[2, 4, 4] == 0
+    assert get_rois_outline(vol, axis=-3)[2, 4, 4] == 0
+
+    # on the side face, which is still a contour in the axis 0 slices
+    assert get_rois_outline(vol, axis=0)[4, 2, 4] == 1